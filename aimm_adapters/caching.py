@@ -0,0 +1,506 @@
+"""
+Caches shared by the LabVIEW trees.
+
+The persistent ones (tree snapshots and, along with them, the negative cache) are
+written to CACHE_DIRECTORY when persistence is asked for. It defaults to
+~/.cache/aimm_adapters and can be moved with the AIMM_ADAPTERS_CACHE environment
+variable. The memory budget of the parsed frames defaults to
+DEFAULT_FRAME_BUDGET bytes and can be set with AIMM_ADAPTERS_FRAME_BUDGET.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+CACHE_DIRECTORY = Path(
+    os.environ.get(
+        "AIMM_ADAPTERS_CACHE", Path("~", ".cache", "aimm_adapters").expanduser()
+    )
+)
+DEFAULT_FRAME_BUDGET = int(
+    os.environ.get("AIMM_ADAPTERS_FRAME_BUDGET", 512 * 1024 * 1024)
+)
+# Seconds after a change before the negative cache is written.
+DEFAULT_FLUSH_DELAY = 5
+NEGATIVE_CACHE_VERSION = 1
+SNAPSHOT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+def _write_json_atomically(filename, content):
+    # Readers never see a partially written file.
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    temporary = filename.with_name(f".{filename.name}.{os.getpid()}.tmp")
+    with open(temporary, "w") as file:
+        json.dump(content, file, separators=(",", ":"))
+    os.replace(temporary, filename)
+
+
+class NegativeCache:
+    """
+    Persistent record of the files known to give no tree node.
+
+    Each entry stores the size and mtime of the file when it was found empty,
+    header-only or malformed, together with the reason. A file stays skipped
+    without being opened until its size or mtime changes. Entries are kept per
+    reader kind, since a file may only fail for some of the readers.
+
+    Changes are written in batches, at most every flush_delay seconds and at
+    exit, rather than on every entry.
+
+    Parameters
+    ----------
+    filename : str or Path, optional
+        JSON file the entries are loaded from and saved to. If None, the cache
+        only lives in memory.
+    flush_delay : float, optional
+        Seconds between a change and the write that saves it.
+    """
+
+    def __init__(self, filename=None, flush_delay=DEFAULT_FLUSH_DELAY):
+        self._filename = None
+        self._flush_delay = flush_delay
+        self._lock = threading.Lock()
+        self._changed = False
+        self._timer = None
+        self._saved_at_exit = False
+        # Maps each reader kind to {path: [size, mtime_ns, reason]}.
+        self._entries = {}
+        if filename is not None:
+            self.persist(filename)
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def persist(self, filename):
+        # Loads the entries saved in filename, on top of which the ones found so
+        # far are kept, and saves them there from now on. With None, the cache
+        # only lives in memory again.
+        content = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as file:
+                    content = json.load(file)
+            except (OSError, ValueError):
+                # Start over from a corrupted or unreadable file.
+                content = {}
+        with self._lock:
+            entries = {}
+            if content.get("version") == NEGATIVE_CACHE_VERSION:
+                entries = content["entries"]
+            for kind, kind_entries in self._entries.items():
+                entries.setdefault(kind, {}).update(kind_entries)
+            self._changed = bool(self._entries)
+            self._entries = entries
+            self._filename = filename
+            if filename is not None and not self._saved_at_exit:
+                self._saved_at_exit = True
+                atexit.register(self.save)
+
+    def reason(self, filepath, stat, kind):
+        # Returns why filepath gives no node of the given kind, or None if it is
+        # not known to be bad or if it changed since it was recorded.
+        key = os.path.abspath(filepath)
+        with self._lock:
+            entry = self._entries.get(kind, {}).get(key)
+        if entry is None:
+            return None
+        size, mtime_ns, reason = entry
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            self.discard(filepath, kind)
+            return None
+        return reason
+
+    def add(self, filepath, reason, stat, kind):
+        # The stat result must be taken before reading the file, so that a file
+        # modified while being parsed is not skipped.
+        with self._lock:
+            self._entries.setdefault(kind, {})[os.path.abspath(filepath)] = [
+                stat.st_size,
+                stat.st_mtime_ns,
+                reason,
+            ]
+            self._schedule_save()
+
+    def discard(self, filepath, kind=None):
+        # Forgets filepath for one reader kind, or for all of them.
+        key = os.path.abspath(filepath)
+        with self._lock:
+            kinds = list(self._entries) if kind is None else [kind]
+            for name in kinds:
+                if self._entries.get(name, {}).pop(key, None) is not None:
+                    self._schedule_save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._schedule_save()
+
+    def _schedule_save(self):
+        # Called with the lock held.
+        self._changed = True
+        if self._filename is not None and self._timer is None:
+            self._timer = threading.Timer(self._flush_delay, self.save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def save(self):
+        # Writes the entries if anything changed since they were loaded or saved.
+        if self._filename is None:
+            return
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._changed:
+                return
+            content = {"version": NEGATIVE_CACHE_VERSION, "entries": self._entries}
+            try:
+                _write_json_atomically(self._filename, content)
+            except OSError as err:
+                # Runs from a timer or at exit, where raising would help no one.
+                # The entries are written again with the next save.
+                logger.warning("Could not save the negative cache: %s", err)
+                return
+            self._changed = False
+
+    def __contains__(self, filepath):
+        # Whether filepath is known to be bad for any reader kind.
+        key = os.path.abspath(filepath)
+        with self._lock:
+            return any(key in entries for entries in self._entries.values())
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._entries.values())
+
+
+def frame_nbytes(df):
+    # Memory held by the values and the index of a dataframe.
+    return int(df.memory_usage(index=True).sum())
+
+
+class FrameStore:
+    """
+    Bounded in-memory store for parsed LabVIEW frames, with spill-to-disk.
+
+    Each frame is accounted by its nbytes. Once the total goes over max_bytes,
+    the least recently used frames are evicted and pickled to spill_directory,
+    where the next access loads them from instead of parsing the text again.
+    A frame is only written to disk the first time it is evicted.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget of the frames kept in memory.
+    spill_directory : str or Path, optional
+        Where evicted frames are written. By default, a temporary directory
+        that is removed with the store.
+    max_spill_bytes : int, optional
+        Disk budget of the spilled frames; the least recently spilled ones are
+        deleted first. Unbounded by default.
+    """
+
+    def __init__(
+        self, max_bytes=DEFAULT_FRAME_BUDGET, spill_directory=None, max_spill_bytes=None
+    ):
+        self.max_bytes = max_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self._spill_directory = spill_directory
+        self._lock = threading.Lock()
+        # Maps keys to (frame, nbytes), in least recently used order.
+        self._frames = OrderedDict()
+        # Maps keys to (spill file, file size), in least recently spilled order.
+        self._spilled = OrderedDict()
+        self._bytes = 0
+        self._spill_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+        self.spill_loads = 0
+
+    @property
+    def usage(self):
+        # Current usage and counters, e.g. for monitoring.
+        with self._lock:
+            return {
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "frames": len(self._frames),
+                "spilled_bytes": self._spill_bytes,
+                "spilled_frames": len(self._spilled),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "spills": self.spills,
+                "spill_loads": self.spill_loads,
+            }
+
+    def get(self, key):
+        # Returns the frame stored for key, or None.
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return self._frames[key][0]
+            spilled = self._spilled.get(key)
+            if spilled is None:
+                self.misses += 1
+                return None
+        try:
+            with open(spilled[0], "rb") as file:
+                df = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self._drop_spilled(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.spill_loads += 1
+        self.put(key, df)
+        return df
+
+    def put(self, key, df):
+        nbytes = frame_nbytes(df)
+        with self._lock:
+            if key in self._frames:
+                self._bytes -= self._frames[key][1]
+            self._frames[key] = (df, nbytes)
+            self._frames.move_to_end(key)
+            self._bytes += nbytes
+            evicted = []
+            while self._bytes > self.max_bytes and self._frames:
+                evicted_key, (evicted_df, evicted_nbytes) = self._frames.popitem(
+                    last=False
+                )
+                self._bytes -= evicted_nbytes
+                self.evictions += 1
+                if evicted_key not in self._spilled:
+                    evicted.append((evicted_key, evicted_df))
+        # Write outside of the lock; a concurrent get() of these keys parses again.
+        for evicted_key, evicted_df in evicted:
+            self._spill(evicted_key, evicted_df)
+
+    def discard(self, key):
+        with self._lock:
+            frame = self._frames.pop(key, None)
+            if frame is not None:
+                self._bytes -= frame[1]
+        self._drop_spilled(key)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._spilled)
+            self._frames.clear()
+            self._bytes = 0
+        for key in keys:
+            self._drop_spilled(key)
+
+    def _spill(self, key, df):
+        directory = self._get_spill_directory()
+        filename = Path(directory, hashlib.sha1(repr(key).encode()).hexdigest())
+        try:
+            with open(filename, "wb") as file:
+                pickle.dump(df, file, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            # Without room on disk the frame is parsed again when needed.
+            return
+        size = filename.stat().st_size
+        with self._lock:
+            self._spilled[key] = (filename, size)
+            self._spill_bytes += size
+            self.spills += 1
+            expired = []
+            if self.max_spill_bytes is not None:
+                while self._spill_bytes > self.max_spill_bytes and self._spilled:
+                    expired_key, (expired_file, expired_size) = self._spilled.popitem(
+                        last=False
+                    )
+                    self._spill_bytes -= expired_size
+                    expired.append(expired_file)
+        for expired_file in expired:
+            _remove_file(expired_file)
+
+    def _drop_spilled(self, key):
+        with self._lock:
+            spilled = self._spilled.pop(key, None)
+            if spilled is not None:
+                self._spill_bytes -= spilled[1]
+        if spilled is not None:
+            _remove_file(spilled[0])
+
+    def _get_spill_directory(self):
+        with self._lock:
+            if self._spill_directory is None:
+                self._spill_directory = tempfile.mkdtemp(prefix="aimm_adapters_frames_")
+                weakref.finalize(
+                    self, shutil.rmtree, self._spill_directory, ignore_errors=True
+                )
+            else:
+                os.makedirs(self._spill_directory, exist_ok=True)
+            return self._spill_directory
+
+
+class TreeSnapshot:
+    """
+    Persisted directory listings and node layouts of a tree.
+
+    A listing is recorded with the mtime of its directory and a node layout with
+    the size and mtime of its file. Entries are only returned while these still
+    match, so after a restart only the directories and files that changed are
+    listed and parsed again.
+
+    Parameters
+    ----------
+    filename : str or Path, optional
+        JSON file the snapshot is loaded from and saved to. If None, the
+        snapshot only lives in memory.
+    """
+
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._changed = False
+        # Maps each directory to its mtime, listing and file layouts.
+        self._directories = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as file:
+                    content = json.load(file)
+            except ValueError:
+                # Start over from a corrupted file.
+                content = {}
+            if content.get("version") == SNAPSHOT_VERSION:
+                self._directories = content["directories"]
+
+    def _directory(self, path):
+        return self._directories.setdefault(
+            os.path.abspath(path),
+            {"mtime_ns": None, "subdirectories": [], "groups": {}, "files": {}},
+        )
+
+    def listing(self, path, mtime_ns):
+        # Returns the (subdirectory names, {stem: filenames}) pair recorded for
+        # path, or None if the directory changed since.
+        with self._lock:
+            entry = self._directories.get(os.path.abspath(path))
+            if entry is None or entry["mtime_ns"] != mtime_ns:
+                return None
+            return list(entry["subdirectories"]), dict(entry["groups"])
+
+    def set_listing(self, path, mtime_ns, subdirectories, groups):
+        with self._lock:
+            entry = self._directory(path)
+            filenames = {name for names in groups.values() for name in names}
+            # Forget the layouts of removed files and the removed subdirectories.
+            entry["files"] = {
+                name: layout
+                for name, layout in entry["files"].items()
+                if name in filenames
+            }
+            for name in set(entry["subdirectories"]) - set(subdirectories):
+                removed = os.path.join(os.path.abspath(path), name)
+                for key in list(self._directories):
+                    if key == removed or key.startswith(removed + os.sep):
+                        del self._directories[key]
+            entry["mtime_ns"] = mtime_ns
+            entry["subdirectories"] = list(subdirectories)
+            entry["groups"] = dict(groups)
+            self._changed = True
+
+    def layout(self, filepath, stat):
+        # Returns the node layout recorded for filepath, or None if the file
+        # changed since.
+        path, name = os.path.split(os.path.abspath(filepath))
+        with self._lock:
+            entry = self._directories.get(path)
+            if entry is None or name not in entry["files"]:
+                return None
+            size, mtime_ns, layout = entry["files"][name]
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return layout
+
+    def set_layout(self, filepath, stat, layout):
+        # The stat result must be taken before reading the file, as for the
+        # negative cache. A None layout forgets the file.
+        path, name = os.path.split(os.path.abspath(filepath))
+        with self._lock:
+            files = self._directory(path)["files"]
+            if layout is not None:
+                files[name] = [stat.st_size, stat.st_mtime_ns, layout]
+            elif files.pop(name, None) is None:
+                return
+            self._changed = True
+
+    def save(self):
+        # Writes the snapshot if anything changed since it was loaded or saved.
+        if self._filename is None:
+            return
+        with self._lock:
+            if not self._changed:
+                return
+            content = {"version": SNAPSHOT_VERSION, "directories": self._directories}
+            _write_json_atomically(self._filename, content)
+            self._changed = False
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls that compute the same value.
+
+    The first caller of do() for a key runs the function; callers that arrive
+    with the same key while it runs wait for it and get the same result, or the
+    same exception. Nothing is kept once the call returns, so caching the result
+    is left to the caller.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
@@ -13,21 +13,165 @@ and start a server like this:
 tiled serve config config.yml
 """
 
+import atexit
+import collections.abc
+import copy
+import functools
+import hashlib
+import io
+import json
 import os
-from collections import defaultdict
+import queue
+import re
+import sys
+import threading
+import time
+import warnings
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import xraydb
+from prometheus_client import Counter, Gauge
 from tiled.adapters.dataframe import DataFrameAdapter
 from tiled.adapters.mapping import MapAdapter
-from tiled.server.object_cache import with_object_cache
+from tiled.server.object_cache import NO_CACHE, get_object_cache, with_object_cache
+
+from .caching import (
+    CACHE_DIRECTORY,
+    FrameStore,
+    NegativeCache,
+    SingleFlight,
+    TreeSnapshot,
+)
 
 _EDGE_ENERGY_DICT = {
     xraydb.atomic_symbol(i): [i, xraydb.xray_edges(i)] for i in range(1, 99)
 }
 
+# Seconds between two checks of the lazily expanded trees for filesystem changes,
+# when the handlers are asked to keep them in sync.
+DEFAULT_POLL_INTERVAL = 5
+
+# Number of following scans of an experiment group built in the background when
+# one of them is requested, and number of threads building them.
+DEFAULT_PREFETCH_DEPTH = 2
+PREFETCH_WORKERS = 2
+
+# Keys of the nodes that serve all the scans of an experiment group at once, and
+# their average on a common energy grid.
+STACKED_KEY = "stacked"
+MERGED_KEY = "merged"
+
+# Fit ranges of the edge-step normalization, in eV relative to the edge energy,
+# and order of the post-edge polynomial.
+DEFAULT_PRE_EDGE = (-150.0, -30.0)
+DEFAULT_POST_EDGE = (50.0, 400.0)
+DEFAULT_POST_EDGE_ORDER = 2
+
+# A point of mu(E) is flagged as a glitch when it is further than SPIKE_THRESHOLD
+# times the spread of the SPIKE_WINDOW points around it from their median.
+SPIKE_THRESHOLD = 8.0
+SPIKE_WINDOW = 5
+
+# Runs of fewer energy steps than this in the other direction are jitter of the
+# monochromator rather than a new sweep.
+MIN_SWEEP_STEPS = 3
+
+# Amplifier sensitivities read "<value> <unit>", e.g. "2 nA/V". Current
+# sensitivities are converted to A/V with the prefix of their unit.
+SENSITIVITY_PATTERN = re.compile(
+    r"^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(.*?)\s*$"
+)
+CURRENT_SENSITIVITY_PATTERN = re.compile(r"^([pnuµm]?)A/V$")
+# Number of distinct header sections kept by shared_section().
+MAX_SHARED_SECTIONS = 4096
+
+# Header sections made of several lines, or kept as lists, and the typed values
+# parsed from them.
+HEADER_BLOCKS = (
+    "columns",
+    "user_comment",
+    "scan_config",
+    "slit_info",
+    "motor_positions",
+)
+HEADER_BLOCK_VALUES = {
+    "slit_info": "slit_info_values",
+    "motor_positions": "motor_position_values",
+}
+# Metadata keys of all the header sections shared between files. The LabVIEW
+# Control Panel line ("file") names the file itself, so it is never shared.
+SHARED_SECTIONS = (
+    HEADER_BLOCKS
+    + tuple(HEADER_BLOCK_VALUES.values())
+    + (
+        "amplifier_sensitivities",
+        "amplifier_sensitivity_values",
+        "analog_input_voltages",
+        "mono_info",
+        "id_info",
+        "xia_filter",
+        "xia_shutter_unit",
+    )
+)
+
+# Entries of the Motor Positions and Slit Info header lines, "name: value" or
+# "name = value" with an optional unit, separated by two spaces or more or by
+# semicolons.
+HEADER_ENTRY_SEPARATOR = re.compile(r"\s{2,}|;\s*")
+HEADER_VALUE_PATTERN = re.compile(
+    r"^(?P<name>[^:=]+?)\s*[:=]\s*"
+    r"(?P<value>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?:\s+\S+)?$"
+)
+
+# Preset time of the scalers, per point in its column or else in the scan
+# configuration of the header, and the channels turned into count rates with it.
+PRESET_TIME_COLUMN = "Scaler preset time"
+PRESET_TIME_PATTERN = re.compile(
+    r"preset\s*time\D*?(\d+\.?\d*(?:[eE][-+]?\d+)?)", re.IGNORECASE
+)
+RATE_CHANNELS = ("i0", "itrans", "ifluor", "irefer")
+UNIT_PREFIXES = {"p": 1e-12, "n": 1e-9, "u": 1e-6, "µ": 1e-6, "m": 1e-3, "": 1.0}
+
+# Number of scans whose parsing state is kept by tail_reader().
+MAX_FOLLOWED_SCANS = 32
+_FOLLOWED_SCANS = OrderedDict()
+_FOLLOWED_SCANS_LOCK = threading.Lock()
+
+# Files known to be empty, header-only or malformed, skipped until they change.
+# Only kept in memory unless a tree snapshot is kept, see tree_snapshot().
+NEGATIVE_CACHE = NegativeCache()
+
+# Snapshots of the trees by file, and the ones saved at exit.
+_TREE_SNAPSHOTS = {}
+_SAVED_AT_EXIT = set()
+_TREE_SNAPSHOTS_LOCK = threading.Lock()
+
+# Parsed frames, within a memory budget. Evicted frames spill to local disk.
+FRAME_STORE = FrameStore()
+
+# Builds of the same node requested concurrently share a single parse.
+NODE_BUILDS = SingleFlight()
+
+# The readers a file can be opened with; each one has its own object cache entry.
+NODE_KINDS = ("raw", "no_device", "complete")
+
+# Progress of the cache warmers, exported with the tiled server metrics.
+WARMUP_FILES = Counter(
+    "aimm_adapters_warmup_files",
+    "Scan files handled by the cache warmers",
+    ["outcome"],
+)
+WARMUP_PENDING = Gauge(
+    "aimm_adapters_warmup_pending_files",
+    "Scan files waiting for the cache warmers",
+    multiprocess_mode="livesum",
+)
+
 
 def mangle_dup_names(names):
     d = defaultdict(int)
@@ -176,29 +320,20 @@ def parse_heald_labview(file, no_device=False):
                     comment_lines.append(line)
                     meta_dict["scan_config"] = comment_lines
                 elif parsing_case == ParsingCase.amplifier:
-                    comment_lines = line.split("  ")
-                    amplifier_dict = {}
-                    for element in comment_lines:
-                        key, value = element.split(": ", 1)
-                        amplifier_dict[key] = value
-                    meta_dict["amplifier_sensitivities"] = amplifier_dict
+                    (
+                        meta_dict["amplifier_sensitivities"],
+                        meta_dict["amplifier_sensitivity_values"],
+                    ) = shared_section(parse_amplifier_section, line)
                 elif parsing_case == ParsingCase.analog:
-                    comment_lines = line.split("  ")
-                    analog_dict = {}
-                    for element in comment_lines:
-                        key, value = element.split(": ", 1)
-                        analog_dict[key] = value
-                    meta_dict["analog_input_voltages"] = analog_dict
+                    meta_dict["analog_input_voltages"] = shared_section(
+                        parse_header_pairs, line, "  "
+                    )
                 elif parsing_case == ParsingCase.mono:
-                    comment_lines = line.split("; ")
-                    mono_dict = {}
-                    for element in comment_lines:
-                        key, value = element.split(": ", 1)
-                        mono_dict[key] = value
-                    meta_dict["mono_info"] = mono_dict
+                    meta_dict["mono_info"] = shared_section(
+                        parse_header_pairs, line, "; "
+                    )
                 elif parsing_case == ParsingCase.id_info:
-                    comment_lines = line.split("  ")
-                    meta_dict["id_info"] = comment_lines
+                    meta_dict["id_info"] = shared_section(split_header_line, line, "  ")
                 elif parsing_case == ParsingCase.slit:
                     comment_lines.append(line)
                     meta_dict["slit_info"] = comment_lines
@@ -206,26 +341,19 @@ def parse_heald_labview(file, no_device=False):
                     comment_lines.append(line)
                     meta_dict["motor_positions"] = comment_lines
                 elif parsing_case == ParsingCase.panel:
-                    comment_lines = line.split("; ")
-                    meta_dict["file"] = comment_lines
+                    meta_dict["file"] = line.split("; ")
                 elif parsing_case == ParsingCase.beamline:
-                    meta_dict["beamline"] = line
+                    meta_dict["beamline"] = sys.intern(line)
                 elif parsing_case == ParsingCase.xia:
                     line = line.replace("OUT", "OUT ")
-                    comment_lines = line.split("  ")
-                    xia_dict = {}
-                    for element in comment_lines:
-                        key, value = element.split(": ", 1)
-                        xia_dict[key] = value
-                    meta_dict["xia_filter"] = xia_dict
+                    meta_dict["xia_filter"] = shared_section(
+                        parse_header_pairs, line, "  "
+                    )
                 elif parsing_case == ParsingCase.shutter:
                     line = line.replace("OUT", "OUT ")
-                    comment_lines = line.split("  ")
-                    shutter_dict = {}
-                    for element in comment_lines:
-                        key, value = element.split(": ", 1)
-                        shutter_dict[key] = value
-                    meta_dict["xia_shutter_unit"] = shutter_dict
+                    meta_dict["xia_shutter_unit"] = shared_section(
+                        parse_header_pairs, line, "  "
+                    )
             else:
                 parsing_case = 0
                 continue
@@ -239,30 +367,547 @@ def parse_heald_labview(file, no_device=False):
     headers = mangle_dup_names(headers)
     df = pd.DataFrame(data, columns=headers)
 
+    # The blocks of several lines are shared once they are complete.
+    for key in HEADER_BLOCKS:
+        if key in meta_dict:
+            meta_dict[key] = shared_section(FrozenList, tuple(meta_dict[key]))
+    for key, values_key in HEADER_BLOCK_VALUES.items():
+        if key in meta_dict:
+            meta_dict[values_key] = shared_section(
+                parse_block_values, tuple(meta_dict[key])
+            )
+
     return df, meta_dict
 
 
+class FrozenDict(dict):
+    """
+    Read-only dict, for the header sections shared between files.
+
+    shared_section() hands out the same instance to every file with an
+    identical section, so changing it in place would change the metadata of all
+    of them. Copies made with dict(), copy.copy() or copy.deepcopy() are plain,
+    mutable dicts.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Shared header sections are read-only, copy them first")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """
+    Read-only list, for the header sections shared between files.
+
+    See FrozenDict. Copies made with list(), copy.copy() or copy.deepcopy() are
+    plain, mutable lists.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Shared header sections are read-only, copy them first")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+@functools.lru_cache(maxsize=MAX_SHARED_SECTIONS)
+def shared_section(parser, *block):
+    # parser(*block), computed once for every distinct raw block of a header
+    # section. Within a beamtime hundreds of files carry identical Mono Info,
+    # ID Info, XIA and amplifier sections, which then share one read-only
+    # object: parsers return FrozenDicts and FrozenLists.
+    return parser(*block)
+
+
+def freeze_section(text):
+    # Read-only copy of a header section serialized to JSON.
+    def freeze(value):
+        if isinstance(value, dict):
+            return FrozenDict((key, freeze(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return FrozenList(freeze(item) for item in value)
+        return value
+
+    return freeze(json.loads(text))
+
+
+def share_sections(metadata):
+    # metadata with its header sections swapped for the shared instances, for
+    # metadata that does not come from parse_heald_labview(), such as the
+    # layouts of a tree snapshot.
+    shared = dict(metadata)
+    for key in SHARED_SECTIONS:
+        if isinstance(shared.get(key), (dict, list)):
+            shared[key] = shared_section(freeze_section, json.dumps(shared[key]))
+    return shared
+
+
+def parse_header_pairs(line, separator):
+    # {key: value} of a header line made of "key: value" entries.
+    return FrozenDict(element.split(": ", 1) for element in line.split(separator))
+
+
+def split_header_line(line, separator):
+    return FrozenList(line.split(separator))
+
+
+def parse_amplifier_section(line):
+    # (texts, typed values) of an Amplifier Sensitivities line, see
+    # parse_amplifier_sensitivities().
+    sensitivities = parse_amplifier_sensitivities(line)
+    texts = FrozenDict((key, text) for key, text, _, _ in sensitivities)
+    values = FrozenDict(
+        (key, FrozenDict(value=value, unit=unit))
+        for key, _, value, unit in sensitivities
+    )
+    return texts, values
+
+
+def parse_block_values(lines):
+    # {name: value} of the numeric entries of the lines of a Motor Positions or
+    # Slit Info block.
+    return FrozenDict(pair for line in lines for pair in parse_header_values(line))
+
+
+def parse_amplifier_sensitivities(line):
+    # (name, text, value, unit) of every sensitivity of an "Amplifier
+    # Sensitivities:" header line. value is a float, or None with the whole text
+    # as unit when the text does not start with a number.
+    sensitivities = []
+    for element in line.split("  "):
+        key, text = element.split(": ", 1)
+        match = SENSITIVITY_PATTERN.match(text)
+        if match is None:
+            sensitivities.append((key, text, None, text.strip()))
+        else:
+            sensitivities.append((key, text, float(match[1]), match[2]))
+    return tuple(sensitivities)
+
+
+def parse_header_values(line):
+    # (name, value) pairs of the numeric entries of a Motor Positions or Slit
+    # Info header line, e.g. "sample_x: 12.30 mm  sample_y: 4.5". Entries
+    # without a number are left out.
+    values = []
+    for entry in HEADER_ENTRY_SEPARATOR.split(line.strip()):
+        match = HEADER_VALUE_PATTERN.match(entry)
+        if match is not None:
+            values.append((match["name"], float(match["value"])))
+    return tuple(values)
+
+
+def sensitivity_scale(value, unit):
+    # Sensitivity in A/V, or None if it is not a current sensitivity.
+    match = CURRENT_SENSITIVITY_PATTERN.match(unit or "")
+    if value is None or match is None:
+        return None
+    return value * UNIT_PREFIXES[match[1]]
+
+
+def channel_gains(changed_columns, metadata):
+    # {normalized channel: sensitivity in A/V} for the channels whose counter
+    # column has a current sensitivity in the header. changed_columns maps the
+    # channels to the counter columns, as returned by normalize_dataframe().
+    sensitivities = metadata.get("amplifier_sensitivity_values", {})
+    gains = {}
+    for channel, column in changed_columns.items():
+        if column in sensitivities:
+            scale = sensitivity_scale(**sensitivities[column])
+            if scale is not None:
+                gains[channel] = scale
+    return gains
+
+
+def preset_times(df, metadata):
+    # (preset time of every point, source) of a raw frame. The source is
+    # "column" for the "Scaler preset time" column, or "header" for a preset
+    # time found in the scan configuration. (None, None) without either.
+    if PRESET_TIME_COLUMN in df:
+        return df[PRESET_TIME_COLUMN].to_numpy(dtype=float), "column"
+    for line in metadata.get("scan_config", []):
+        match = PRESET_TIME_PATTERN.search(line)
+        if match is not None:
+            return np.full(len(df), float(match[1])), "header"
+    return None, None
+
+
+def with_count_rates(df, preset_time):
+    # The normalized frame with a "<channel>_rate" column of counts per second
+    # for each of its RATE_CHANNELS, from the preset time of every point. Points
+    # with a non-positive preset time get NaN.
+    channels = [channel for channel in RATE_CHANNELS if channel in df]
+    if not channels:
+        return df, []
+    preset_time = np.asarray(preset_time, dtype=float)[:, np.newaxis]
+    counts = df[channels].to_numpy(dtype=float)
+    rates = np.divide(
+        counts,
+        preset_time,
+        out=np.full(counts.shape, np.nan),
+        where=preset_time > 0,
+    )
+    columns = [f"{channel}_rate" for channel in channels]
+    df[columns] = rates
+    return df, columns
+
+
 def find_char_indexes(word, char):
     return [i for i, val in enumerate(word) if val == char]
 
 
+def frame_key(filepath, kind, stat):
+    # Identifies one parsed frame of filepath in FRAME_STORE. The size and mtime
+    # make the frames of older versions of the file unreachable.
+    return (os.path.abspath(filepath), kind, stat.st_size, stat.st_mtime_ns)
+
+
+def read_frame(filepath, no_device=False):
+    # Parses filepath again, when its frame is gone from FRAME_STORE.
+    with open(filepath) as file:
+        df, _ = parse_heald_labview(file, no_device)
+    return df
+
+
+class StoredFrameAdapter(DataFrameAdapter):
+    """
+    DataFrameAdapter whose frame is held by FRAME_STORE instead of the node.
+
+    The structure of the frame is kept in the node, so that the tree can be
+    browsed without the data. Reading fetches the frame from the store, which
+    may load it back from its spill file, or rebuilds it with loader().
+
+    Parameters
+    ----------
+    key : tuple
+        Key of the frame in FRAME_STORE, see frame_key().
+    loader : callable
+        Returns the frame when the store does not have it anymore.
+    df : pandas.DataFrame
+        The frame, which is put in the store.
+    metadata : dict, optional
+    specs : List[str], optional
+    """
+
+    def __init__(self, key, loader, df, *, metadata=None, specs=None):
+        # Same structure as DataFrameAdapter.from_pandas(df, npartitions=1).
+        super().__init__(
+            [None],
+            df.iloc[:0],
+            (df.index[0], df.index[-1]),
+            metadata=metadata,
+            specs=specs,
+        )
+        self._key = key
+        self._loader = loader
+        FRAME_STORE.put(key, df)
+
+    @property
+    def key(self):
+        # Key of the frame in FRAME_STORE.
+        return self._key
+
+    def _frame(self):
+        df = FRAME_STORE.get(self._key)
+        if df is None:
+            df = self._loader()
+            FRAME_STORE.put(self._key, df)
+        return df
+
+    def read(self, fields=None):
+        df = self._frame()
+        if fields is not None:
+            df = df[fields]
+        return df
+
+    def read_partition(self, partition, fields=None):
+        if partition != 0:
+            raise IndexError(partition)
+        return self.read(fields)
+
+
+class SnapshotFrameAdapter(DataFrameAdapter):
+    """
+    Node of a scan file restored from a tree snapshot.
+
+    The structure and metadata come from the layout recorded in the snapshot, so
+    the file is only parsed once its data is read, by building the actual node.
+
+    Parameters
+    ----------
+    layout : dict
+        See node_layout().
+    build : callable
+        Returns the actual node of the file.
+    """
+
+    def __init__(self, layout, build):
+        # The parsed frames all have a RangeIndex.
+        meta = pd.DataFrame(
+            {i: pd.Series(dtype=dtype) for i, dtype in enumerate(layout["dtypes"])},
+            index=pd.RangeIndex(0),
+        )
+        meta.columns = layout["columns"]
+        super().__init__(
+            [None],
+            meta,
+            tuple(layout["divisions"]),
+            metadata=share_sections(layout["metadata"]),
+            specs=layout["specs"],
+        )
+        self._build = build
+        self._lock = threading.Lock()
+        self._node = None
+
+    def _built(self):
+        with self._lock:
+            if self._node is None:
+                self._node = self._build()
+            return self._node
+
+    def read(self, fields=None):
+        node = self._built()
+        if node is None:
+            # The file lost its data since the snapshot; the tree refresh will
+            # drop this node.
+            return self._meta if fields is None else self._meta[fields]
+        return node.read(fields)
+
+    def read_partition(self, partition, fields=None):
+        node = self._built()
+        if node is None:
+            return self.read(fields)
+        return node.read_partition(partition, fields)
+
+
+def node_layout(node):
+    # JSON description of a dataframe node, from which SnapshotFrameAdapter can
+    # serve its structure and metadata. None if the node cannot be described.
+    if not isinstance(node, DataFrameAdapter):
+        return None
+    layout = {
+        "columns": list(node._meta.columns),
+        "dtypes": [str(dtype) for dtype in node._meta.dtypes],
+        "divisions": [
+            value.item() if hasattr(value, "item") else value
+            for value in node._divisions
+        ],
+        "metadata": dict(node.metadata),
+        "specs": list(node.specs),
+    }
+    try:
+        json.dumps(layout)
+    except (TypeError, ValueError):
+        return None
+    return layout
+
+
 def build_reader(filepath, no_device=False):
     with open(filepath) as file:
+        key = frame_key(filepath, ("raw", no_device), os.fstat(file.fileno()))
         df, metadata = parse_heald_labview(file, no_device)
         if df.empty:
             return None
-    return DataFrameAdapter.from_pandas(df, metadata=metadata, npartitions=1)
+    loader = functools.partial(read_frame, filepath, no_device)
+    return StoredFrameAdapter(key, loader, df, metadata=metadata)
+
+
+class LabViewTail:
+    """
+    Incremental parser for a LabVIEW scan that may still be growing.
+
+    The first update() parses the file from the top. Later calls only parse the
+    data rows appended since the last byte offset, with the column layout found
+    the first time, and append them to the frame parsed so far. The file is
+    parsed from the top again when it is replaced or truncated, or when new
+    header lines show up.
+
+    The frames are kept in FRAME_STORE, within its memory budget; the tail only
+    holds the byte offset, the column layout and the header metadata. When the
+    store has evicted the frame, the file is parsed from the top again.
+
+    Rows are committed once their line is terminated. An unterminated last row
+    is returned as well when it has a value for every column, but it is read
+    again on the next update in case it was still being written.
+
+    Parameters
+    ----------
+    filepath : str or Path
+    no_device : bool, optional
+        Passed to parse_heald_labview().
+    """
+
+    def __init__(self, filepath, no_device=False):
+        self._filepath = Path(filepath)
+        self._no_device = no_device
+        self._lock = threading.Lock()
+        self._file_id = None
+        self._signature = None
+        self._stat = None
+        self._offset = 0
+        # Columns of the file, or None when it is to be parsed from the top.
+        self._columns = None
+        # Committed rows of the frame stored under _key.
+        self._rows = 0
+        self._key = None
+        self._metadata = {}
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def stat(self):
+        # File status when the frame was last brought up to date.
+        return self._stat
+
+    @property
+    def key(self):
+        # Key of the last frame in FRAME_STORE, see frame_key().
+        return self._key
+
+    def update(self):
+        # Returns the (dataframe, metadata) pair of everything written so far.
+        with self._lock:
+            stat = os.stat(self._filepath)
+            if (stat.st_mtime_ns, stat.st_size) == self._signature:
+                df = FRAME_STORE.get(self._key)
+                if df is not None:
+                    return df, self._metadata
+                self._columns = None
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id != self._file_id or stat.st_size < self._offset:
+                self._columns = None
+            self._file_id = file_id
+            try:
+                df = self._read()
+            except Exception:
+                # Parse the file from the top on the next update.
+                self._columns = self._signature = None
+                raise
+            self._signature = (stat.st_mtime_ns, stat.st_size)
+            self._stat = stat
+            self._key = frame_key(self._filepath, ("raw", self._no_device), stat)
+            FRAME_STORE.put(self._key, df)
+            return df, self._metadata
+
+    def _committed(self):
+        # The committed rows parsed so far, or None if the file is to be parsed
+        # from the top: it has no complete column layout yet, or its frame is
+        # gone from FRAME_STORE.
+        if not self._columns:
+            return None
+        df = FRAME_STORE.get(self._key)
+        return None if df is None else df.iloc[: self._rows]
+
+    def _read(self):
+        df = self._committed()
+        with open(self._filepath, "rb") as file:
+            if df is not None:
+                file.seek(self._offset)
+            chunk = file.read()
+        end = chunk.rfind(b"\n") + 1
+        text = chunk[:end].decode()
+        lines = text.splitlines()
+        pending_line = chunk[end:].decode()
+
+        if df is None:
+            self._offset = 0
+            df, self._metadata = parse_heald_labview(io.StringIO(text), self._no_device)
+            self._columns = list(df.columns)
+        elif any(line.startswith("#") for line in lines):
+            self._columns = None
+            return self._read()
+        elif lines:
+            df = self._append_rows(df, lines)
+        self._offset += end
+        self._rows = len(df)
+
+        if pending_line.strip() and not pending_line.startswith("#"):
+            if len(pending_line.split()) == len(df.columns):
+                try:
+                    return self._append_rows(df, [pending_line])
+                except ValueError:
+                    # The last value is still being written.
+                    pass
+        return df
+
+    @staticmethod
+    def _append_rows(df, lines):
+        rows = [list(map(float, line.split())) for line in lines if line.strip()]
+        if not rows:
+            return df
+        appended = pd.DataFrame(rows, columns=df.columns)
+        return pd.concat([df, appended], ignore_index=True)
+
+
+def tail_reader(filepath, no_device=False):
+    # Same as build_reader(), but the LabViewTail of the most recently read scans
+    # is kept so that a scan still being written is parsed from where it stopped.
+    key = (Path(filepath), no_device)
+    with _FOLLOWED_SCANS_LOCK:
+        tail = _FOLLOWED_SCANS.pop(key, None)
+        if tail is None:
+            tail = LabViewTail(filepath, no_device)
+        _FOLLOWED_SCANS[key] = tail
+        while len(_FOLLOWED_SCANS) > MAX_FOLLOWED_SCANS:
+            _FOLLOWED_SCANS.popitem(last=False)
+    df, metadata = tail.update()
+    if df.empty:
+        return None
+    key = tail.key
+    loader = functools.partial(read_frame, filepath, no_device)
+    return StoredFrameAdapter(key, loader, df, metadata=metadata)
+
+
+def read_normalized_frame(filepath, mask_glitches=False, scale_gains=False):
+    # Normalizes filepath again, when its normalized frame is gone from FRAME_STORE.
+    with open(filepath) as file:
+        df, metadata = parse_heald_labview(file, no_device=True)
+    norm_df, changed_columns = normalize_dataframe(df)
+    gains = channel_gains(changed_columns, metadata) if scale_gains else None
+    preset_time, _ = preset_times(df, metadata)
+    norm_df, _ = process_normalized_frame(norm_df, mask_glitches, gains, preset_time)
+    return norm_df
+
+
+def read_complete_frame(filepath, no_device=False):
+    # Parses filepath again, when its standardized frame is gone from FRAME_STORE.
+    df = read_frame(filepath, no_device)
+    std_df, _ = normalize_dataframe(df, standardize=True)
+    return df if std_df is None else std_df
 
 
 def complete_build_reader(filepath, no_device=False):
     with open(filepath) as file:
+        key = frame_key(filepath, ("complete", no_device), os.fstat(file.fileno()))
         df, metadata = parse_heald_labview(file, no_device)
         if df.empty:
             return None
 
+        loader = functools.partial(read_complete_frame, filepath, no_device)
         std_df, changed_columns = normalize_dataframe(df, standardize=True)
         if std_df is None:
-            return DataFrameAdapter.from_pandas(df, metadata=metadata, npartitions=1)
+            return StoredFrameAdapter(key, loader, df, metadata=metadata)
         else:
             metadata["columns"] = list(std_df.columns)
             element_name, edge_symbol = parse_element_name(filepath, std_df, metadata)
@@ -273,7 +918,7 @@ def complete_build_reader(filepath, no_device=False):
             }
             metadata["translation"] = changed_columns
 
-        return DataFrameAdapter.from_pandas(std_df, metadata=metadata, npartitions=1)
+        return StoredFrameAdapter(key, loader, std_df, metadata=metadata)
 
 
 def is_candidate(filename):
@@ -281,56 +926,86 @@ def is_candidate(filename):
     return filename_ext[-1].isnumeric()
 
 
+ScanFile = namedtuple("ScanFile", ["dirpath", "stem", "suffix", "stat"])
+
+
+def scan_directory(path):
+    # Lists a single directory with one os.scandir() call and splits its visible
+    # entries into subdirectories and LabVIEW scan files (numeric suffix), given
+    # as (entry, stem, suffix) triples, both sorted by name. The entry type
+    # comes from the cached DirEntry information, so no stat() call is made per
+    # entry.
+    subdirectories = []
+    scan_entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                # Skip hidden files.
+                continue
+            if entry.is_dir():
+                subdirectories.append(entry)
+                continue
+            stem, suffix = os.path.splitext(entry.name)
+            if suffix[1:].isnumeric() and entry.is_file():
+                scan_entries.append((entry, stem, suffix))
+    # os.scandir() order depends on the filesystem.
+    subdirectories.sort(key=lambda entry: entry.name)
+    scan_entries.sort(key=lambda item: item[0].name)
+    return subdirectories, scan_entries
+
+
+def walk_scan_files(path, stat=True):
+    # Generator shared by all the directory traversals. Yields one ScanFile
+    # (dirpath, stem, suffix, stat) per LabVIEW scan file found below path.
+    # The suffix keeps its leading dot, so dirpath / (stem + suffix) is the file.
+    # The files of a directory come first, by name, then its subdirectories, by
+    # name. Directory listings are not materialized as Path objects.
+    # Pass stat=False to skip the stat() call when the file status is not needed.
+    pending = [Path(path)]
+    while pending:
+        dirpath = pending.pop()
+        subdirectories, scan_entries = scan_directory(dirpath)
+        for entry, stem, suffix in scan_entries:
+            yield ScanFile(dirpath, stem, suffix, entry.stat() if stat else None)
+        pending.extend(Path(entry.path) for entry in reversed(subdirectories))
+
+
+def _subdirectory_mapping(nodes, dirpath):
+    # Returns the mapping of the tree node for dirpath, creating the intermediate
+    # subdirectory nodes on first use. Directories without scan files therefore
+    # never show up in the tree.
+    if dirpath not in nodes:
+        sub_mapping = {}
+        parent_mapping = _subdirectory_mapping(nodes, dirpath.parent)
+        parent_mapping[dirpath.name] = MapAdapter(sub_mapping)
+        nodes[dirpath] = sub_mapping
+    return nodes[dirpath]
+
+
 def iter_subdirectory(mapping, path, normalize=False):
+    nodes = {Path(path): mapping}
     experiment_group = {}
-    filepaths = sorted(path.iterdir())
-    for i in range(len(filepaths)):
-        if filepaths[i].name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepaths[i].is_file():
-            # Explore subfolder for more labview files recursively
-            sub_mapping = {}
-            sub_mapping = iter_subdirectory(sub_mapping, filepaths[i], normalize)
-            if sub_mapping:
-                mapping[filepaths[i].name] = MapAdapter(sub_mapping)
-            continue
-        if filepaths[i].suffix[1:].isnumeric():
-            if filepaths[i].stem not in experiment_group:
-                experiment_group[filepaths[i].stem] = {}
-                if not normalize:
-                    mapping[filepaths[i].stem] = MapAdapter(
-                        experiment_group[filepaths[i].stem]
-                    )
-            if normalize:
-                norm_node = NormalizedReader(filepaths[i])
-                if not norm_node.is_empty():
-                    experiment_group[filepaths[i].stem][
-                        filepaths[i].name
-                    ] = norm_node.read()
-            else:
-                cache_key = (Path(__file__).stem, filepaths[i])
-                end_node = with_object_cache(cache_key, build_reader, filepaths[i])
-                if end_node is not None:
-                    experiment_group[filepaths[i].stem][filepaths[i].name] = end_node
-
-        # For a normalized tree, experiments files are grouped, filtered and saved
-        # temporarily. Once all files of one experiment are read, it checks if there
-        # are remaining files that passed the filtering phase. The result is saved in
-        # the main tree. This avoids the generation of empty nodes in the final version
-        # of the tree.
-        if normalize:
-            if filepaths[i].stem in experiment_group:
-                if i == len(filepaths) - 1:
-                    if len(experiment_group[filepaths[i].stem]) != 0:
-                        mapping[filepaths[i].stem] = MapAdapter(
-                            experiment_group[filepaths[i].stem]
-                        )
-                elif filepaths[i].stem != filepaths[i + 1].stem:
-                    if len(experiment_group[filepaths[i].stem]) != 0:
-                        mapping[filepaths[i].stem] = MapAdapter(
-                            experiment_group[filepaths[i].stem]
-                        )
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        filepath = dirpath / (stem + suffix)
+        group_key = (dirpath, stem)
+        if group_key not in experiment_group:
+            experiment_group[group_key] = {}
+            if not normalize:
+                _subdirectory_mapping(nodes, dirpath)[stem] = MapAdapter(
+                    experiment_group[group_key]
+                )
+        end_node = normalized_node(filepath) if normalize else raw_node(filepath)
+        if end_node is not None:
+            experiment_group[group_key][filepath.name] = end_node
+
+    # For a normalized tree, experiments files are grouped, filtered and saved
+    # temporarily. Once all files are read, only the experiments with remaining
+    # files that passed the filtering phase are saved in the main tree. This avoids
+    # the generation of empty nodes in the final version of the tree.
+    if normalize:
+        for (dirpath, stem), group in experiment_group.items():
+            if len(group) != 0:
+                _subdirectory_mapping(nodes, dirpath)[stem] = MapAdapter(group)
 
     return mapping
 
@@ -338,54 +1013,1053 @@ def iter_subdirectory(mapping, path, normalize=False):
 def complete_tree_iter_subdirectory(mapping, path):
     # This method takes the two strategies implemented in iter_subdirectory() but it creates one single
     # tree instead with the information of both versions when it is available.
+    nodes = {Path(path): mapping}
     experiment_group = {}
-    filepaths = sorted(path.iterdir())
-    for i in range(len(filepaths)):
-        if filepaths[i].name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepaths[i].is_file():
-            # Explore subfolder for more labview files recursively
-            sub_mapping = {}
-            sub_mapping = complete_tree_iter_subdirectory(sub_mapping, filepaths[i])
-            if sub_mapping:
-                mapping[filepaths[i].name] = MapAdapter(sub_mapping)
-            continue
-        if filepaths[i].suffix[1:].isnumeric():
-            if filepaths[i].stem not in experiment_group:
-                experiment_group[filepaths[i].stem] = {}
-                mapping[filepaths[i].stem] = MapAdapter(
-                    experiment_group[filepaths[i].stem]
-                )
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        filepath = dirpath / (stem + suffix)
+        group_key = (dirpath, stem)
+        if group_key not in experiment_group:
+            experiment_group[group_key] = {}
+            _subdirectory_mapping(nodes, dirpath)[stem] = MapAdapter(
+                experiment_group[group_key]
+            )
 
-            cache_key = (Path(__file__).stem, filepaths[i])
-            end_node = with_object_cache(cache_key, complete_build_reader, filepaths[i])
-            if end_node is not None:
-                experiment_group[filepaths[i].stem][filepaths[i].name] = end_node
+        end_node = complete_node(filepath)
+        if end_node is not None:
+            experiment_group[group_key][filepath.name] = end_node
 
     return mapping
 
 
-def subdirectory_handler(path):
-    mapping = {}
-    heald_tree = MapAdapter(mapping)
-    mapping = iter_subdirectory(mapping, path)
-    return heald_tree
+def read_or_skip(filepath, kind, factory, *args, **kwargs):
+    # Calls factory(*args, **kwargs) to build the node of filepath, unless the
+    # negative cache knows that the file gives no node of this kind. Files that
+    # come out empty or cannot be parsed are added to the negative cache with
+    # the reason.
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    if NEGATIVE_CACHE.reason(filepath, stat, kind) is not None:
+        return None
+    try:
+        node = factory(*args, **kwargs)
+    except (IndexError, KeyError, ValueError) as err:
+        reason = f"malformed: {type(err).__name__}: {err}"
+        NEGATIVE_CACHE.add(filepath, reason, stat, kind)
+        return None
+    if node is None:
+        reason = "empty" if stat.st_size == 0 else "header-only"
+        NEGATIVE_CACHE.add(filepath, reason, stat, kind)
+    return node
+
+
+def snapshot_node(snapshot, filepath, factory, *args, **kwargs):
+    # Builds the node of filepath with factory(*args, **kwargs), unless the
+    # snapshot has the layout of the file as it is now. In that case the node is
+    # served from the layout and the file is not parsed until it is read. Files
+    # that give no node are recorded with a False layout.
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    layout = snapshot.layout(filepath, stat)
+    if layout is False:
+        return None
+    if layout is not None:
+        return SnapshotFrameAdapter(layout, functools.partial(factory, *args, **kwargs))
+    node = factory(*args, **kwargs)
+    snapshot.set_layout(filepath, stat, False if node is None else node_layout(node))
+    return node
+
+
+def tree_snapshot(path, kind, directory=None):
+    # Persisted snapshot of the tree of the given kind served from path, kept in
+    # directory, by default the "snapshots" directory of CACHE_DIRECTORY. Calls
+    # for the same file share one snapshot, which is saved at exit. The negative
+    # cache is persisted in the same directory, so that the skipped files stay
+    # skipped after a restart too.
+    if directory is None:
+        directory = CACHE_DIRECTORY / "snapshots"
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    filename = Path(directory, f"{kind}-{digest}.json").absolute()
+    with _TREE_SNAPSHOTS_LOCK:
+        snapshot = _TREE_SNAPSHOTS.get(filename)
+        if snapshot is None:
+            snapshot = _TREE_SNAPSHOTS[filename] = TreeSnapshot(filename)
+        negative_cache = Path(directory, "negative_cache.json").absolute()
+        if NEGATIVE_CACHE.filename != negative_cache:
+            NEGATIVE_CACHE.persist(negative_cache)
+    save_at_exit(snapshot)
+    return snapshot
+
+
+def handler_snapshot(path, kind, snapshot):
+    # The snapshot option of the handlers: False, True to keep the snapshot in
+    # CACHE_DIRECTORY, or the directory to keep it in.
+    if not snapshot:
+        return None
+    return tree_snapshot(path, kind, None if snapshot is True else snapshot)
+
+
+def save_at_exit(snapshot):
+    # Registers snapshot.save() to run at exit, once per snapshot.
+    with _TREE_SNAPSHOTS_LOCK:
+        if snapshot in _SAVED_AT_EXIT:
+            return
+        _SAVED_AT_EXIT.add(snapshot)
+    atexit.register(snapshot.save)
+
+
+def node_cache_key(filepath, kind):
+    return (Path(__file__).stem, filepath, kind)
+
+
+def cached_node(filepath, kind, factory, *args, **kwargs):
+    # with_object_cache() runs the factory for every request that misses the
+    # cache, so requests arriving together for a file not parsed yet would each
+    # parse it. Under NODE_BUILDS, the first one parses and the others wait for
+    # its node.
+    cache_key = node_cache_key(filepath, kind)
+    return NODE_BUILDS.do(
+        cache_key, with_object_cache, cache_key, factory, *args, **kwargs
+    )
+
+
+def raw_node(filepath):
+    return read_or_skip(
+        filepath, "raw", cached_node, filepath, "raw", tail_reader, filepath
+    )
+
+
+def normalized_node(filepath, mask_glitches=False, scale_gains=False):
+    def unnormalized_reader():
+        norm_node = NormalizedReader(filepath, mask_glitches, scale_gains)
+        return None if norm_node.is_empty() else norm_node
+
+    norm_node = read_or_skip(filepath, "normalized", unnormalized_reader)
+    if norm_node is None:
+        return None
+    return norm_node.read()
+
+
+def complete_node(filepath):
+    return read_or_skip(
+        filepath,
+        "complete",
+        cached_node,
+        filepath,
+        "complete",
+        complete_build_reader,
+        filepath,
+    )
+
+
+def discard_cached_node(filepath):
+    # Removes the nodes of one file from the tiled object cache, if any, so that
+    # the next access parses the file again.
+    cache = get_object_cache()
+    if cache is not NO_CACHE:
+        for kind in NODE_KINDS:
+            cache.discard(node_cache_key(filepath, kind))
+
+
+def stat_signature(filepath):
+    # Cheap fingerprint used to tell whether a file changed since it was parsed.
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RequestActivity:
+    # Time of the last access to a lazy tree made for a live request. Threads
+    # that set warming.active, like those of CacheWarmer, are not counted.
+
+    def __init__(self):
+        self.last_request = float("-inf")
+        self.warming = threading.local()
+
+    def touch(self):
+        if not getattr(self.warming, "active", False):
+            self.last_request = time.monotonic()
+
+    def idle_for(self):
+        return time.monotonic() - self.last_request
+
+
+LIVE_REQUESTS = RequestActivity()
+
+
+def _mark_background_thread():
+    LIVE_REQUESTS.warming.active = True
+
+
+PREFETCH_POOL = ThreadPoolExecutor(
+    max_workers=PREFETCH_WORKERS,
+    thread_name_prefix="aimm-prefetch",
+    initializer=_mark_background_thread,
+)
+
+
+def scan_number(filename):
+    # Numeric suffix of a scan file, which orders the scans of a group.
+    return int(os.path.splitext(filename)[1][1:])
+
+
+def scan_order(filename):
+    # Sort key of the scans of a group: Cu.2 comes before Cu.10.
+    return scan_number(filename), filename
+
+
+def sweep_index(energy, min_steps=MIN_SWEEP_STEPS):
+    # Sweep of every point of a scan whose energy goes up and down several times
+    # in one data block. A new sweep starts after every change of direction of
+    # the energy that lasts at least min_steps steps, and the turning point ends
+    # the previous sweep. Repeated energies keep the current direction.
+    energy = np.asarray(energy, dtype=float)
+    index = np.zeros(len(energy), dtype=int)
+    direction = np.sign(np.diff(energy))
+    moving = np.flatnonzero(direction)
+    if not len(moving):
+        return index
+    # Zero steps take the direction of the step before them, or after them at
+    # the start of the scan.
+    last_move = np.maximum.accumulate(
+        np.where(direction != 0, np.arange(len(direction)), 0)
+    )
+    direction = direction[last_move]
+    direction[: moving[0]] = direction[moving[0]]
+
+    # Runs of steps in one direction. The short ones take the direction of the
+    # last long run, or of the first one at the start of the scan, so that the
+    # backlash of the first steps is not a sweep of its own. Without any long
+    # run, the longest one sets the direction.
+    starts = np.flatnonzero(np.diff(direction)) + 1
+    starts = np.concatenate([[0], starts])
+    lengths = np.diff(np.append(starts, len(direction)))
+    long_runs = lengths >= min_steps
+    if not long_runs.any():
+        long_runs[np.argmax(lengths)] = True
+    first_long = np.argmax(long_runs)
+    last_long = np.maximum.accumulate(
+        np.where(long_runs, np.arange(len(starts)), first_long)
+    )
+    direction = np.repeat(direction[starts][last_long], lengths)
+
+    index[np.flatnonzero(np.diff(direction)) + 2] = 1
+    return np.cumsum(index)
+
+
+def split_sweeps(frame, column="sweep"):
+    # The sweeps of a frame with a sweep index column, as views of the frame in
+    # their order. Frames without the column are a single sweep.
+    if column not in frame or len(frame) == 0:
+        return [frame]
+    starts = np.flatnonzero(np.diff(frame[column].to_numpy())) + 1
+    bounds = np.concatenate([[0], starts, [len(frame)]])
+    return [frame.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def stack_scans(frames):
+    # Long-form table of the scans of a group, from a {scan number: frame}
+    # dictionary. There is one row per point of every scan, led by "scan" and
+    # "point" columns. Columns missing from a scan are filled with NaN.
+    return pd.concat(frames, names=["scan", "point"]).reset_index()
+
+
+class LazyDirectoryMapping(collections.abc.Mapping):
+    """
+    Mapping over the content of one directory of the archive.
+
+    The directory is listed on first access and the listing is cached until the
+    directory mtime changes. Subdirectories map to nested lazy containers and
+    experiment groups to LazyExperimentMapping, so no file is parsed until one
+    of its scans is requested.
+
+    Parameters
+    ----------
+    path : str or Path
+    node_factory : callable
+        Builds the adapter of one scan file from its path, or returns None to
+        leave the file out of the tree.
+    snapshot : TreeSnapshot, optional
+        Where listings and node layouts are looked up before listing the
+        directory or parsing a file, and recorded after.
+    prefetch_depth : int, optional
+        Number of following scans of a group built in the background when one
+        scan is requested. 0 disables the prefetch.
+    stacked : bool, optional
+        Whether the experiment groups have a STACKED_KEY node with all their
+        scans.
+    merged : bool, optional
+        Whether the experiment groups whose scans have an "energy" column have
+        a MERGED_KEY node with their average, see merge_scans().
+    """
+
+    def __init__(
+        self,
+        path,
+        node_factory,
+        snapshot=None,
+        prefetch_depth=0,
+        stacked=False,
+        merged=False,
+    ):
+        self._path = Path(path)
+        self._node_factory = node_factory
+        self._snapshot = snapshot
+        self.prefetch_depth = prefetch_depth
+        self.stacked = stacked
+        self.merged = merged
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._groups = {}
+        # Maps each child name to a (lazy mapping, adapter) pair.
+        self._children = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def _listing(self):
+        try:
+            mtime = os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime is None:
+                removed = list(self._children.values())
+                self._groups, self._children = {}, {}
+            elif mtime != self._mtime:
+                removed = self._update_listing(mtime)
+            else:
+                removed = []
+            self._mtime = mtime
+            groups, children = self._groups, self._children
+        for mapping, _ in removed:
+            mapping.evict()
+        return groups, children
+
+    def _update_listing(self, mtime):
+        # Children that survive a relisting are reused so that their own cached
+        # listings and nodes are kept. Returns the children that were dropped.
+        listing = None
+        if self._snapshot is not None:
+            listing = self._snapshot.listing(self._path, mtime)
+        if listing is None:
+            subdirectories, scan_entries = scan_directory(self._path)
+            groups = defaultdict(list)
+            for entry, stem, _ in scan_entries:
+                groups[stem].append(entry.name)
+            listing = (
+                [entry.name for entry in subdirectories],
+                {stem: sorted(names, key=scan_order) for stem, names in groups.items()},
+            )
+            if self._snapshot is not None:
+                self._snapshot.set_listing(self._path, mtime, *listing)
+        subdirectories, groups = listing
+        # Snapshots written by older versions have the scans in name order.
+        groups = {stem: sorted(names, key=scan_order) for stem, names in groups.items()}
+        children = {}
+        for name in subdirectories:
+            child = self._children.get(name)
+            if child is None or not isinstance(child[0], LazyDirectoryMapping):
+                mapping = LazyDirectoryMapping(
+                    self._path / name,
+                    self._node_factory,
+                    self._snapshot,
+                    self.prefetch_depth,
+                    self.stacked,
+                    self.merged,
+                )
+                child = (mapping, MapAdapter(mapping))
+            children[name] = child
+        for stem in groups:
+            child = self._children.get(stem)
+            if child is None or not isinstance(child[0], LazyExperimentMapping):
+                mapping = LazyExperimentMapping(self, stem)
+                child = (mapping, MapAdapter(mapping))
+            children[stem] = child
+        removed = [
+            child
+            for key, child in self._children.items()
+            if children.get(key) is not child
+        ]
+        self._groups = groups
+        # Subdirectories and groups listed together by name, as in iter_subdirectory().
+        self._children = dict(sorted(children.items()))
+        return removed
+
+    def group_filenames(self, stem):
+        groups, _ = self._listing()
+        return groups.get(stem, [])
+
+    def build_node(self, filename):
+        filepath = self._path / filename
+        if self._snapshot is None:
+            return self._node_factory(filepath)
+        return snapshot_node(self._snapshot, filepath, self._node_factory, filepath)
+
+    def expanded_directories(self):
+        # Yields this directory and every nested directory that has been listed.
+        with self._lock:
+            if self._mtime is None:
+                return
+            subdirectories = [
+                mapping
+                for mapping, _ in self._children.values()
+                if isinstance(mapping, LazyDirectoryMapping)
+            ]
+        yield self
+        for mapping in subdirectories:
+            yield from mapping.expanded_directories()
+
+    def refresh(self, recursive=True):
+        # Brings the cached listing and nodes up to date with the filesystem.
+        # Only what has already been expanded is checked; new and removed
+        # entries are picked up by relisting, modified files by their group.
+        with self._lock:
+            if self._mtime is None:
+                return
+        _, children = self._listing()
+        for mapping, _ in list(children.values()):
+            if recursive or isinstance(mapping, LazyExperimentMapping):
+                mapping.refresh()
+
+    def evict(self):
+        # Drops every cached listing and node below this directory.
+        with self._lock:
+            children = list(self._children.values())
+            self._mtime = None
+            self._groups, self._children = {}, {}
+        for mapping, _ in children:
+            mapping.evict()
+
+    def child_mapping(self, key):
+        # The lazy mapping of a subdirectory or experiment group.
+        _, children = self._listing()
+        return children[key][0]
+
+    def __getitem__(self, key):
+        LIVE_REQUESTS.touch()
+        _, children = self._listing()
+        return children[key][1]
+
+    def __iter__(self):
+        LIVE_REQUESTS.touch()
+        _, children = self._listing()
+        return iter(list(children))
+
+    def __len__(self):
+        LIVE_REQUESTS.touch()
+        _, children = self._listing()
+        return len(children)
+
+    def __contains__(self, key):
+        LIVE_REQUESTS.touch()
+        _, children = self._listing()
+        return key in children
+
+
+class LazyExperimentMapping(collections.abc.Mapping):
+    """
+    Mapping over the scan files of one experiment group within a directory.
+
+    A file node is built the first time it is requested. Listing the group builds
+    all of its nodes, because files that produce no node (e.g. empty scans) must
+    not be listed. Requesting one scan queues the following ones, in scan number
+    order, to be built and read by PREFETCH_POOL.
+
+    If the directory has stacked set, the group also lists a STACKED_KEY node
+    with the frames of all its scans in one table (see stack_scans()), so that
+    they can be fetched in a single request. Likewise with merged, a MERGED_KEY
+    node has the average of the scans on a common energy grid, listed when the
+    scans have an energy column. Whether they share an energy range is only
+    checked when the node is requested, since it takes reading them: if they do
+    not, the request raises KeyError and the group is listed without it from then
+    on. Both are kept until one of the scans changes.
+
+    Parameters
+    ----------
+    directory : LazyDirectoryMapping
+    stem : str
+        Name of the experiment group.
+    """
+
+    def __init__(self, directory, stem):
+        self._directory = directory
+        self._stem = stem
+        self._lock = threading.Lock()
+        self._nodes = {}
+        self._signatures = {}
+        self._prefetching = set()
+        # Maps STACKED_KEY and MERGED_KEY to the (signatures of the scans, node)
+        # pair of the last node built.
+        self._aggregates = {}
+        # (signatures of the scans, whether they can be merged) of the last check.
+        self._mergeable = (None, False)
+
+    def _node(self, filename):
+        with self._lock:
+            if filename in self._nodes:
+                return self._nodes[filename]
+        filepath = self._directory.path / filename
+        signature = stat_signature(filepath)
+        node = self._directory.build_node(filename)
+        with self._lock:
+            self._signatures.setdefault(filename, signature)
+            return self._nodes.setdefault(filename, node)
+
+    def _discard(self, filename):
+        with self._lock:
+            self._nodes.pop(filename, None)
+            self._signatures.pop(filename, None)
+        discard_cached_node(self._directory.path / filename)
+
+    def _resolved_filenames(self):
+        filenames = self._directory.group_filenames(self._stem)
+        with self._lock:
+            removed = set(self._nodes) - set(filenames)
+        # Forget the nodes of files that have been removed.
+        for filename in removed:
+            self._discard(filename)
+        return [name for name in filenames if self._node(name) is not None]
+
+    def _aggregate_frame(self, key, filenames):
+        frames = {}
+        for name in filenames:
+            node = self._node(name)
+            if node is not None:
+                frames[scan_number(name)] = node.read()
+        if key == STACKED_KEY:
+            return stack_scans(frames)
+        return merge_scans(frames.values())
+
+    def _aggregate_keys(self, filenames):
+        keys = []
+        if filenames and self._directory.stacked:
+            keys.append(STACKED_KEY)
+        # Listing only looks at the structure of the nodes, and at the last
+        # check of _can_merge(), so that the scans are not read.
+        if (
+            filenames
+            and self._directory.merged
+            and all(
+                "energy" in self._node(name).macrostructure().columns
+                for name in filenames
+            )
+            and self._checked_merge(filenames) is not False
+        ):
+            keys.append(MERGED_KEY)
+        return keys
+
+    def _checked_merge(self, filenames):
+        # Result of the last _can_merge() call, or None if the scans changed since.
+        with self._lock:
+            signatures = tuple((name, self._signatures[name]) for name in filenames)
+            if self._mergeable[0] == signatures:
+                return self._mergeable[1]
+        return None
+
+    def _can_merge(self, filenames):
+        mergeable = self._checked_merge(filenames)
+        if mergeable is not None:
+            return mergeable
+        with self._lock:
+            signatures = tuple((name, self._signatures[name]) for name in filenames)
+        frames = [self._node(name).read() for name in filenames]
+        mergeable = can_merge(frames)
+        with self._lock:
+            self._mergeable = (signatures, mergeable)
+        return mergeable
+
+    def _aggregate_node(self, key):
+        filenames = sorted(self._resolved_filenames(), key=scan_number)
+        if key not in self._aggregate_keys(filenames):
+            raise KeyError(key)
+        if key == MERGED_KEY and not self._can_merge(filenames):
+            raise KeyError(key)
+        with self._lock:
+            signatures = tuple((name, self._signatures[name]) for name in filenames)
+            if self._aggregates.get(key, (None,))[0] == signatures:
+                return self._aggregates[key][1]
+        frame_key = (key, str(self._directory.path), self._stem, signatures)
+        node = StoredFrameAdapter(
+            frame_key,
+            functools.partial(self._aggregate_frame, key, filenames),
+            self._aggregate_frame(key, filenames),
+            metadata={"scans": filenames},
+        )
+        with self._lock:
+            self._aggregates[key] = (signatures, node)
+        return node
+
+    def _prefetch_siblings(self, filename):
+        # Scans of a group are usually read one after the other, so the ones
+        # following filename are built before they are requested.
+        depth = self._directory.prefetch_depth
+        if not depth or getattr(LIVE_REQUESTS.warming, "active", False):
+            return
+        number = scan_number(filename)
+        following = sorted(
+            (
+                name
+                for name in self._directory.group_filenames(self._stem)
+                if scan_number(name) > number
+            ),
+            key=scan_number,
+        )[:depth]
+        with self._lock:
+            siblings = [
+                name
+                for name in following
+                if name not in self._nodes and name not in self._prefetching
+            ]
+            self._prefetching.update(siblings)
+        for name in siblings:
+            PREFETCH_POOL.submit(self._prefetch, name)
+
+    def _prefetch(self, filename):
+        try:
+            node = self._node(filename)
+            if node is not None:
+                node.read()
+        except (OSError, ValueError):
+            # The error shows up again if the scan is requested.
+            pass
+        finally:
+            with self._lock:
+                self._prefetching.discard(filename)
+
+    def refresh(self):
+        # Drops the nodes of the files modified since they were built, so that
+        # they are built again on next access.
+        with self._lock:
+            signatures = list(self._signatures.items())
+        for filename, signature in signatures:
+            if stat_signature(self._directory.path / filename) != signature:
+                self._discard(filename)
+
+    def evict(self):
+        with self._lock:
+            filenames = list(self._nodes)
+            self._aggregates = {}
+            self._mergeable = (None, False)
+        for filename in filenames:
+            self._discard(filename)
+
+    def __getitem__(self, key):
+        LIVE_REQUESTS.touch()
+        if key in (STACKED_KEY, MERGED_KEY):
+            return self._aggregate_node(key)
+        if key not in self._directory.group_filenames(self._stem):
+            raise KeyError(key)
+        node = self._node(key)
+        if node is None:
+            raise KeyError(key)
+        self._prefetch_siblings(key)
+        return node
+
+    def _keys(self):
+        filenames = self._resolved_filenames()
+        return filenames + self._aggregate_keys(filenames)
+
+    def __iter__(self):
+        LIVE_REQUESTS.touch()
+        return iter(self._keys())
+
+    def __len__(self):
+        LIVE_REQUESTS.touch()
+        return len(self._keys())
+
+
+class TreeRefresher:
+    """
+    Keeps a lazily expanded tree in sync with the filesystem from a daemon thread.
+
+    Every poll_interval seconds the expanded directories are checked for mtime
+    changes and the built nodes for modified files. On Linux, when the optional
+    inotify_simple package is installed, the thread instead waits for inotify
+    events and only refreshes the directories they come from.
+
+    Parameters
+    ----------
+    root : LazyDirectoryMapping
+    poll_interval : float
+        Seconds between two polls, or the inotify read timeout.
+    use_inotify : bool, optional
+    """
+
+    def __init__(self, root, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        self._root = root
+        self._poll_interval = poll_interval
+        self._inotify = None
+        self._watches = {}
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                import inotify_simple
+            except ImportError:
+                pass
+            else:
+                self._inotify = inotify_simple.INotify()
+                flags = inotify_simple.flags
+                self._watch_flags = (
+                    flags.CREATE
+                    | flags.DELETE
+                    | flags.MODIFY
+                    | flags.CLOSE_WRITE
+                    | flags.MOVED_FROM
+                    | flags.MOVED_TO
+                )
+                self._ignored_flag = flags.IGNORED
+        self._kill_switch = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="aimm-refresh-tree"
+        )
 
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
 
-def normalized_subdirectory_handler(path):
-    mapping = {}
-    heald_tree = MapAdapter(mapping)
-    mapping = iter_subdirectory(mapping, path, normalize=True)
-    return heald_tree
+    def start(self):
+        self._thread.start()
+        return self
 
+    def stop(self):
+        self._kill_switch.set()
+
+    def _add_watches(self):
+        watched = {directory.path for directory in self._watches.values()}
+        for directory in self._root.expanded_directories():
+            if directory.path not in watched:
+                try:
+                    wd = self._inotify.add_watch(directory.path, self._watch_flags)
+                except OSError:
+                    continue
+                self._watches[wd] = directory
+                # Catch up with the changes made before the watch existed.
+                directory.refresh(recursive=False)
+
+    def check(self):
+        # Runs one refresh round, then saves the snapshot of the tree, if any.
+        if self._inotify is None:
+            self._root.refresh()
+        else:
+            self._check_events()
+        if self._root.snapshot is not None:
+            self._root.snapshot.save()
+
+    def _check_events(self):
+        self._add_watches()
+        events = self._inotify.read(timeout=int(self._poll_interval * 1000))
+        changed = set()
+        for event in events:
+            if event.mask & self._ignored_flag:
+                # The watched directory is gone.
+                self._watches.pop(event.wd, None)
+            else:
+                changed.add(event.wd)
+        for wd in changed:
+            if wd in self._watches:
+                self._watches[wd].refresh(recursive=False)
+
+    def _run(self):
+        while not self._kill_switch.is_set():
+            try:
+                self.check()
+            except OSError:
+                # Network mounts come and go; try again on the next round.
+                pass
+            if self._inotify is None:
+                self._kill_switch.wait(self._poll_interval)
+
+
+class CacheWarmer:
+    """
+    Parses the scan files of a lazy tree ahead of their first request.
+
+    The files are listed in priority order and read through the tree by a
+    bounded pool of daemon threads, so their nodes and frames are cached by the
+    time a client asks for them. The workers pause while live requests are
+    being served, and the progress is exported with the tiled server metrics.
+
+    Work starts when the server runs the background task of the tree (see
+    served()), which only happens for the root tree, or after delay seconds.
+
+    Parameters
+    ----------
+    root : LazyDirectoryMapping
+    order : {"newest", "name"}, optional
+        Warm the most recently modified files first, or go by path.
+    subdirectories : list of str, optional
+        Paths relative to the root that are warmed before the rest, in order.
+    workers : int, optional
+        Number of worker threads.
+    idle_time : float, optional
+        Seconds without live requests before a worker takes the next file.
+    delay : float, optional
+        Seconds to wait for the server to start.
+    """
+
+    def __init__(
+        self,
+        root,
+        order="newest",
+        subdirectories=(),
+        workers=2,
+        idle_time=1.0,
+        delay=30,
+    ):
+        if order not in ("newest", "name"):
+            raise ValueError(f"Unknown warm-up order {order!r}")
+        self._root = root
+        self._order = order
+        self._subdirectories = [Path(path) for path in subdirectories]
+        self._workers = workers
+        self._idle_time = idle_time
+        self._delay = delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._served = threading.Event()
+        self._kill_switch = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="aimm-warm-cache"
+        )
+        self._progress = {
+            "total": 0,
+            "warmed": 0,
+            "skipped": 0,
+            "failed": 0,
+            "pauses": 0,
+            "done": False,
+        }
 
-def complete_subdirectory_handler(path):
+    @property
+    def progress(self):
+        with self._lock:
+            progress = dict(self._progress)
+        handled = progress["warmed"] + progress["skipped"] + progress["failed"]
+        progress["pending"] = progress["total"] - handled
+        return progress
+
+    async def served(self):
+        # Background task for the tiled server, which runs it once serving.
+        self._served.set()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._kill_switch.set()
+        self._served.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def prioritized_files(self):
+        # The ScanFile of every file below the root, in warm-up order.
+        files = list(walk_scan_files(self._root.path))
+        if self._order == "newest":
+            files.sort(key=lambda scan: scan.stat.st_mtime_ns, reverse=True)
+        else:
+            files.sort(key=lambda scan: (scan.dirpath, scan.stem, scan.suffix))
+
+        def rank(scan):
+            relative = scan.dirpath.relative_to(self._root.path)
+            for i, subdirectory in enumerate(self._subdirectories):
+                if relative == subdirectory or subdirectory in relative.parents:
+                    return i
+            return len(self._subdirectories)
+
+        # The sort is stable, so the order holds within each rank.
+        files.sort(key=rank)
+        return files
+
+    def _run(self):
+        self._served.wait(self._delay)
+        if self._kill_switch.is_set():
+            return
+        files = self.prioritized_files()
+        for scan in files:
+            self._queue.put(scan)
+        with self._lock:
+            self._progress["total"] = len(files)
+        WARMUP_PENDING.inc(len(files))
+        workers = [
+            threading.Thread(
+                target=self._work, daemon=True, name=f"aimm-warm-cache-{i}"
+            )
+            for i in range(self._workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        with self._lock:
+            self._progress["done"] = True
+
+    def _work(self):
+        LIVE_REQUESTS.warming.active = True
+        while not self._kill_switch.is_set():
+            try:
+                scan = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._wait_for_idle()
+            outcome = self._warm(scan)
+            with self._lock:
+                self._progress[outcome] += 1
+            WARMUP_FILES.labels(outcome).inc()
+            WARMUP_PENDING.dec()
+
+    def _wait_for_idle(self):
+        # Yields to the live requests until none came for idle_time seconds.
+        paused = False
+        while not self._kill_switch.is_set():
+            remaining = self._idle_time - LIVE_REQUESTS.idle_for()
+            if remaining <= 0:
+                return
+            if not paused:
+                paused = True
+                with self._lock:
+                    self._progress["pauses"] += 1
+            self._kill_switch.wait(remaining)
+
+    def _warm(self, scan):
+        # Goes through the tree, so the node is kept by its experiment group.
+        relative = scan.dirpath.relative_to(self._root.path)
+        try:
+            mapping = self._root
+            for name in relative.parts:
+                mapping = mapping.child_mapping(name)
+            node = mapping.child_mapping(scan.stem)[scan.stem + scan.suffix]
+            node.read()
+        except KeyError:
+            # Removed, or gives no node.
+            return "skipped"
+        except (OSError, ValueError):
+            return "failed"
+        return "warmed"
+
+
+def lazy_tree(
+    path,
+    node_factory,
+    poll_interval=None,
+    snapshot=None,
+    warm_up=None,
+    prefetch=DEFAULT_PREFETCH_DEPTH,
+    stacked=False,
+    merged=False,
+):
+    # With poll_interval, in seconds, a TreeRefresher keeps the tree in sync
+    # with the filesystem. warm_up is True or a dict of CacheWarmer options to
+    # parse the files in the background once the tree is served. prefetch,
+    # stacked and merged configure the experiment groups, see
+    # LazyDirectoryMapping.
+    mapping = LazyDirectoryMapping(
+        path, node_factory, snapshot, prefetch, stacked, merged
+    )
+    if snapshot is not None:
+        # Also saved after every refresh round.
+        save_at_exit(snapshot)
+    if poll_interval:
+        TreeRefresher(mapping, poll_interval).start()
+    tree = MapAdapter(mapping)
+    if warm_up:
+        options = {} if warm_up is True else warm_up
+        warmer = CacheWarmer(mapping, **options).start()
+        tree.background_tasks.append(warmer.served)
+    return tree
+
+
+# With snapshot=True, the handlers keep a snapshot of the tree and the negative
+# cache in CACHE_DIRECTORY, or in the directory given as snapshot, so that a
+# restarted server lists and parses again only what changed. By default they
+# start from the filesystem. See lazy_tree() for poll_interval, warm_up and
+# prefetch. With stacked, every experiment group also lists a STACKED_KEY node
+# with all of its scans. With merged, the groups of the normalized and complete
+# trees also list a MERGED_KEY node with the average of their scans.
+
+
+def subdirectory_handler(
+    path,
+    poll_interval=None,
+    snapshot=False,
+    warm_up=None,
+    prefetch=DEFAULT_PREFETCH_DEPTH,
+    stacked=False,
+):
+    snapshot = handler_snapshot(path, "raw", snapshot)
+    return lazy_tree(
+        path, raw_node, poll_interval, snapshot, warm_up, prefetch, stacked
+    )
+
+
+def normalized_subdirectory_handler(
+    path,
+    poll_interval=None,
+    snapshot=False,
+    warm_up=None,
+    prefetch=DEFAULT_PREFETCH_DEPTH,
+    stacked=False,
+    merged=False,
+    mask_glitches=False,
+    scale_gains=False,
+):
+    # With mask_glitches, the derived absorption columns are NaN at the glitches
+    # found by the quality control, instead of only being flagged. With
+    # scale_gains, the channels are multiplied by the current sensitivity of
+    # their amplifier, so that they are on a common scale.
+    kind = "normalized"
+    if mask_glitches:
+        kind += "-masked"
+    if scale_gains:
+        kind += "-gains"
+    snapshot = handler_snapshot(path, kind, snapshot)
+    node_factory = functools.partial(
+        normalized_node, mask_glitches=mask_glitches, scale_gains=scale_gains
+    )
+    return lazy_tree(
+        path,
+        node_factory,
+        poll_interval,
+        snapshot,
+        warm_up,
+        prefetch,
+        stacked,
+        merged,
+    )
+
+
+def complete_subdirectory_handler(
+    path,
+    poll_interval=None,
+    snapshot=False,
+    warm_up=None,
+    prefetch=DEFAULT_PREFETCH_DEPTH,
+    stacked=False,
+    merged=False,
+):
     # Added a new method that combines the structures of a raw and XDI tree into one single tree
-    mapping = {}
-    heald_tree = MapAdapter(mapping)
-    mapping = complete_tree_iter_subdirectory(mapping, path)
-    return heald_tree
+    snapshot = handler_snapshot(path, "complete", snapshot)
+    return lazy_tree(
+        path,
+        complete_node,
+        poll_interval,
+        snapshot,
+        warm_up,
+        prefetch,
+        stacked,
+        merged,
+    )
 
 
 def normalize_dataframe(df, standardize=False):
@@ -442,6 +2116,443 @@ def normalize_dataframe(df, standardize=False):
     return norm_df, changed_names
 
 
+# Absorption columns derived from the normalized channels, as
+# name: (numerator, denominator, logarithm).
+DERIVED_COLUMNS = {
+    "mutrans": ("i0", "itrans", True),
+    "mufluor": ("ifluor", "i0", False),
+    "murefer": ("itrans", "irefer", True),
+}
+
+
+def derive_absorption(df):
+    # ln(i0/itrans), ifluor/i0 and ln(itrans/irefer) of a normalized frame, for
+    # the channels it has, computed together on one 2-D array. Points with a
+    # zero or negative denominator, or a logarithm of a non-positive ratio, are
+    # NaN instead of inf or a RuntimeWarning. Plain ratios keep their sign, as
+    # offset-subtracted fluorescence can be negative.
+    derived = {
+        name: spec
+        for name, spec in DERIVED_COLUMNS.items()
+        if spec[0] in df and spec[1] in df
+    }
+    if not derived:
+        return pd.DataFrame(index=df.index)
+    numerators, denominators, logarithms = zip(*derived.values())
+    numerator = df[list(numerators)].to_numpy(dtype=float)
+    denominator = df[list(denominators)].to_numpy(dtype=float)
+    ratio = np.divide(
+        numerator,
+        denominator,
+        out=np.full(numerator.shape, np.nan),
+        where=denominator > 0,
+    )
+    logarithm = np.array(logarithms)
+    values = np.log(ratio, out=ratio.copy(), where=logarithm & (ratio > 0))
+    values[logarithm & ~(ratio > 0)] = np.nan
+    return pd.DataFrame(values, index=df.index, columns=list(derived))
+
+
+def derived_formula(name):
+    # Formula of a derived column, for the metadata, e.g. "ln(i0/itrans)".
+    numerator, denominator, logarithm = DERIVED_COLUMNS[name]
+    ratio = f"{numerator}/{denominator}"
+    return f"ln({ratio})" if logarithm else ratio
+
+
+def with_derived_columns(df):
+    # The normalized frame with its derived absorption columns appended.
+    derived = derive_absorption(df)
+    return pd.concat([df, derived], axis=1) if len(derived.columns) else df
+
+
+def absorption(df):
+    # mu(E) of a normalized scan and how it was measured: ln(i0/itrans) in
+    # transmission, or ifluor/i0 in fluorescence. (None, None) when the scan
+    # lacks the columns of both modes. Uses the derived columns when the frame
+    # already has them.
+    if not ("mutrans" in df or "mufluor" in df):
+        df = derive_absorption(df)
+    if "mutrans" in df:
+        return df["mutrans"].to_numpy(), "transmission"
+    if "mufluor" in df:
+        return df["mufluor"].to_numpy(), "fluorescence"
+    return None, None
+
+
+def shared_energy_range(energies):
+    # (start, stop) of the energy range covered by every scan.
+    start = max(np.min(energy) for energy in energies)
+    stop = min(np.max(energy) for energy in energies)
+    return start, stop
+
+
+def common_energy_grid(energies, step=None):
+    # Evenly spaced grid over the energy range covered by every scan. The step
+    # defaults to the median step of the scans.
+    start, stop = shared_energy_range(energies)
+    if not start < stop:
+        raise ValueError("The scans do not share an energy range")
+    if step is None:
+        steps = np.concatenate([np.abs(np.diff(energy)) for energy in energies])
+        steps = steps[steps > 0]
+        step = float(np.median(steps))
+    return start + step * np.arange(int(np.floor((stop - start) / step)) + 1)
+
+
+def interpolate_scans(energies, values, grid):
+    # Linear interpolation of many scans onto one grid in a single operation.
+    # energies is a list of 1D arrays and values a list of (points, columns)
+    # arrays, one per scan. Returns a (scans, grid points, columns) array, with
+    # NaN outside of the energy range of each scan.
+    lengths = np.array([len(energy) for energy in energies])
+    if lengths.min() < 2:
+        raise ValueError("Every scan needs at least two points")
+    n_scans, n_points, n_columns = len(energies), lengths.max(), values[0].shape[1]
+    # Scans sorted by energy and padded with their last point to a common length.
+    padded_energies = np.empty((n_scans, n_points))
+    padded_values = np.empty((n_scans, n_points, n_columns))
+    for i, (energy, value) in enumerate(zip(energies, values)):
+        order = np.argsort(energy, kind="stable")
+        length = lengths[i]
+        padded_energies[i, :length] = energy[order]
+        padded_energies[i, length:] = energy[order[-1]]
+        padded_values[i, :length] = value[order]
+        padded_values[i, length:] = value[order[-1]]
+
+    # Offsetting each scan by more than the whole energy range turns the rows
+    # into one sorted array, so a single searchsorted() finds every bracketing
+    # pair of points.
+    low = min(padded_energies.min(), grid.min())
+    span = max(padded_energies.max(), grid.max()) - low + 1
+    offsets = span * np.arange(n_scans)[:, np.newaxis]
+    flat_energies = (padded_energies - low + offsets).ravel()
+    targets = grid[np.newaxis, :] - low + offsets
+    row_starts = n_points * np.arange(n_scans)[:, np.newaxis]
+    index = np.searchsorted(flat_energies, targets, side="right") - 1 - row_starts
+    index = np.clip(index, 0, n_points - 2) + row_starts
+
+    e0, e1 = flat_energies[index], flat_energies[index + 1]
+    flat_values = padded_values.reshape(n_scans * n_points, n_columns)
+    v0, v1 = flat_values[index], flat_values[index + 1]
+    width = e1 - e0
+    weight = np.divide(targets - e0, width, out=np.zeros_like(width), where=width != 0)
+    result = v0 + weight[..., np.newaxis] * (v1 - v0)
+
+    outside = (grid[np.newaxis, :] < padded_energies[:, :1]) | (
+        grid[np.newaxis, :] > padded_energies[:, -1:]
+    )
+    result[outside] = np.nan
+    return result
+
+
+def merge_scans(frames, columns=None, energy="energy", step=None, grid=None):
+    # Averages repeated scans, e.g. the normalized scans of an experiment group,
+    # after interpolating them onto a common energy grid. Returns a frame with
+    # the grid, the mean and the standard deviation ("<column>_std") of every
+    # column across the scans, and the number of scans covering each point.
+    # columns defaults to the numeric columns shared by all the frames. Scans
+    # made of several sweeps count as one scan per sweep.
+    frames = merged_sweeps(frames)
+    if not frames:
+        raise ValueError("No scan to merge")
+    if columns is None:
+        columns = [
+            name
+            for name in frames[0].select_dtypes("number").columns
+            if name not in (energy, "sweep")
+            and all(name in frame.columns for frame in frames)
+        ]
+    energies = [frame[energy].to_numpy(dtype=float) for frame in frames]
+    if grid is None:
+        grid = common_energy_grid(energies, step)
+    grid = np.asarray(grid, dtype=float)
+    values = [frame[columns].to_numpy(dtype=float) for frame in frames]
+    interpolated = interpolate_scans(energies, values, grid)
+
+    with warnings.catch_warnings():
+        # Grid points covered by no scan are NaN.
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(interpolated, axis=0)
+        spread = np.nanstd(interpolated, axis=0)
+    merged = pd.DataFrame({energy: grid})
+    for i, name in enumerate(columns):
+        merged[name] = mean[:, i]
+        merged[f"{name}_std"] = spread[:, i]
+    merged["scans"] = (
+        (grid >= np.array([e.min() for e in energies])[:, np.newaxis])
+        & (grid <= np.array([e.max() for e in energies])[:, np.newaxis])
+    ).sum(axis=0)
+    return merged
+
+
+def merged_sweeps(frames):
+    # The sweeps of frames that merge_scans() averages, those with more than one
+    # point.
+    return [
+        sweep for frame in frames for sweep in split_sweeps(frame) if len(sweep) > 1
+    ]
+
+
+def can_merge(frames, energy="energy"):
+    # Whether merge_scans() can average frames on their common energy grid.
+    sweeps = merged_sweeps(frames)
+    if not sweeps:
+        return False
+    start, stop = shared_energy_range(
+        [sweep[energy].to_numpy(dtype=float) for sweep in sweeps]
+    )
+    return bool(start < stop)
+
+
+def pad_scans(arrays):
+    # Stacks 1D arrays of different lengths into one (scans, points) array,
+    # padded with NaN. Also returns the lengths.
+    lengths = np.array([len(array) for array in arrays])
+    padded = np.full((len(arrays), lengths.max()), np.nan)
+    padded[np.arange(lengths.max()) < lengths[:, np.newaxis]] = np.concatenate(arrays)
+    return padded, lengths
+
+
+def find_e0(energy, mu):
+    # Edge energy of every row of padded (scans, points) arrays, at the largest
+    # derivative of mu(E). NaN for rows with fewer than two usable points.
+    order = np.argsort(energy, axis=1)
+    energy = np.take_along_axis(energy, order, axis=1)
+    mu = np.take_along_axis(mu, order, axis=1)
+    step = np.diff(energy, axis=1)
+    derivative = np.divide(
+        np.diff(mu, axis=1), step, out=np.full(step.shape, -np.inf), where=step > 0
+    )
+    derivative[np.isnan(derivative)] = -np.inf
+    index = np.argmax(derivative, axis=1)[:, np.newaxis]
+    lower = np.take_along_axis(energy, index, axis=1)[:, 0]
+    upper = np.take_along_axis(energy, index + 1, axis=1)[:, 0]
+    e0 = (lower + upper) / 2
+    e0[np.isneginf(np.take_along_axis(derivative, index, axis=1)[:, 0])] = np.nan
+    return e0
+
+
+def fit_polynomials(x, y, mask, order):
+    # Least-squares polynomial fits of y(x) over the points of mask, for every
+    # row of (scans, points) arrays at once: the normal equations of all the
+    # rows are stacked and solved together. Returns (scans, order + 1)
+    # coefficients, lowest order first, NaN for rows with too few points.
+    mask = mask & np.isfinite(x) & np.isfinite(y)
+    powers = np.where(mask, x, 0.0)[..., np.newaxis] ** np.arange(order + 1)
+    powers[~mask] = 0.0
+    normal = np.einsum("spi,spj->sij", powers, powers)
+    rhs = np.einsum("spi,sp->si", powers, np.where(mask, y, 0.0))
+    coefficients = np.einsum("sij,sj->si", np.linalg.pinv(normal), rhs)
+    coefficients[mask.sum(axis=1) <= order] = np.nan
+    return coefficients
+
+
+def evaluate_polynomials(coefficients, x):
+    # Values at the (scans, points) x of the polynomials of fit_polynomials().
+    powers = x[..., np.newaxis] ** np.arange(coefficients.shape[1])
+    return np.einsum("spi,si->sp", powers, coefficients)
+
+
+def normalize_edges(
+    energies,
+    mus,
+    e0=None,
+    pre_edge=DEFAULT_PRE_EDGE,
+    post_edge=DEFAULT_POST_EDGE,
+    order=DEFAULT_POST_EDGE_ORDER,
+):
+    # Pre-/post-edge normalization of many spectra at once. energies and mus are
+    # lists of 1D arrays, one per spectrum. A line is fitted over pre_edge and a
+    # polynomial of the given order over post_edge, both in eV relative to e0,
+    # which defaults to the largest derivative of each spectrum. The edge step
+    # is the difference of the two fits at e0.
+    # Returns a dict of arrays with one entry per spectrum: "e0", "edge_step",
+    # "pre_edge" and "post_edge" (coefficients in powers of E - e0 in keV,
+    # lowest order first), and "norm", the list of normalized spectra. Spectra
+    # whose fits fail or whose edge step is not positive get NaN.
+    if not len(energies):
+        raise ValueError("No spectrum to normalize")
+    energy, lengths = pad_scans([np.asarray(e, dtype=float) for e in energies])
+    mu, _ = pad_scans([np.asarray(m, dtype=float) for m in mus])
+    if e0 is None:
+        e0 = find_e0(energy, mu)
+    e0 = np.broadcast_to(np.asarray(e0, dtype=float), lengths.shape)
+    relative = energy - e0[:, np.newaxis]
+    pre_mask = (relative >= pre_edge[0]) & (relative <= pre_edge[1])
+    post_mask = (relative >= post_edge[0]) & (relative <= post_edge[1])
+    # keV keep the powers of the post-edge polynomial well conditioned.
+    x = relative / 1000
+    pre = fit_polynomials(x, mu, pre_mask, 1)
+    post = fit_polynomials(x, mu, post_mask, order)
+    edge_step = post[:, 0] - pre[:, 0]
+    edge_step[~(edge_step > 0)] = np.nan
+    norm = (mu - evaluate_polynomials(pre, x)) / edge_step[:, np.newaxis]
+    return {
+        "e0": e0.copy(),
+        "edge_step": edge_step,
+        "pre_edge": pre,
+        "post_edge": post,
+        "norm": [row[:length] for row, length in zip(norm, lengths)],
+    }
+
+
+def finite_or_none(values):
+    # Plain floats, or nested lists of them, for the node metadata, with None
+    # where a fit failed.
+    values = np.asarray(values, dtype=float)
+    if values.ndim:
+        return [finite_or_none(value) for value in values]
+    return float(values) if np.isfinite(values) else None
+
+
+def with_edge_normalization(df):
+    # The normalized frame with a "norm" column of its edge-step normalized
+    # mu(E), and the fit results for the node metadata. (df, None) when the
+    # scan has no absorption to normalize.
+    mu, mode = absorption(df)
+    if mu is None or len(df) < 2:
+        return df, None
+    result = normalize_edges([df["energy"].to_numpy(dtype=float)], [mu])
+    edge = {"mode": mode}
+    for name in ("e0", "edge_step", "pre_edge", "post_edge"):
+        edge[name] = finite_or_none(result[name][0])
+    return df.assign(norm=result["norm"][0]), edge
+
+
+def running_median(values, width):
+    # Median of the width points centered on every point of the rows of a padded
+    # (scans, points) array, ignoring NaN, and the median absolute deviation of
+    # these points from it.
+    half = width // 2
+    padded = np.pad(values, ((0, 0), (half, half)), constant_values=np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width, axis=1)
+    with warnings.catch_warnings():
+        # All-NaN windows of the padding.
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(windows, axis=2)
+        deviation = np.nanmedian(np.abs(windows - median[..., np.newaxis]), axis=2)
+    return median, deviation
+
+
+def quality_metrics(energies, mus, threshold=SPIKE_THRESHOLD, width=SPIKE_WINDOW):
+    # Quality metrics of many spectra at once. energies and mus are lists of 1D
+    # arrays, one per spectrum. Returns a dict of arrays with one entry per
+    # spectrum: "points", "points_per_ev" over the scanned range, "backsteps",
+    # the number of energy steps that are not increasing, "monotonic", "noise",
+    # a robust estimate of the noise of mu(E), "spikes", the number of
+    # glitches, and "glitches", the list of boolean masks of the glitches of
+    # every spectrum.
+    energy, lengths = pad_scans([np.asarray(e, dtype=float) for e in energies])
+    mu, _ = pad_scans([np.asarray(m, dtype=float) for m in mus])
+    steps = np.diff(energy, axis=1)
+    in_scan = np.arange(steps.shape[1]) < (lengths - 1)[:, np.newaxis]
+    backsteps = (~(steps > 0) & in_scan).sum(axis=1)
+
+    # The glitches are searched in energy order, with a Hampel filter: a point
+    # is flagged when it stands out of the median of its window by more than
+    # threshold times the spread of the window. The spread follows the shape of
+    # the spectrum, so that sharp but smooth features such as white lines are
+    # not flagged. It is never taken below the noise, which comes from the
+    # median absolute deviation of the second differences, 6 times the variance
+    # of white noise, nor below a floor for noiseless spectra.
+    order = np.argsort(energy, axis=1)
+    sorted_mu = np.take_along_axis(mu, order, axis=1)
+    median, spread = running_median(sorted_mu, width)
+    residual = np.abs(sorted_mu - median)
+    curvature = np.diff(sorted_mu, n=2, axis=1)
+    with warnings.catch_warnings():
+        # Spectra without any finite point.
+        warnings.simplefilter("ignore", RuntimeWarning)
+        span = np.nanmax(energy, axis=1) - np.nanmin(energy, axis=1)
+        deviation = np.abs(curvature - np.nanmedian(curvature, axis=1)[:, np.newaxis])
+        noise = 1.4826 * np.nanmedian(deviation, axis=1) / np.sqrt(6)
+        floor = np.maximum(noise, 1e-9 * np.nanmax(np.abs(sorted_mu), axis=1))
+    scale = np.maximum(1.4826 * spread, floor[:, np.newaxis])
+    flagged = residual > threshold * scale
+    glitches = np.empty_like(flagged)
+    np.put_along_axis(glitches, order, flagged, axis=1)
+    return {
+        "points": lengths,
+        "points_per_ev": np.divide(
+            lengths - 1, span, out=np.full(span.shape, np.nan), where=span > 0
+        ),
+        "backsteps": backsteps,
+        "monotonic": backsteps == 0,
+        "noise": noise,
+        "spikes": glitches.sum(axis=1),
+        "glitches": [row[:length] for row, length in zip(glitches, lengths)],
+    }
+
+
+def with_quality_control(df, mask_glitches=False):
+    # The normalized frame with a boolean "glitch" column flagging the glitches
+    # of its mu(E), and its quality metrics for the node metadata. If
+    # mask_glitches, the derived absorption columns are NaN at the glitches.
+    if len(df) < 2:
+        return df.assign(glitch=False), None
+    mu, _ = absorption(df)
+    if mu is None:
+        mu = np.full(len(df), np.nan)
+    metrics = quality_metrics([df["energy"].to_numpy(dtype=float)], [mu])
+    glitch = metrics["glitches"][0]
+    df = df.assign(glitch=glitch)
+    if mask_glitches:
+        df.loc[glitch, [name for name in DERIVED_COLUMNS if name in df]] = np.nan
+    qc = {
+        "points": int(metrics["points"][0]),
+        "points_per_ev": finite_or_none(metrics["points_per_ev"][0]),
+        "backsteps": int(metrics["backsteps"][0]),
+        "monotonic": bool(metrics["monotonic"][0]),
+        "noise": finite_or_none(metrics["noise"][0]),
+        "spikes": int(metrics["spikes"][0]),
+        "masked": mask_glitches,
+    }
+    return df, qc
+
+
+def process_normalized_frame(
+    norm_df, mask_glitches=False, gains=None, preset_time=None
+):
+    # Scales the channels of a normalized frame by their amplifier gains, if
+    # given as {channel: sensitivity in A/V}, then adds the count rates, if the
+    # preset_time of the points is given, the derived absorption columns, the
+    # sweep index, the glitch flags and the edge-step normalization, in that
+    # order, so that masked glitches stay out of the edge fits. Returns the
+    # frame and the metadata entries of these steps.
+    if gains:
+        # One multiplication for all the scaled channels.
+        channels = list(gains)
+        norm_df[channels] = norm_df[channels].to_numpy(dtype=float) * np.array(
+            list(gains.values())
+        )
+    rates = []
+    if preset_time is not None:
+        norm_df, rates = with_count_rates(norm_df, preset_time)
+    norm_df = with_derived_columns(norm_df)
+    # The sweep index is added in place, the frame is already a new one.
+    norm_df["sweep"] = sweep_index(norm_df["energy"])
+    metadata = {
+        "Derived": {
+            name: derived_formula(name)
+            for name in norm_df.columns
+            if name in DERIVED_COLUMNS
+        },
+        "Sweeps": int(norm_df["sweep"].iloc[-1]) + 1,
+    }
+    if gains:
+        metadata["Gains"] = gains
+    if rates:
+        metadata["Rates"] = {"columns": rates}
+    norm_df, qc = with_quality_control(norm_df, mask_glitches)
+    if qc is not None:
+        metadata["QC"] = qc
+    norm_df, edge = with_edge_normalization(norm_df)
+    if edge is not None:
+        metadata["Edge"] = edge
+    return norm_df, metadata
+
+
 def parse_element_name(filepath, df, metadata):
 
     element_name = None
@@ -536,12 +2647,24 @@ def parse_element_name(filepath, df, metadata):
 
 class HealdLabViewTree(MapAdapter):
     @classmethod
-    def from_directory(cls, directory):
+    def from_directory(cls, directory, snapshot=False):
+        # With snapshot=True, the files unchanged since the last call are not
+        # parsed until they are read.
+        _, scan_entries = scan_directory(directory)
+        if not snapshot:
+            mapping = {
+                entry.name: build_reader(Path(entry.path))
+                for entry, _, _ in scan_entries
+            }
+            return cls(mapping)
+        snapshot = tree_snapshot(directory, "heald")
         mapping = {
-            filename: build_reader(Path(directory, filename))
-            for filename in os.listdir(directory)
-            if is_candidate(filename)
+            entry.name: snapshot_node(
+                snapshot, Path(entry.path), build_reader, Path(entry.path)
+            )
+            for entry, _, _ in scan_entries
         }
+        snapshot.save()
         return cls(mapping)
 
 
@@ -560,25 +2683,24 @@ class RIXSImagesAndTable(MapAdapter):
                     ),
                 }
             )
-            for name in os.listdir(directory)
-            if not os.path.isdir(Path(directory, name))
+            for name in (
+                entry.name for entry in os.scandir(directory) if not entry.is_dir()
+            )
         }
         return cls(mapping)
 
 
 class NormalizedReader:
-    def __init__(self, filepath):
-        cache_key = (
-            Path(__file__).stem,
-            filepath,
-        )  # exact same key you used for build_reader
+    def __init__(self, filepath, mask_glitches=False, scale_gains=False):
         # Make an UNnoramlized reader first.
-        # Use the cache so that this unnormalized reader can be shared across
-        # a normalized tree and an unnormalized tree.
-        self._unnormalized_reader = with_object_cache(
-            cache_key, build_reader, filepath, no_device=True
+        # Use the cache so that this unnormalized reader is parsed once, even when
+        # several requests need it at the same time.
+        self._unnormalized_reader = cached_node(
+            filepath, "no_device", build_reader, filepath, no_device=True
         )
         self._current_filepath = filepath
+        self._mask_glitches = mask_glitches
+        self._scale_gains = scale_gains
 
     def read(self):
         result = self._unnormalized_reader.read()
@@ -587,6 +2709,17 @@ class NormalizedReader:
         norm_df, changed_columns = normalize_dataframe(result)
         if norm_df is None:
             return norm_df
+        gains = None
+        if self._scale_gains:
+            gains = channel_gains(changed_columns, self._unnormalized_reader.metadata)
+        preset_time, preset_source = preset_times(
+            result, self._unnormalized_reader.metadata
+        )
+        norm_df, processed_metadata = process_normalized_frame(
+            norm_df, self._mask_glitches, gains, preset_time
+        )
+        if "Rates" in processed_metadata:
+            processed_metadata["Rates"]["preset_time"] = preset_source
 
         # norm_metadata = {'Columns':self._unnormalized_reader.metadata['Columns']}
         element_name, edge_symbol = parse_element_name(
@@ -596,10 +2729,16 @@ class NormalizedReader:
             "Element": {"symbol": element_name, "edge": edge_symbol},
             "common": {"element": {"symbol": element_name, "edge": edge_symbol}},
             "Translation": changed_columns,
+            **processed_metadata,
         }
-        return DataFrameAdapter.from_pandas(
-            norm_df, metadata=norm_metadata, npartitions=1
+        # The derived columns are kept with the normalized frame in FRAME_STORE,
+        # next to the unnormalized frame it comes from.
+        options = (self._mask_glitches, self._scale_gains)
+        key = ("normalized",) + options + self._unnormalized_reader.key
+        loader = functools.partial(
+            read_normalized_frame, self._current_filepath, *options
         )
+        return StoredFrameAdapter(key, loader, norm_df, metadata=norm_metadata)
 
     def is_empty(self):
         node_state = False
@@ -0,0 +1,160 @@
+"""
+Index of the motor positions and slit settings of a LabVIEW archive.
+
+Only the headers of the files are read. The typed values that
+parse_heald_labview() finds in their Motor Positions and Slit Info blocks go
+into a parquet table, with one row per file and one "motor.<name>" or
+"slit.<name>" column per value, next to the size and mtime of the file.
+Updating the index only reads the files that changed since, and queries run on
+the table without touching the files again:
+
+python -m aimm_adapters.positions build path/to/files path/to/positions.parquet
+python -m aimm_adapters.positions query path/to/positions.parquet sample_x 12.3 -t 0.1
+"""
+
+import argparse
+import io
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .heald_labview import parse_heald_labview, walk_scan_files
+
+# Header values indexed, as metadata key: column prefix.
+VALUE_PREFIXES = {"motor_position_values": "motor.", "slit_info_values": "slit."}
+FILE_COLUMNS = ["file", "size", "mtime_ns"]
+
+
+def read_header(filepath):
+    # The comment lines at the top of filepath, without its data.
+    lines = []
+    with open(filepath) as file:
+        for line in file:
+            if not line.startswith("#"):
+                break
+            lines.append(line)
+    return "".join(lines)
+
+
+def index_record(filepath):
+    # {column: value} of one file of the index. Runs in the worker processes.
+    try:
+        _, metadata = parse_heald_labview(io.StringIO(read_header(filepath)))
+    except (IndexError, KeyError, ValueError, OSError):
+        metadata = {}
+    record = {}
+    for key, prefix in VALUE_PREFIXES.items():
+        for name, value in metadata.get(key, {}).items():
+            record[prefix + name] = value
+    return record
+
+
+def build_position_index(directory, output, workers=None, chunksize=64):
+    # Writes the index of the files below directory to output, or updates it.
+    # The rows of the files whose size and mtime did not change are kept from
+    # the previous index. Returns the index, whose attrs["parsed"] is the number
+    # of files read.
+    directory = Path(directory)
+    output = Path(output)
+    current = pd.DataFrame(
+        [
+            (
+                str((dirpath / (stem + suffix)).relative_to(directory)),
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+            for dirpath, stem, suffix, stat in walk_scan_files(directory)
+        ],
+        columns=FILE_COLUMNS,
+    )
+    parts = []
+    if output.exists():
+        parts.append(pd.read_parquet(output).merge(current, on=FILE_COLUMNS))
+    changed = current
+    if parts:
+        changed = current[~current["file"].isin(parts[0]["file"])]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        records = list(
+            executor.map(
+                index_record,
+                [directory / name for name in changed["file"]],
+                chunksize=chunksize,
+            )
+        )
+    parts.append(
+        pd.concat([changed.reset_index(drop=True), pd.DataFrame(records)], axis=1)
+    )
+    index = pd.concat(parts, ignore_index=True).sort_values("file")
+    # Values no file has anymore.
+    index = index.dropna(axis="columns", how="all").reset_index(drop=True)
+    index.to_parquet(output, index=False)
+    index.attrs["parsed"] = len(changed)
+    return index
+
+
+class PositionIndex:
+    """
+    Queries on the index written by build_position_index().
+
+    Parameters
+    ----------
+    table : pandas.DataFrame, str or Path
+        The index, or the parquet file that holds it.
+    """
+
+    def __init__(self, table):
+        if not isinstance(table, pd.DataFrame):
+            table = pd.read_parquet(table)
+        self.table = table
+
+    def column(self, name):
+        # Column of a motor or slit value, named with or without its prefix.
+        for column in [name] + [prefix + name for prefix in VALUE_PREFIXES.values()]:
+            if column in self.table:
+                return column
+        raise KeyError(name)
+
+    def near(self, name, value, tolerance):
+        # Rows of the files whose name value is within tolerance of value.
+        values = self.table[self.column(name)].to_numpy(dtype=float)
+        return self.table[np.abs(values - value) <= tolerance]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build or update the index.")
+    build_parser.add_argument("directory", help="Root directory of the LabVIEW files.")
+    build_parser.add_argument("output", help="Parquet file of the index.")
+    build_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs).",
+    )
+
+    query_parser = subparsers.add_parser(
+        "query", help="List the files with a value close to the given one."
+    )
+    query_parser.add_argument("index", help="Parquet file of the index.")
+    query_parser.add_argument("name", help="Motor or slit name, e.g. sample_x.")
+    query_parser.add_argument("value", type=float)
+    query_parser.add_argument("-t", "--tolerance", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        index = build_position_index(args.directory, args.output, args.workers)
+        print(f"{len(index)} files indexed, {index.attrs['parsed']} read")
+    else:
+        rows = PositionIndex(args.index).near(args.name, args.value, args.tolerance)
+        for name in rows["file"]:
+            print(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,20 @@
+import io
+import json
 from enum import Enum
 from pathlib import Path
 
 import pandas as pd
 import xraydb
 
+from aimm_adapters.heald_labview import walk_scan_files
+
 _EDGE_ENERGY_DICT = {
     xraydb.atomic_symbol(i): [i, xraydb.xray_edges(i)] for i in range(1, 99)
 }
 
+# Errors the parsers of this module raise on malformed files.
+PARSE_ERRORS = (IndexError, KeyError, ValueError)
+
 
 class ParsingCase(Enum):
     column = 1
@@ -297,230 +304,213 @@ def find_char_indexes(word, char):
     return [i for i, val in enumerate(word) if val == char]
 
 
+def _nested_mapping(nodes, dirpath):
+    # Returns the dictionary for dirpath inside the tree-like dictionary, creating
+    # the intermediate subfolder entries on first use.
+    if dirpath not in nodes:
+        nodes[dirpath] = {}
+        _nested_mapping(nodes, dirpath.parent)[dirpath.name] = nodes[dirpath]
+    return nodes[dirpath]
+
+
 def iter_subdirectory_handler(mapping, path):
-    # Recursively, creates a tree-like dictionary by grouping files based on the
-    # name of experiment. The end nodes save the information of each file contaning
+    # Creates a tree-like dictionary by grouping files based on the name of
+    # experiment. The end nodes save the information of each file contaning
     # a list with the name of the columns and the size of the list and the size of
     # the columns in the data section. This function is to be used to check that
     # all files have a matching and stable structure in size
 
-    test_group = set()
-    name_set = set()
-    for filepath in path.iterdir():
-        if filepath.name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepath.is_file():
-            # Explore subfolder for more labview files recursively
-            mapping[filepath.name] = {}
-            mapping[filepath.name] = iter_subdirectory_handler(
-                mapping[filepath.name], filepath
-            )
-            continue
-        if filepath.suffix[1:].isnumeric():
-            with open(filepath) as file:
-                columns, column_number = parse_columns(file)
-
-            if filepath.stem in test_group:
-                for element in columns:
-                    if element not in name_set:
-                        name_set.add(element)
-                        mapping[filepath.stem][0].append(element)
-                        mapping[filepath.stem][2][0] = len(mapping[filepath.stem][0])
-                        print(filepath.name)
-
-                mapping[filepath.stem][1].append(filepath.name)
-
-                if column_number != mapping[filepath.stem][2][1]:
-                    print(column_number)
-
-                # print(filepath.stem)
-            else:
-                test_group.add(filepath.stem)
-                file_list = [filepath.name]
-                mapping[filepath.stem] = [
-                    columns,
-                    file_list,
-                    [column_number, len(columns)],
-                ]
-                name_set = set(columns)
-            # print(filepath.stem)
+    nodes = {Path(path): mapping}
+    name_sets = {}
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        filepath = dirpath / (stem + suffix)
+        with open(filepath) as file:
+            columns, column_number = parse_columns(file)
+
+        group = _nested_mapping(nodes, dirpath)
+        name_set = name_sets.get((dirpath, stem))
+        if name_set is not None:
+            for element in columns:
+                if element not in name_set:
+                    name_set.add(element)
+                    group[stem][0].append(element)
+                    group[stem][2][0] = len(group[stem][0])
+                    print(filepath.name)
+
+            group[stem][1].append(filepath.name)
+
+            if column_number != group[stem][2][1]:
+                print(column_number)
+        else:
+            name_sets[(dirpath, stem)] = set(columns)
+            file_list = [filepath.name]
+            group[stem] = [
+                columns,
+                file_list,
+                [column_number, len(columns)],
+            ]
 
     return mapping
 
 
 def iter_subdirectory_handler_v2(mapping, path):
-    # Recursively, creates a tree-like dictionary by grouping files based on the
-    # name of experiment and similarities between column names
-
-    test_group = set()
-
-    for filepath in path.iterdir():
-        if filepath.name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepath.is_file():
-            # Explore subfolder for more labview files recursively
-            mapping[filepath.name] = {}
-            mapping[filepath.name] = iter_subdirectory_handler_v2(
-                mapping[filepath.name], filepath
-            )
-            continue
-        if filepath.suffix[1:].isnumeric():
-            with open(filepath) as file:
-                columns, column_number = parse_columns(file)
-                column_key = tuple(columns)
-
-            if filepath.stem not in test_group:
-                test_group.add(filepath.stem)
-                mapping[filepath.stem] = {}
-                file_value = [filepath.name]
-                mapping[filepath.stem][column_key] = file_value
-            else:
-                if column_key in mapping[filepath.stem].keys():
-                    mapping[filepath.stem][column_key].append(filepath.name)
-                else:
-                    file_value = [filepath.name]
-                    mapping[filepath.stem][column_key] = file_value
+    # Creates a tree-like dictionary by grouping files based on the name of
+    # experiment and similarities between column names
+
+    nodes = {Path(path): mapping}
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        filepath = dirpath / (stem + suffix)
+        with open(filepath) as file:
+            columns, column_number = parse_columns(file)
+            column_key = tuple(columns)
+
+        group = _nested_mapping(nodes, dirpath).setdefault(stem, {})
+        if column_key in group:
+            group[column_key].append(filepath.name)
+        else:
+            group[column_key] = [filepath.name]
 
     return mapping
 
 
 def iter_subdirectory_handler_v3(mapping, path, keyword):
-    # Improved recursive method. Creates a tree-like dictionary by grouping files
+    # Improved method. Creates a tree-like dictionary by grouping files
     # based on the use of a specific keyword.
 
-    for filepath in path.iterdir():
-        if filepath.name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepath.is_file():
-            # Explore subfolder for more labview files recursively
-            mapping[filepath.name] = {}
-            mapping[filepath.name] = iter_subdirectory_handler_v3(
-                mapping[filepath.name], filepath, keyword
-            )
-            continue
-        if filepath.suffix[1:].isnumeric():
-            with open(filepath) as file:
-                is_column = find_in_file(file, keyword)
-
-            if filepath.stem not in mapping:
-                mapping[filepath.stem] = {keyword: [], "None": []}
-            if is_column:
-                mapping[filepath.stem][keyword].append(filepath.name)
-            else:
-                mapping[filepath.stem]["None"].append(filepath.name)
+    nodes = {Path(path): mapping}
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        filepath = dirpath / (stem + suffix)
+        with open(filepath) as file:
+            is_column = find_in_file(file, keyword)
+
+        group = _nested_mapping(nodes, dirpath)
+        if stem not in group:
+            group[stem] = {keyword: [], "None": []}
+        if is_column:
+            group[stem][keyword].append(filepath.name)
+        else:
+            group[stem]["None"].append(filepath.name)
 
     return mapping
 
 
 def iter_count_keyword(path, keyword):
-    # Recursively, counts the number of times that a keyword is used in all the files
+    # Counts the number of times that a keyword is used in all the files
     # of the dataset
 
     counter = 0
     total = 0
-    for filepath in path.iterdir():
-        if filepath.name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepath.is_file():
-            # Explore subfolder for more labview files recursively
-            temp_counter, temp_total = iter_count_keyword(filepath, keyword)
-            counter += temp_counter
-            total += temp_total
-            continue
-        if filepath.suffix[1:].isnumeric():
-            with open(filepath) as file:
-                column_names, column_size = parse_columns(file)
-                column_set = set(column_names)
-                if keyword in column_set:
-                    counter += 1
-                total += 1
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        with open(dirpath / (stem + suffix)) as file:
+            column_names, column_size = parse_columns(file)
+            column_set = set(column_names)
+            if keyword in column_set:
+                counter += 1
+            total += 1
     return counter, total
 
 
 def iter_unique_keywords(path, tracked_set, start=False, count=False, collection=None):
-    # Recursively, navigates through subfolders and labview files and finds
-    # unique keywords that used in the columns names throughout the entire dataset
-
-    for filepath in path.iterdir():
-        if filepath.name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepath.is_file():
-            # Explore subfolder for more labview files recursively
-            tracked_set, start, collection = iter_unique_keywords(
-                filepath, tracked_set, start, count, collection
-            )
-            continue
-        if filepath.suffix[1:].isnumeric():
-            with open(filepath) as file:
-                column_names, column_size = parse_columns(file, no_device=True)
-
-                column_set = set(column_names)
-                if "Mono Energy" in column_set and column_size > 0:
-                    if not count:
-                        # if (
-                        #     "I0" not in column_set
-                        #     and "IO" not in column_set
-                        #     and "I-0" not in column_set
-                        # ):
-                        #     collection_names = ",".join(column_names)
-                        #     collection.add(collection_names)
-                        #     print("Not Unique: ", filepath)
-                        if start:
-                            tracked_set = column_set.copy()
-                            start = False
-                        else:
-                            tracked_set = tracked_set | column_set
+    # Navigates through subfolders and labview files and finds unique keywords
+    # that used in the columns names throughout the entire dataset
+
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        with open(dirpath / (stem + suffix)) as file:
+            column_names, column_size = parse_columns(file, no_device=True)
+
+            column_set = set(column_names)
+            if "Mono Energy" in column_set and column_size > 0:
+                if not count:
+                    # if (
+                    #     "I0" not in column_set
+                    #     and "IO" not in column_set
+                    #     and "I-0" not in column_set
+                    # ):
+                    #     collection_names = ",".join(column_names)
+                    #     collection.add(collection_names)
+                    #     print("Not Unique: ", filepath)
+                    if start:
+                        tracked_set = column_set.copy()
+                        start = False
                     else:
-                        for set_name in column_set:
-                            if set_name not in tracked_set:
-                                tracked_set[set_name] = 0
-                            tracked_set[set_name] += 1
+                        tracked_set = tracked_set | column_set
+                else:
+                    for set_name in column_set:
+                        if set_name not in tracked_set:
+                            tracked_set[set_name] = 0
+                        tracked_set[set_name] += 1
 
     return tracked_set, start, collection
 
 
-def iter_dictionary_read(dict_input, level, str_buffer):
-    # Recursively, reads a dictionary and pass it to a buffer
+def write_tree_report(dict_input, file, report_format="text"):
+    # Streams a tree-like dictionary straight to an open file handle, one line per
+    # entry, so memory use does not grow with the size of the report.
+    #
+    # "text" is the indented format of the *_file_tree.txt files. "jsonl" writes
+    # one JSON object per entry with its level, the path of keys leading to it
+    # and, for the end nodes, its value.
+
+    if report_format == "text":
+        write_line = _write_text_line
+    elif report_format == "jsonl":
+        write_line = _write_jsonl_line
+    else:
+        raise ValueError(f"Unknown report format: {report_format!r}")
+
+    path = []
+    # Explicit stack of item iterators, one per level of the tree being written.
+    stack = [iter(dict_input.items())]
+    while stack:
+        for key, value in stack[-1]:
+            del path[len(stack) - 1 :]  # noqa: E203
+            path.append(key)
+            write_line(file, path, value)
+            if type(value) is dict:
+                stack.append(iter(value.items()))
+                break
+        else:
+            stack.pop()
+
 
+def _write_text_line(file, path, value):
     spacing = "--"
+    file.write("    " * (len(path) - 1) + "|" + spacing + " " + str(path[-1]) + ":")
+    file.write("\n" if type(value) is dict else str(value) + "\n")
 
-    for key, value in dict_input.items():
-        str_buffer += "    " * level + "|" + spacing + " "
-        str_buffer += str(key) + ":"
-        if type(value) == dict:
-            str_buffer += "\n"
-            str_buffer = iter_dictionary_read(value, level + 1, str_buffer)
-        else:
-            str_buffer += str(value) + "\n"
 
-    return str_buffer
+def _write_jsonl_line(file, path, value):
+    # Tuple keys (e.g. column signatures) become JSON lists.
+    entry = {"level": len(path) - 1, "path": path}
+    if type(value) is not dict:
+        entry["value"] = value
+    file.write(json.dumps(entry, default=str) + "\n")
+
+
+def iter_dictionary_read(dict_input, level, str_buffer):
+    # Reads a dictionary and pass it to a buffer. Kept for compatibility; use
+    # write_tree_report() to write a report to a file.
+
+    buffer = io.StringIO()
+    write_tree_report(dict_input, buffer)
+    indentation = "    " * level
+    lines = buffer.getvalue().splitlines(keepends=True)
+    return str_buffer + "".join(indentation + line for line in lines)
 
 
 def iter_element_name_parse(path):
 
-    for filepath in path.iterdir():
-        if filepath.name.startswith("."):
-            # Skip hidden files.
-            continue
-        if not filepath.is_file():
-            # Explore subfolder for more labview files recursively
-            iter_element_name_parse(filepath)
-            continue
-        if filepath.suffix[1:].isnumeric():
-            with open(filepath) as file:
-                df, metadata = parse_labview_file(file)
+    for dirpath, stem, suffix, _ in walk_scan_files(path, stat=False):
+        filepath = dirpath / (stem + suffix)
+        with open(filepath) as file:
+            df, metadata = parse_labview_file(file)
 
-            if not df.empty:
-                element_name, edge_symbol = parse_element_name(filepath, df, metadata)
-                print(element_name, edge_symbol)
+        if not df.empty:
+            element_name, edge_symbol = parse_element_name(filepath, df, metadata)
+            print(element_name, edge_symbol)
 
 
-def write_file_structure(keyword):
+def write_file_structure(keyword, report_format="text"):
     # Navigates through all the subfolders in the dataset, finds the compatible files,
     # creates a tree structure with their information and writes it into a file.
 
@@ -528,12 +518,12 @@ def write_file_structure(keyword):
     mapping = {}
     # mapping = iter_subdirectory_handler_v2(mapping, Path("../files/"))
     mapping = iter_subdirectory_handler_v3(mapping, Path("../files/"), keyword)
-    string_buffer = iter_dictionary_read(mapping, 0, "")
 
     # with open("labview_file_tree.txt", "w") as file:
-    filename = "files/" + keyword + "_file_tree.txt"
+    extension = ".txt" if report_format == "text" else ".jsonl"
+    filename = "files/" + keyword + "_file_tree" + extension
     with open(filename, "w") as file:
-        file.write(string_buffer)
+        write_tree_report(mapping, file, report_format)
 
     print("Done!!")
 
@@ -0,0 +1,72 @@
+"""
+Memory held by the header metadata of a LabVIEW archive, with and without sharing.
+
+The headers of every file below a directory are parsed twice and their metadata
+kept: once as the trees parse them, with the identical header sections shared
+between files by shared_section(), and once with its cache cleared before every
+file, so that nothing is shared. Run it like this:
+
+python -m aimm_adapters.scripts.header_memory path/to/files
+"""
+
+import argparse
+import io
+import tracemalloc
+
+from ..heald_labview import parse_heald_labview, shared_section, walk_scan_files
+from ..positions import read_header
+
+
+def retained_metadata(headers, share=True):
+    # Bytes still allocated for the metadata of headers once all of them are
+    # parsed, and the number of headers that could be parsed.
+    shared_section.cache_clear()
+    metadata = []
+    tracemalloc.start()
+    try:
+        for header in headers:
+            if not share:
+                shared_section.cache_clear()
+            try:
+                metadata.append(parse_heald_labview(io.StringIO(header))[1])
+            except (IndexError, KeyError, ValueError):
+                continue
+        # Only what the metadata holds on to is counted, not the cache itself.
+        shared_section.cache_clear()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return retained, len(metadata)
+
+
+def measure(directory):
+    headers = [
+        read_header(dirpath / (stem + suffix))
+        for dirpath, stem, suffix, _ in walk_scan_files(directory, stat=False)
+    ]
+    unshared, parsed = retained_metadata(headers, share=False)
+    shared, _ = retained_metadata(headers)
+    return {
+        "files": len(headers),
+        "parsed": parsed,
+        "unshared": unshared,
+        "shared": shared,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory", help="Root directory of the LabVIEW files.")
+    args = parser.parse_args(argv)
+
+    result = measure(args.directory)
+    saved = result["unshared"] - result["shared"]
+    print(f"{result['parsed']} of {result['files']} headers parsed")
+    print(f"Without sharing: {result['unshared'] / 1e6:.2f} MB")
+    print(f"With sharing: {result['shared'] / 1e6:.2f} MB")
+    if result["unshared"]:
+        print(f"Saved: {saved / 1e6:.2f} MB ({saved / result['unshared']:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Clustering of LabVIEW files by their column signature.
+
+Every file gets a compact hash of its column names. The index maps each hash to
+its columns and to the files that share it, and it is persisted as JSON so that
+later runs only parse the files that are new or changed. Files that cannot be
+parsed are listed with their error instead of a signature. Run it like this:
+
+python -m aimm_adapters.scripts.signatures path/to/files --index files/column_signatures.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from ..heald_labview import walk_scan_files
+from .file_handler import PARSE_ERRORS, parse_columns
+
+INDEX_VERSION = 2
+
+
+def signature_hash(columns):
+    # Short, stable hash of an ordered list of column names.
+    joined = "\x1f".join(columns).encode()
+    return hashlib.sha1(joined).hexdigest()[:16]
+
+
+def read_signature(filepath):
+    # (columns, None), or (None, error) when filepath cannot be parsed.
+    with open(filepath) as file:
+        try:
+            columns, _ = parse_columns(file)
+        except PARSE_ERRORS as err:
+            return None, f"{type(err).__name__}: {err}"
+    return columns, None
+
+
+class SignatureIndex:
+    # Persisted tables of column signatures, keyed by their hash, and of the
+    # signature and (size, mtime) of every file seen in the last run. Files that
+    # cannot be parsed have a None signature and their error.
+
+    def __init__(self, signatures=None, files=None):
+        self.signatures = signatures or {}
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, filename):
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename) as file:
+            content = json.load(file)
+        if content.get("version") != INDEX_VERSION:
+            return cls()
+        return cls(content["signatures"], content["files"])
+
+    def save(self, filename):
+        content = {
+            "version": INDEX_VERSION,
+            "signatures": self.signatures,
+            "clusters": self.clusters(),
+            "errors": self.errors(),
+            "files": self.files,
+        }
+        with open(filename, "w") as file:
+            json.dump(content, file, indent=1)
+
+    def clusters(self):
+        # Signature hash to list of files table.
+        clusters = {}
+        for name, entry in sorted(self.files.items()):
+            if entry["signature"] is not None:
+                clusters.setdefault(entry["signature"], []).append(name)
+        return clusters
+
+    def errors(self):
+        # File to parse error table.
+        return {
+            name: entry["error"]
+            for name, entry in sorted(self.files.items())
+            if entry["signature"] is None
+        }
+
+    def update(self, directory, workers=None, chunksize=16):
+        # Brings the index up to date with the files below directory, parsing only
+        # the files that are new or whose size or mtime changed. Returns the files
+        # whose signature changed, which flags schema changes between runs. Files
+        # that could not be parsed, before or now, are not schema changes.
+        seen = set()
+        stale = []
+        for dirpath, stem, suffix, stat in walk_scan_files(directory):
+            filepath = dirpath / (stem + suffix)
+            name = os.path.relpath(filepath, directory)
+            seen.add(name)
+            entry = self.files.get(name, {})
+            if (entry.get("size"), entry.get("mtime_ns")) != (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                stale.append((name, filepath, stat))
+
+        for name in set(self.files) - seen:
+            del self.files[name]
+
+        changes = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            all_columns = executor.map(
+                read_signature,
+                [filepath for _, filepath, _ in stale],
+                chunksize=chunksize,
+            )
+            for (name, _, stat), (columns, error) in zip(stale, all_columns):
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                if columns is None:
+                    self.files[name] = {"signature": None, "error": error, **entry}
+                    continue
+                signature = signature_hash(columns)
+                self.signatures.setdefault(signature, columns)
+                previous = self.files.get(name, {}).get("signature")
+                if previous is not None and previous != signature:
+                    changes.append({"file": name, "old": previous, "new": signature})
+                self.files[name] = {"signature": signature, **entry}
+
+        # Forget the signatures no file uses anymore.
+        used = {entry["signature"] for entry in self.files.values()}
+        for signature in set(self.signatures) - used:
+            del self.signatures[signature]
+        return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory", help="Root directory of the LabVIEW files.")
+    parser.add_argument(
+        "-i",
+        "--index",
+        default="files/column_signatures.json",
+        help="Path of the persisted signature index.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs).",
+    )
+    args = parser.parse_args(argv)
+
+    index = SignatureIndex.load(args.index)
+    changes = index.update(args.directory, args.workers)
+    index.save(args.index)
+
+    print(f"{len(index.files)} files, {len(index.signatures)} column signatures")
+    for name, error in index.errors().items():
+        print(f"Cannot parse: {name} {error}")
+    for change in changes:
+        print(f"Signature changed: {change['file']} {change['old']} -> {change['new']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Survey of a whole LabVIEW dataset in one parallel pass.
+
+Computes together the statistics that file_handler.py gathers with separate
+walks: column signature groups, keyword frequencies, per-keyword file counts,
+element/edge assignments and column-count mismatches. Run it like this:
+
+python -m aimm_adapters.scripts.survey path/to/files --workers 8 --output survey_report.json
+"""
+
+import argparse
+import io
+import json
+import os
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from ..heald_labview import walk_scan_files
+from .file_handler import (
+    PARSE_ERRORS,
+    parse_columns,
+    parse_element_name,
+    parse_labview_file,
+)
+from .signatures import signature_hash
+
+
+def _named_buffer(text, filepath):
+    # In-memory copy of a file for the parsers, which report errors by file name.
+    buffer = io.StringIO(text)
+    buffer.name = str(filepath)
+    return buffer
+
+
+def survey_file(filepath):
+    # Reads one file from disk once and extracts everything the survey needs.
+    # Runs in the worker processes, so it only returns plain Python objects.
+    record = {
+        "file": str(filepath),
+        "columns": None,
+        "device_free_columns": [],
+        "data_columns": 0,
+        "element": None,
+        "edge": None,
+        "error": None,
+    }
+    try:
+        with open(filepath) as file:
+            text = file.read()
+        record["columns"], record["data_columns"] = parse_columns(
+            _named_buffer(text, filepath)
+        )
+        record["device_free_columns"], _ = parse_columns(
+            _named_buffer(text, filepath), no_device=True
+        )
+        df, metadata = parse_labview_file(_named_buffer(text, filepath))
+        if not df.empty:
+            record["element"], record["edge"] = parse_element_name(
+                filepath, df, metadata
+            )
+    except (*PARSE_ERRORS, OSError) as err:
+        # Unreadable files are recorded as failed, like unparsable ones.
+        record["error"] = f"{type(err).__name__}: {err}"
+    return record
+
+
+class SurveyReport:
+    # Accumulates the per-file records into the dataset-wide statistics.
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.total_files = 0
+        self.signature_groups = defaultdict(list)
+        self.keyword_frequencies = Counter()
+        self.keyword_file_counts = Counter()
+        self.elements = {}
+        self.element_counts = Counter()
+        self.column_count_mismatches = []
+        self.errors = []
+
+    def add(self, record):
+        filename = os.path.relpath(record["file"], self.directory)
+        self.total_files += 1
+        if record["error"] is not None:
+            self.errors.append({"file": filename, "error": record["error"]})
+
+        columns = record["columns"]
+        if columns is not None:
+            # Files whose columns cannot be parsed are only listed in errors.
+            self.signature_groups[tuple(columns)].append(filename)
+            self.keyword_file_counts.update(set(columns))
+
+        # Same selection as file_handler.count_unique_words().
+        device_free_columns = set(record["device_free_columns"])
+        if "Mono Energy" in device_free_columns and record["data_columns"] > 0:
+            self.keyword_frequencies.update(device_free_columns)
+
+        if record["data_columns"] and record["data_columns"] != len(columns):
+            self.column_count_mismatches.append(
+                {
+                    "file": filename,
+                    "columns": len(columns),
+                    "data_columns": record["data_columns"],
+                }
+            )
+
+        self.elements[filename] = {"symbol": record["element"], "edge": record["edge"]}
+        if record["element"] is None:
+            self.element_counts["unassigned"] += 1
+        else:
+            self.element_counts[f"{record['element']} {record['edge']}"] += 1
+
+    def to_dict(self):
+        signature_groups = sorted(
+            self.signature_groups.items(), key=lambda item: len(item[1]), reverse=True
+        )
+        return {
+            "directory": str(self.directory),
+            "total_files": self.total_files,
+            "column_signature_groups": [
+                {
+                    "signature": signature_hash(columns),
+                    "columns": list(columns),
+                    "files": sorted(files),
+                }
+                for columns, files in signature_groups
+            ],
+            "keyword_frequencies": dict(self.keyword_frequencies.most_common()),
+            "keyword_file_counts": dict(self.keyword_file_counts.most_common()),
+            "element_counts": dict(self.element_counts.most_common()),
+            "elements": dict(sorted(self.elements.items())),
+            "column_count_mismatches": sorted(
+                self.column_count_mismatches, key=lambda item: item["file"]
+            ),
+            "errors": sorted(self.errors, key=lambda item: item["file"]),
+        }
+
+
+def survey(directory, workers=None, chunksize=16):
+    # Walks the dataset once and spreads the parsing over a pool of processes.
+    filepaths = (
+        dirpath / (stem + suffix)
+        for dirpath, stem, suffix, _ in walk_scan_files(directory, stat=False)
+    )
+    report = SurveyReport(directory)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for record in executor.map(survey_file, filepaths, chunksize=chunksize):
+            report.add(record)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory", help="Root directory of the LabVIEW files.")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs).",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="files/survey_report.json",
+        help="Path of the JSON report.",
+    )
+    args = parser.parse_args(argv)
+
+    print("Surveying...")
+    report = survey(args.directory, args.workers)
+    with open(args.output, "w") as file:
+        json.dump(report.to_dict(), file, indent=2)
+    print("Done!!")
+
+
+if __name__ == "__main__":
+    main()
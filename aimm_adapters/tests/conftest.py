@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# Keep the persistent caches of the test runs out of the user cache directory.
+# This must happen before aimm_adapters.caching is imported.
+os.environ["AIMM_ADAPTERS_CACHE"] = tempfile.mkdtemp(prefix="aimm_adapters_cache_")
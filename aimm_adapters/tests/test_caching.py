@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+import pandas as pd
+
+from ..caching import FrameStore, NegativeCache, SingleFlight, frame_nbytes
+
+
+def test_frame_store_eviction_and_spill(tmp_path):
+    frames = {
+        name: pd.DataFrame({"energy": [float(i) for i in range(100)]}) for name in "abc"
+    }
+    nbytes = frame_nbytes(frames["a"])
+    store = FrameStore(max_bytes=2 * nbytes, spill_directory=tmp_path)
+
+    for name, df in frames.items():
+        store.put(name, df)
+    usage = store.usage
+    assert usage["bytes"] == 2 * nbytes
+    assert usage["evictions"] == 1
+    assert usage["spilled_frames"] == 1
+
+    # The least recently used frame comes back from its spill file.
+    assert store.get("a").equals(frames["a"])
+    usage = store.usage
+    assert usage["spill_loads"] == 1
+    assert usage["bytes"] <= 2 * nbytes
+    assert store.get("missing") is None
+    assert store.usage["misses"] == 1
+
+    store.clear()
+    assert store.usage["bytes"] == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_single_flight():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow(value):
+        calls.append(value)
+        started.set()
+        release.wait()
+        if value < 0:
+            raise ValueError(value)
+        return value * 2
+
+    for value, expected in ((21, 42), (-1, ValueError)):
+        calls.clear()
+        started.clear()
+        release.clear()
+        flight = SingleFlight()
+        results = []
+
+        def call():
+            try:
+                results.append(flight.do("key", slow, value))
+            except ValueError as err:
+                results.append(type(err))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=call) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        # Let the followers reach the in-flight call before it completes.
+        while flight.shared < len(followers):
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        assert calls == [value]
+        assert results == [expected] * 5
+
+    # Nothing is remembered once the call returned.
+    release.set()
+    assert flight.do("key", slow, 1) == 2
+    assert flight.calls == 2
+
+
+def test_negative_cache_batches_writes(tmp_path):
+    filename = tmp_path / "negative_cache.json"
+    cache = NegativeCache(filename, flush_delay=60)
+    filepath = tmp_path / "Cu.001"
+    filepath.write_text("")
+    stat = os.stat(filepath)
+    for i in range(100):
+        cache.add(tmp_path / f"Cu.{i:03}", "empty", stat, "complete")
+    # Nothing is written before the flush.
+    assert not filename.exists()
+    cache.save()
+
+    # Entries are kept per reader kind.
+    reloaded = NegativeCache(filename)
+    assert len(reloaded) == 100 and filepath in reloaded
+    assert reloaded.reason(filepath, stat, "complete") == "empty"
+    assert reloaded.reason(filepath, stat, "raw") is None
+
+    cache = NegativeCache(filename, flush_delay=0.05)
+    cache.discard(filepath)
+    deadline = time.monotonic() + 5
+    while filepath in NegativeCache(filename) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(NegativeCache(filename)) == 99
+
+
+def test_negative_cache_save_errors(tmp_path, caplog):
+    # The cache directory cannot be created where a file is.
+    (tmp_path / "cache").write_text("")
+    cache = NegativeCache(tmp_path / "cache" / "negative_cache.json")
+    filepath = tmp_path / "Cu.001"
+    filepath.write_text("")
+    cache.add(filepath, "empty", os.stat(filepath), "raw")
+    cache.save()
+    assert "Could not save the negative cache" in caplog.text
+    assert filepath in cache
+
+    # A memory-only cache picks up the saved entries once persisted.
+    filename = tmp_path / "negative_cache.json"
+    cache.persist(filename)
+    cache.save()
+    cache = NegativeCache()
+    cache.add(tmp_path / "Cu.002", "empty", os.stat(filepath), "raw")
+    cache.persist(filename)
+    assert len(cache) == 2
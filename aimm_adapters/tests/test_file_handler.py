@@ -0,0 +1,45 @@
+import io
+import json
+
+from ..scripts.file_handler import iter_dictionary_read, write_tree_report
+
+TREE = {
+    "Cu": {
+        "Cu_foil.001": {("Mono Energy", "I0"): 2},
+        "empty": {},
+    },
+    "Fe.001": "unreadable",
+}
+
+
+def test_write_tree_report_text():
+    buffer = io.StringIO()
+    write_tree_report(TREE, buffer)
+    # The indented format of the *_file_tree.txt files.
+    assert buffer.getvalue() == (
+        "|-- Cu:\n"
+        "    |-- Cu_foil.001:\n"
+        "        |-- ('Mono Energy', 'I0'):2\n"
+        "    |-- empty:\n"
+        "|-- Fe.001:unreadable\n"
+    )
+    assert iter_dictionary_read(TREE, 0, "") == buffer.getvalue()
+    assert iter_dictionary_read(TREE["Cu"], 1, "start\n") == (
+        "start\n"
+        "    |-- Cu_foil.001:\n"
+        "        |-- ('Mono Energy', 'I0'):2\n"
+        "    |-- empty:\n"
+    )
+
+
+def test_write_tree_report_jsonl():
+    buffer = io.StringIO()
+    write_tree_report(TREE, buffer, report_format="jsonl")
+    records = [json.loads(line) for line in buffer.getvalue().splitlines()]
+    assert records == [
+        {"level": 0, "path": ["Cu"]},
+        {"level": 1, "path": ["Cu", "Cu_foil.001"]},
+        {"level": 2, "path": ["Cu", "Cu_foil.001", ["Mono Energy", "I0"]], "value": 2},
+        {"level": 1, "path": ["Cu", "empty"]},
+        {"level": 0, "path": ["Fe.001"], "value": "unreadable"},
+    ]
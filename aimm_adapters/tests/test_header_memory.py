@@ -0,0 +1,24 @@
+import numpy as np
+
+from ..scripts.header_memory import measure
+from .test_heald import spectrum_content
+
+HEADER = """# LabVIEW Control Panel; File: {name}
+# Mono Info:
+# Mono: Si(111); d-spacing: 3.1356; Offset: 12.5
+# Motor Positions:
+# sample_x: 12.34  sample_y: -1.5 mm  theta: 0.2
+#"""
+
+
+def test_header_memory(tmp_path):
+    energy = np.linspace(8950, 9050, 5)
+    for i in range(50):
+        name = f"Cu.{i:03}"
+        (tmp_path / name).write_text(
+            spectrum_content(energy, {"I0": np.ones(5)}, HEADER.format(name=name))
+        )
+
+    result = measure(tmp_path)
+    assert result["files"] == result["parsed"] == 50
+    assert 0 < result["shared"] < result["unshared"]
@@ -1,10 +1,65 @@
+import asyncio
+import copy
+import json
+import os
+import threading
+import time
+import warnings
+from collections import Counter
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 import pytest
 from tiled.adapters.mapping import MapAdapter
 from tiled.client import from_tree
 
-from ..heald_labview import HealdLabViewTree
+from .. import heald_labview
+from ..caching import CACHE_DIRECTORY, NegativeCache, TreeSnapshot
+from ..heald_labview import (
+    LIVE_REQUESTS,
+    MERGED_KEY,
+    NEGATIVE_CACHE,
+    STACKED_KEY,
+    CacheWarmer,
+    FrozenList,
+    HealdLabViewTree,
+    LabViewTail,
+    LazyDirectoryMapping,
+    TreeRefresher,
+    can_merge,
+    derive_absorption,
+    iter_subdirectory,
+    lazy_tree,
+    merge_scans,
+    normalize_edges,
+    normalized_node,
+    normalized_subdirectory_handler,
+    quality_metrics,
+    raw_node,
+    share_sections,
+    split_sweeps,
+    subdirectory_handler,
+    sweep_index,
+    walk_scan_files,
+)
+
+
+def scan_content():
+    here = Path(__file__).parent
+    content = (here / ".." / "files" / "test_data.01").read_text()
+    return content.rstrip("\n") + "\n"
+
+
+def spectrum_content(energy, columns, header=""):
+    # LabVIEW scan with a Mono Energy column and the given {name: values}.
+    lines = ["# User Comment:", "# Cu foil", "#"]
+    lines.extend(header.splitlines())
+    lines.append("# Column Headings:")
+    lines.append("#" + "      ".join(["Mono Energy"] + list(columns)))
+    for row in zip(energy, *columns.values()):
+        lines.append("   ".join(f"{value:.6f}" for value in row))
+    return "\n".join(lines) + "\n"
 
 
 @pytest.mark.parametrize(
@@ -18,3 +73,772 @@ def test_heald_labview(filename, expected_size):
     client = from_tree(tree)
     arr = client["A"][filename].read()
     assert arr.shape == expected_size
+
+
+def test_walk_scan_files(tmp_path):
+    content = scan_content()
+    (tmp_path / "sub" / "deeper").mkdir(parents=True)
+    (tmp_path / "empty").mkdir()
+    (tmp_path / "alpha").mkdir()
+    for name in ["Zn.001", "Cu.002", "Cu.001", ".hidden.001", "notes.txt"]:
+        (tmp_path / name).write_text(content)
+    (tmp_path / "sub" / "deeper" / "Fe.001").write_text(content)
+    (tmp_path / "alpha" / "Mg.001").write_text(content)
+
+    # Always in the same order, whatever the filesystem lists first.
+    found = [
+        (str(dirpath.relative_to(tmp_path)), stem, suffix, stat.st_size)
+        for dirpath, stem, suffix, stat in walk_scan_files(tmp_path)
+    ]
+    size = len(content.encode())
+    assert found == [
+        (".", "Cu", ".001", size),
+        (".", "Cu", ".002", size),
+        (".", "Zn", ".001", size),
+        ("alpha", "Mg", ".001", size),
+        (str(Path("sub", "deeper")), "Fe", ".001", size),
+    ]
+
+    mapping = iter_subdirectory({}, tmp_path)
+    assert list(mapping) == ["Cu", "Zn", "alpha", "sub"]
+    assert list(mapping["Cu"]) == ["Cu.001", "Cu.002"]
+    assert list(mapping["sub"]["deeper"]["Fe"]) == ["Fe.001"]
+
+
+def test_lazy_subdirectory_tree(tmp_path):
+    content = scan_content()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "Cu.001").write_text(content)
+    (tmp_path / "Cu.002").write_text("")
+
+    mapping = LazyDirectoryMapping(tmp_path, raw_node)
+    assert mapping._mtime is None  # Nothing is listed before the first access.
+    assert set(mapping) == {"Cu", "sub"}
+    assert list(mapping["Cu"]) == ["Cu.001"]  # The empty scan is left out.
+
+    (tmp_path / "Fe.001").write_text(content)
+    (tmp_path / "Al.001").mkdir()
+    (tmp_path / "Cu.10").write_text(content)
+    (tmp_path / "Cu.2").write_text(content)
+    # Subdirectories and groups by name, the scans of a group by number.
+    assert list(mapping) == ["Al.001", "Cu", "Fe", "sub"]
+    assert list(mapping["Cu"]) == ["Cu.001", "Cu.2", "Cu.10"]
+
+    def refreshers():
+        return [t for t in threading.enumerate() if t.name == "aimm-refresh-tree"]
+
+    running = len(refreshers())
+    client = from_tree(MapAdapter({"A": subdirectory_handler(tmp_path)}))
+    assert client["A"]["Fe"]["Fe.001"].read().shape == (2, 4)
+    assert list(client["A"]["Fe"]) == ["Fe.001"]  # No stacked node by default.
+    # Only the trees asked to poll start a refresh thread.
+    assert len(refreshers()) == running
+
+
+def test_tree_refresh(tmp_path):
+    content = scan_content()
+    (tmp_path / "Cu.001").write_text(content)
+    (tmp_path / "Cu.002").write_text(content)
+
+    mapping = LazyDirectoryMapping(tmp_path, raw_node)
+    refresher = TreeRefresher(mapping, poll_interval=0.1, use_inotify=False)
+    first = mapping["Cu"]["Cu.001"]
+    second = mapping["Cu"]["Cu.002"]
+
+    with open(tmp_path / "Cu.001", "a") as file:
+        file.write("       1.0       2.0       3.0            4.0\n")
+    os.utime(tmp_path / "Cu.001", ns=(0, 0))
+    (tmp_path / "Cu.003").write_text(content)
+    refresher.check()
+
+    # Only the modified file gets a new node.
+    assert mapping["Cu"]["Cu.001"] is not first
+    assert mapping["Cu"]["Cu.001"].read().shape == (3, 4)
+    assert mapping["Cu"]["Cu.002"] is second
+    assert list(mapping["Cu"]) == ["Cu.001", "Cu.002", "Cu.003"]
+
+    (tmp_path / "Cu.002").unlink()
+    refresher.check()
+    assert list(mapping["Cu"]) == ["Cu.001", "Cu.003"]
+
+
+def test_labview_tail(tmp_path):
+    filepath = tmp_path / "Cu.001"
+    content = scan_content()
+    header, first_row, second_row = content.rsplit("\n", 3)[:3]
+    filepath.write_text(header + "\n" + first_row + "\n" + second_row[:12])
+
+    tail = LabViewTail(filepath)
+    df, metadata = tail.update()
+    assert df.shape == (1, 4)
+    assert metadata["columns"] == ["Resistance", "Voltage", "Current", "Capacitance"]
+
+    with open(filepath, "a") as file:
+        file.write(second_row[12:])
+    df, _ = tail.update()  # The unterminated row is complete now.
+    assert df.shape == (2, 4)
+
+    with open(filepath, "a") as file:
+        file.write("\n" + second_row + "\n")
+    df, _ = tail.update()
+    assert df.shape == (3, 4)
+    assert list(df.iloc[2]) == list(df.iloc[1])
+
+    # The frame lives in FRAME_STORE, and is parsed again once evicted.
+    assert not any(isinstance(value, pd.DataFrame) for value in vars(tail).values())
+    assert heald_labview.FRAME_STORE.get(tail.key) is df
+    heald_labview.FRAME_STORE.clear()
+    with open(filepath, "a") as file:
+        file.write(second_row + "\n")
+    assert tail.update()[0].shape == (4, 4)
+
+    # A row that cannot be parsed fails every update until the file is fixed.
+    with open(filepath, "a") as file:
+        file.write("1.0 2.0 n/a 4.0\n")
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            tail.update()
+    filepath.write_text(content)
+    assert tail.update()[0].shape == (2, 4)
+
+
+def test_negative_cache(tmp_path):
+    (tmp_path / "Cu.001").write_text("")
+    (tmp_path / "Cu.002").write_text("# Column Headings:\n#A  B\n")
+    (tmp_path / "Cu.003").write_text(scan_content() + "1.0 2.0 n/a 4.0\n")
+    for name in ["Cu.001", "Cu.002", "Cu.003"]:
+        assert raw_node(tmp_path / name) is None
+
+    stat = os.stat(tmp_path / "Cu.001")
+    assert NEGATIVE_CACHE.reason(tmp_path / "Cu.001", stat, "raw") == "empty"
+    stat = os.stat(tmp_path / "Cu.002")
+    assert NEGATIVE_CACHE.reason(tmp_path / "Cu.002", stat, "raw") == "header-only"
+    stat = os.stat(tmp_path / "Cu.003")
+    assert NEGATIVE_CACHE.reason(tmp_path / "Cu.003", stat, "raw").startswith(
+        "malformed"
+    )
+
+    # The entries are only persisted along with a tree snapshot.
+    NEGATIVE_CACHE.save()
+    assert NEGATIVE_CACHE.filename is None
+    assert not list(CACHE_DIRECTORY.glob("**/negative_cache.json"))
+    subdirectory_handler(tmp_path, snapshot=tmp_path / "snapshots")
+    NEGATIVE_CACHE.save()
+    NEGATIVE_CACHE.persist(None)
+    reloaded = NegativeCache(tmp_path / "snapshots" / "negative_cache.json")
+    assert tmp_path / "Cu.001" in reloaded
+
+    # Entries are dropped once the file changes.
+    (tmp_path / "Cu.001").write_text(scan_content())
+    assert raw_node(tmp_path / "Cu.001") is not None
+    assert tmp_path / "Cu.001" not in NEGATIVE_CACHE
+
+
+def test_concurrent_builds_parse_once(tmp_path, monkeypatch):
+    filepaths = []
+    for i in range(4):
+        filepath = tmp_path / f"scan_{i}.001"
+        filepath.write_text(scan_content())
+        filepaths.append(filepath)
+
+    parses = Counter()
+    lock = threading.Lock()
+    original = heald_labview.parse_heald_labview
+
+    def counting_parse(file, no_device=False):
+        with lock:
+            parses[no_device] += 1
+        # Keep the parse slow enough for all the threads to pile up on it.
+        time.sleep(0.1)
+        return original(file, no_device)
+
+    monkeypatch.setattr(heald_labview, "parse_heald_labview", counting_parse)
+
+    threads_per_file = 8
+    barrier = threading.Barrier(2 * threads_per_file * len(filepaths))
+    nodes = []
+
+    def request(factory, filepath):
+        barrier.wait()
+        node = factory(filepath)
+        with lock:
+            nodes.append((factory, node))
+
+    threads = [
+        threading.Thread(target=request, args=(factory, filepath))
+        for filepath in filepaths
+        for factory in (raw_node, normalized_node)
+        for _ in range(threads_per_file)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(nodes) == len(threads)
+    # test_data.01 has no energy column, so only the raw tree gets nodes.
+    assert all(node is not None for factory, node in nodes if factory is raw_node)
+    # One parse per file and reader, whatever the number of concurrent requests.
+    assert parses == {False: len(filepaths), True: len(filepaths)}
+
+
+def test_tree_snapshot(tmp_path, monkeypatch):
+    content = scan_content()
+    root = tmp_path / "data"
+    (root / "sub").mkdir(parents=True)
+    (root / "sub" / "Cu.001").write_text(content)
+    (root / "sub" / "Cu.002").write_text(content)
+    (root / "Fe.001").write_text(content)
+    snapshot_file = tmp_path / "snapshot.json"
+
+    snapshot = TreeSnapshot(snapshot_file)
+    tree = lazy_tree(root, raw_node, snapshot=snapshot)
+    client = from_tree(MapAdapter({"A": tree}))
+    expected = client["A"]["sub"]["Cu"]["Cu.002"].read()
+    expected_metadata = dict(client["A"]["sub"]["Cu"]["Cu.002"].metadata)
+    expected_structure = client["A"]["sub"]["Cu"]["Cu.002"].item["attributes"][
+        "structure"
+    ]
+    assert list(client["A"]["Fe"]) == ["Fe.001"]
+    snapshot.save()
+
+    # A restarted server lists and describes the unchanged files from the
+    # snapshot, and only parses a file when its data is read.
+    (root / "Fe.001").write_text(content + "4 4 4 4\n")
+    parses = []
+    original = heald_labview.parse_heald_labview
+
+    def counting_parse(file, no_device=False):
+        parses.append(file)
+        return original(file, no_device)
+
+    heald_labview.FRAME_STORE.clear()
+    heald_labview._FOLLOWED_SCANS.clear()
+    monkeypatch.setattr(heald_labview, "parse_heald_labview", counting_parse)
+    monkeypatch.setattr(heald_labview, "scan_directory", None)  # No relisting.
+    tree = lazy_tree(
+        root,
+        raw_node,
+        poll_interval=0,
+        snapshot=TreeSnapshot(snapshot_file),
+    )
+    client = from_tree(MapAdapter({"A": tree}))
+    node = client["A"]["sub"]["Cu"]["Cu.002"]
+    assert list(client["A"]["sub"]["Cu"]) == ["Cu.001", "Cu.002"]
+    assert dict(node.metadata) == expected_metadata
+    assert node.item["attributes"]["structure"] == expected_structure
+    assert parses == []
+    pd.testing.assert_frame_equal(node.read(), expected)
+    assert len(parses) == 1
+
+    # The modified file is parsed again, in a directory whose listing is reused.
+    assert client["A"]["Fe"]["Fe.001"].read().shape == (3, 4)
+    assert len(parses) == 2
+
+    # The handlers only keep a snapshot when asked to, one per tree.
+    assert subdirectory_handler(root)._mapping.snapshot is None
+    first, second = (
+        subdirectory_handler(root, snapshot=tmp_path / "snapshots") for _ in range(2)
+    )
+    assert first._mapping.snapshot is second._mapping.snapshot
+    assert first._mapping.snapshot in heald_labview._SAVED_AT_EXIT
+    assert NEGATIVE_CACHE.filename.parent == tmp_path / "snapshots"
+    NEGATIVE_CACHE.persist(None)
+
+
+def test_cache_warmer(tmp_path):
+    content = scan_content()
+    for i, (subdirectory, filename) in enumerate(
+        [("a", "Cu.001"), ("b", "Fe.001"), ("a", "Cu.002"), ("a", "Ni.001")]
+    ):
+        filepath = tmp_path / subdirectory / filename
+        filepath.parent.mkdir(exist_ok=True)
+        filepath.write_text("" if filename == "Ni.001" else content)
+        os.utime(filepath, ns=(i * 10**9, i * 10**9))
+
+    root = LazyDirectoryMapping(tmp_path, raw_node)
+    warmer = CacheWarmer(root, subdirectories=["b"], workers=1, idle_time=0.2)
+    names = [scan.stem + scan.suffix for scan in warmer.prioritized_files()]
+    assert names == ["Fe.001", "Ni.001", "Cu.002", "Cu.001"]
+
+    # A live request has just been served, so the warmer waits for its turn.
+    LIVE_REQUESTS.touch()
+    warmer.start()
+    asyncio.run(warmer.served())
+    warmer.join(timeout=10)
+    progress = warmer.progress
+    assert progress["done"]
+    assert progress["pauses"] >= 1
+    assert (progress["warmed"], progress["skipped"], progress["pending"]) == (3, 1, 0)
+
+    # The nodes are kept by the tree, so the first request does not parse.
+    group = root.child_mapping("a").child_mapping("Cu")
+    assert set(group._nodes) == {"Cu.001", "Cu.002"}
+
+
+def test_sibling_prefetch(tmp_path):
+    content = scan_content()
+    for number in (1, 2, 3, 10):
+        (tmp_path / f"Cu.{number}").write_text(content)
+
+    root = LazyDirectoryMapping(tmp_path, raw_node, prefetch_depth=2)
+    group = root.child_mapping("Cu")
+    group["Cu.1"]
+    # The next two scans by number are built in the background.
+    deadline = time.monotonic() + 10
+    while group._prefetching and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert set(group._nodes) == {"Cu.1", "Cu.2", "Cu.3"}
+
+    group["Cu.3"]
+    deadline = time.monotonic() + 10
+    while "Cu.10" not in group._nodes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert set(group._nodes) == {"Cu.1", "Cu.2", "Cu.3", "Cu.10"}
+
+
+def test_stacked_scans(tmp_path):
+    content = scan_content()
+    (tmp_path / "Cu.2").write_text(content + "4 4 4 4\n")
+    (tmp_path / "Cu.10").write_text(content)
+    (tmp_path / "Cu.11").write_text("")
+
+    tree = lazy_tree(tmp_path, raw_node, prefetch=0, stacked=True)
+    client = from_tree(MapAdapter({"A": tree}))
+    assert list(client["A"]["Cu"]) == ["Cu.2", "Cu.10", STACKED_KEY]
+    stacked = client["A"]["Cu"][STACKED_KEY]
+    assert stacked.metadata["scans"] == ["Cu.2", "Cu.10"]
+    df = stacked.read()
+    assert list(df.columns[:2]) == ["scan", "point"]
+    assert df["scan"].tolist() == [2, 2, 2, 10, 10]
+    assert df["point"].tolist() == [0, 1, 2, 0, 1]
+    expected = client["A"]["Cu"]["Cu.10"].read()
+    pd.testing.assert_frame_equal(
+        df[df["scan"] == 10].drop(columns=["scan", "point"]).reset_index(drop=True),
+        expected,
+    )
+
+
+def test_merge_scans():
+    energies = [np.linspace(8950, 9050, 21), np.linspace(8940, 9040, 41)[::-1]]
+    frames = [
+        pd.DataFrame({"energy": energy, "mu": energy / 1000 + offset})
+        for energy, offset in zip(energies, (0.0, 0.2))
+    ]
+    merged = merge_scans(frames, step=5)
+    assert merged["energy"].tolist() == list(np.arange(8950, 9041, 5.0))
+    np.testing.assert_allclose(merged["mu"], merged["energy"] / 1000 + 0.1)
+    np.testing.assert_allclose(merged["mu_std"], 0.1)
+    assert (merged["scans"] == 2).all()
+
+    # On a given grid, each point only averages the scans that cover it.
+    merged = merge_scans(frames, grid=[8945.0, 9000.0])
+    assert merged["scans"].tolist() == [1, 2]
+    np.testing.assert_allclose(merged["mu"], [8.945 + 0.2, 9.1])
+
+    with pytest.raises(ValueError):
+        merge_scans([frames[0], frames[0].assign(energy=frames[0]["energy"] + 500)])
+
+
+def test_merged_node(tmp_path):
+    energy = np.linspace(8950, 9050, 11)
+    for number, i0 in ((1, 1.0), (2, 3.0)):
+        (tmp_path / f"Cu.00{number}").write_text(
+            spectrum_content(energy, {"I0": np.full(11, i0), "IT": energy / 1e4})
+        )
+
+    tree = normalized_subdirectory_handler(tmp_path)
+    assert MERGED_KEY not in from_tree(MapAdapter({"A": tree}))["A"]["Cu"]
+
+    tree = normalized_subdirectory_handler(
+        tmp_path, poll_interval=0, snapshot=False, merged=True
+    )
+    client = from_tree(MapAdapter({"A": tree}))
+    assert MERGED_KEY in client["A"]["Cu"]
+    merged = client["A"]["Cu"][MERGED_KEY]
+    assert merged.metadata["scans"] == ["Cu.001", "Cu.002"]
+    df = merged.read()
+    np.testing.assert_allclose(df["energy"], energy)
+    np.testing.assert_allclose(df["i0"], 2.0)
+    np.testing.assert_allclose(df["i0_std"], 1.0)
+
+    # The merged node is kept until a scan of the group changes.
+    group = tree._mapping.child_mapping("Cu")
+    assert group[MERGED_KEY] is group[MERGED_KEY]
+    (tmp_path / "Cu.002").write_text(
+        spectrum_content(energy, {"I0": np.full(11, 5.0), "IT": energy / 1e4})
+    )
+    group.refresh()
+    np.testing.assert_allclose(group[MERGED_KEY].read()["i0"], 3.0)
+
+    # Raw trees have no energy column, so no merged node.
+    raw = from_tree(MapAdapter({"A": lazy_tree(tmp_path, raw_node, poll_interval=0)}))
+    assert MERGED_KEY not in raw["A"]["Cu"]
+
+
+def test_unmergeable_groups(tmp_path):
+    # Scans without a common energy range, or with a single point, are still
+    # served, just without a merged node.
+    for number, start in ((1, 8950), (2, 7050)):
+        energy = np.linspace(start, start + 100, 11)
+        (tmp_path / f"Cu.00{number}").write_text(
+            spectrum_content(energy, {"I0": np.ones(11), "IT": np.full(11, 0.5)})
+        )
+    (tmp_path / "Fe.001").write_text(
+        spectrum_content([7112.0], {"I0": [1.0], "IT": [0.5]})
+    )
+    tree = normalized_subdirectory_handler(tmp_path, merged=True)
+    client = from_tree(MapAdapter({"A": tree}))
+    for stem, filenames in (("Cu", ["Cu.001", "Cu.002"]), ("Fe", ["Fe.001"])):
+        # Listing does not read the scans, so only the request finds out.
+        assert list(client["A"][stem]) == filenames + [MERGED_KEY]
+        with pytest.raises(KeyError):
+            client["A"][stem][MERGED_KEY]
+        assert list(client["A"][stem]) == filenames
+        assert len(list(client["A"][stem].items())) == len(filenames)
+
+
+def test_merged_node_cold_start(tmp_path, monkeypatch):
+    # Groups restored from a snapshot list their merged node without parsing.
+    energy = np.linspace(8950, 9050, 11)
+    for number in (1, 2):
+        (tmp_path / f"Cu.00{number}").write_text(
+            spectrum_content(energy, {"I0": np.ones(11), "IT": np.full(11, 0.5)})
+        )
+    snapshot_file = tmp_path / "snapshot.json"
+    snapshot = TreeSnapshot(snapshot_file)
+    tree = lazy_tree(tmp_path, normalized_node, snapshot=snapshot, merged=True)
+    assert MERGED_KEY in tree._mapping.child_mapping("Cu")
+    snapshot.save()
+
+    parses = []
+    original = heald_labview.parse_heald_labview
+
+    def counting_parse(file, no_device=False):
+        parses.append(file)
+        return original(file, no_device)
+
+    heald_labview.FRAME_STORE.clear()
+    monkeypatch.setattr(heald_labview, "parse_heald_labview", counting_parse)
+    tree = lazy_tree(
+        tmp_path,
+        normalized_node,
+        poll_interval=0,
+        snapshot=TreeSnapshot(snapshot_file),
+        merged=True,
+    )
+    group = tree._mapping.child_mapping("Cu")
+    assert list(group) == ["Cu.001", "Cu.002", MERGED_KEY]
+    assert parses == []
+    np.testing.assert_allclose(group[MERGED_KEY].read()["i0"], 1.0)
+    assert len(parses) == 2
+
+
+def test_derived_columns(tmp_path):
+    energy = np.linspace(8950, 9050, 5)
+    (tmp_path / "Cu.001").write_text(
+        spectrum_content(
+            energy,
+            {
+                "I0": [2.0, 2.0, 0.0, 2.0, 2.0],
+                "IT": [1.0, 0.0, 1.0, -1.0, 1.0],
+                "IR": [0.5, 0.5, 0.5, 0.5, 0.0],
+            },
+        )
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        node = normalized_node(tmp_path / "Cu.001")
+        df = node.read()
+    assert node.metadata["Derived"] == {
+        "mutrans": "ln(i0/itrans)",
+        "murefer": "ln(itrans/irefer)",
+    }
+    np.testing.assert_allclose(
+        df["mutrans"], [np.log(2), np.nan, np.nan, np.nan, np.log(2)]
+    )
+    np.testing.assert_allclose(
+        df["murefer"], [np.log(2), np.nan, np.log(2), np.nan, np.nan]
+    )
+
+    # The derived columns are rebuilt once the frame is gone from the store.
+    heald_labview.FRAME_STORE.clear()
+    np.testing.assert_allclose(node.read()["mutrans"], df["mutrans"])
+
+    # Fluorescence is a plain ratio, negative after an offset subtraction.
+    fluorescence = pd.DataFrame({"i0": [2.0, 2.0, 0.0], "ifluor": [1.0, -1.0, 1.0]})
+    np.testing.assert_allclose(
+        derive_absorption(fluorescence)["mufluor"], [0.5, -0.5, np.nan]
+    )
+
+
+def test_normalize_edges(tmp_path):
+    # Pre-edge line, post-edge quadratic and a step of 1.5 at 8979 eV.
+    energies = [
+        np.linspace(8800, 9400, 601),
+        np.linspace(9300, 8850, 300),
+        np.linspace(8990, 9010, 5),
+    ]
+    mus = []
+    for energy in energies:
+        x = (energy - 8979) / 1000
+        post = (1.5 + 0.3 * x - 0.5 * x**2) * (energy > 8979)
+        mus.append(0.1 + 0.2 * x + post)
+    result = normalize_edges(energies, mus, e0=[8979, 8979, 8979])
+    np.testing.assert_allclose(result["edge_step"][:2], 1.5)
+    np.testing.assert_allclose(result["pre_edge"][:2], [[0.1, 0.2]] * 2, atol=1e-9)
+    np.testing.assert_allclose(
+        result["post_edge"][:2], [[1.6, 0.5, -0.5]] * 2, atol=1e-9
+    )
+    assert [len(norm) for norm in result["norm"]] == [601, 300, 5]
+    # The normalized spectrum is the post-edge part over the edge step.
+    x = (energies[1] - 8979) / 1000
+    expected = np.where(energies[1] > 8979, (1.5 + 0.3 * x - 0.5 * x**2) / 1.5, 0)
+    np.testing.assert_allclose(result["norm"][1], expected, atol=1e-9)
+    # Too few points for the fits.
+    assert np.isnan(result["edge_step"][2]) and np.isnan(result["norm"][2]).all()
+
+    # Without e0, the edge is found at the largest derivative.
+    result = normalize_edges(energies[:2], mus[:2])
+    assert (np.abs(result["e0"] - 8979) < 2).all()
+
+    # Normalized nodes carry the normalized spectrum and the fit results.
+    (tmp_path / "Cu.001").write_text(
+        spectrum_content(energies[0], {"I0": np.ones(601), "IT": np.exp(-mus[0])})
+    )
+    node = normalized_node(tmp_path / "Cu.001")
+    edge = node.metadata["Edge"]
+    assert edge["mode"] == "transmission"
+    assert abs(edge["e0"] - 8979) < 2
+    assert abs(edge["edge_step"] - 1.5) < 0.05
+    assert "norm" in node.read()
+
+
+def test_quality_control(tmp_path):
+    rng = np.random.default_rng(0)
+    energy = np.arange(8900.0, 9101.0)
+    mu = 1 / (1 + np.exp(-(energy - 9000) / 3)) + rng.normal(0, 0.001, len(energy))
+    glitched = mu.copy()
+    glitched[[50, 150, 151]] += 0.05
+    # Two points recorded out of order.
+    swapped = energy.copy()
+    swapped[[100, 101]] = swapped[[101, 100]]
+    swapped_mu = mu.copy()
+    swapped_mu[[100, 101]] = swapped_mu[[101, 100]]
+    metrics = quality_metrics([energy, swapped], [glitched, swapped_mu])
+    assert metrics["spikes"].tolist() == [3, 0]
+    assert np.flatnonzero(metrics["glitches"][0]).tolist() == [50, 150, 151]
+    assert metrics["backsteps"].tolist() == [0, 1]
+    assert metrics["monotonic"].tolist() == [True, False]
+    np.testing.assert_allclose(metrics["points_per_ev"], 1.0)
+    assert (0.0005 < metrics["noise"]).all() and (metrics["noise"] < 0.002).all()
+
+    (tmp_path / "Cu.001").write_text(
+        spectrum_content(energy, {"I0": np.ones(len(energy)), "IT": np.exp(-glitched)})
+    )
+    node = normalized_node(tmp_path / "Cu.001")
+    qc = node.metadata["QC"]
+    assert qc["spikes"] == 3 and qc["monotonic"] and not qc["masked"]
+    df = node.read()
+    assert np.flatnonzero(df["glitch"]).tolist() == [50, 150, 151]
+    assert np.isfinite(df["mutrans"]).all()
+
+    # Masked trees leave the glitches out of the derived columns.
+    tree = normalized_subdirectory_handler(
+        tmp_path, poll_interval=0, snapshot=False, mask_glitches=True
+    )
+    client = from_tree(MapAdapter({"A": tree}))
+    node = client["A"]["Cu"]["Cu.001"]
+    assert node.metadata["QC"]["masked"]
+    df = node.read()
+    assert np.flatnonzero(np.isnan(df["mutrans"])).tolist() == [50, 150, 151]
+
+
+def test_white_line_is_not_a_glitch():
+    # A sharp but smooth peak stands out of its running median as much as a
+    # glitch does, but not out of the spread of its window.
+    energy = np.arange(8950.0, 9100.0, 0.5)
+    white_line = 0.8 * np.exp(-((energy - 8995) ** 2) / (2 * 1.2**2))
+    noisy = white_line + np.random.default_rng(0).normal(0, 1e-3, len(energy))
+    glitched = noisy.copy()
+    glitched[200] += 0.05
+    metrics = quality_metrics([energy] * 3, [white_line, noisy, glitched])
+    assert metrics["spikes"].tolist() == [0, 0, 1]
+    assert np.flatnonzero(metrics["glitches"][2]).tolist() == [200]
+
+
+def test_sweeps(tmp_path):
+    up = np.arange(8950.0, 9051.0, 10)
+    # Up, down with a repeated energy, then up again with a jitter step.
+    energy = np.concatenate([up, up[::-1][1:], [8950.0], up[1:]])
+    energy[-4] = energy[-5] - 1
+    expected = np.repeat([0, 1, 2], [11, 11, 10])
+    np.testing.assert_array_equal(sweep_index(energy), expected)
+    np.testing.assert_array_equal(sweep_index(up), 0)
+    np.testing.assert_array_equal(sweep_index([9000.0, 9000.0]), 0)
+
+    (tmp_path / "Cu.001").write_text(
+        spectrum_content(energy, {"I0": np.ones(len(energy)), "IT": 0.5 + energy / 1e5})
+    )
+    node = normalized_node(tmp_path / "Cu.001")
+    assert node.metadata["Sweeps"] == 3
+    df = node.read()
+    np.testing.assert_array_equal(df["sweep"], expected)
+    sweeps = split_sweeps(df)
+    assert [len(sweep) for sweep in sweeps] == [11, 11, 10]
+    assert np.shares_memory(sweeps[1]["energy"].to_numpy(), df["energy"].to_numpy())
+
+    # Merging treats every sweep as a scan.
+    merged = merge_scans([df], columns=["itrans"], grid=up)
+    np.testing.assert_allclose(merged["itrans"], 0.5 + up / 1e5)
+    assert merged["scans"].tolist() == [2] + [3] * 9 + [2]
+
+
+def test_backlash_is_not_a_sweep(tmp_path):
+    # The first step goes down to take up the backlash of the monochromator.
+    energy = np.concatenate([[9000.0, 8999.0], np.arange(9001.0, 9200.0)])
+    np.testing.assert_array_equal(sweep_index(energy), 0)
+    for number in (1, 2):
+        (tmp_path / f"Cu.00{number}").write_text(
+            spectrum_content(
+                energy, {"I0": np.ones(len(energy)), "IT": np.full(len(energy), 0.5)}
+            )
+        )
+    frames = [normalized_node(tmp_path / f"Cu.00{number}").read() for number in (1, 2)]
+    assert [len(sweep) for sweep in split_sweeps(frames[0])] == [len(energy)]
+    assert can_merge(frames)
+    merged = merge_scans(frames, columns=["itrans"])
+    np.testing.assert_allclose(merged["itrans"], 0.5)
+
+
+def test_amplifier_gains(tmp_path):
+    header = "# Amplifier Sensitivities:\n# I0: 2 nA/V  IT: 1 uA/V  IF: low\n#"
+    energy = np.linspace(8950, 9050, 11)
+    content = spectrum_content(
+        energy, {"I0": np.full(11, 1000.0), "IT": np.full(11, 10.0)}, header
+    )
+    nodes = []
+    for number in (1, 2):
+        (tmp_path / f"Cu.00{number}").write_text(content)
+        nodes.append(raw_node(tmp_path / f"Cu.00{number}"))
+    # Files with the same settings share the parsed sensitivities.
+    node = nodes[1]
+    assert (
+        nodes[0].metadata["amplifier_sensitivity_values"]
+        is node.metadata["amplifier_sensitivity_values"]
+    )
+    assert node.metadata["amplifier_sensitivities"]["I0"] == "2 nA/V"
+    assert node.metadata["amplifier_sensitivity_values"] == {
+        "I0": {"value": 2.0, "unit": "nA/V"},
+        "IT": {"value": 1.0, "unit": "uA/V"},
+        "IF": {"value": None, "unit": "low"},
+    }
+
+    # Unscaled by default.
+    df = normalized_node(tmp_path / "Cu.001").read()
+    np.testing.assert_allclose(df["mutrans"], np.log(100))
+
+    tree = normalized_subdirectory_handler(
+        tmp_path, poll_interval=0, snapshot=False, scale_gains=True
+    )
+    node = from_tree(MapAdapter({"A": tree}))["A"]["Cu"]["Cu.001"]
+    assert node.metadata["Gains"] == {"i0": 2e-9, "itrans": 1e-6}
+    df = node.read()
+    np.testing.assert_allclose(df["i0"], 2e-6)
+    np.testing.assert_allclose(df["mutrans"], np.log(100 * 2e-9 / 1e-6))
+
+
+def test_count_rates(tmp_path):
+    energy = np.linspace(8950, 9050, 11)
+    for number, dwell in ((1, 1.0), (2, 2.0)):
+        (tmp_path / f"Cu.00{number}").write_text(
+            spectrum_content(
+                energy,
+                {
+                    "Scaler preset time": np.full(11, dwell),
+                    "I0": 1000 * dwell * np.ones(11),
+                    "IT": 500 * dwell * np.ones(11),
+                },
+            )
+        )
+    node = normalized_node(tmp_path / "Cu.002")
+    assert node.metadata["Rates"] == {
+        "columns": ["i0_rate", "itrans_rate"],
+        "preset_time": "column",
+    }
+    df = node.read()
+    np.testing.assert_allclose(df["i0_rate"], 1000)
+    np.testing.assert_allclose(df["itrans_rate"], 500)
+
+    # Scans with different dwell times merge on their rates.
+    tree = normalized_subdirectory_handler(
+        tmp_path, poll_interval=0, snapshot=False, merged=True
+    )
+    merged = tree._mapping.child_mapping("Cu")[MERGED_KEY].read()
+    np.testing.assert_allclose(merged["i0_rate"], 1000)
+    np.testing.assert_allclose(merged["i0_rate_std"], 0)
+
+    # Preset time from the header, zero counting time gives NaN.
+    header = "# Scan config:\n# Scaler preset time: 0.5 s\n#"
+    (tmp_path / "Cu.003").write_text(
+        spectrum_content(energy, {"I0": np.arange(11.0)}, header)
+    )
+    node = normalized_node(tmp_path / "Cu.003")
+    assert node.metadata["Rates"]["preset_time"] == "header"
+    np.testing.assert_allclose(node.read()["i0_rate"], 2 * np.arange(11.0))
+    (tmp_path / "Cu.004").write_text(
+        spectrum_content(
+            energy, {"Scaler preset time": np.arange(11.0), "I0": np.ones(11)}
+        )
+    )
+    rates = normalized_node(tmp_path / "Cu.004").read()["i0_rate"]
+    assert np.isnan(rates[0]) and rates[10] == 0.1
+
+
+def test_shared_sections(tmp_path):
+    header = "\n".join(
+        [
+            "# LabVIEW Control Panel; File: {name}",
+            "# Scan config:",
+            "# Scaler preset time: 1 s",
+            "#",
+            "# Mono Info:",
+            "# Mono: Si(111); d-spacing: 3.1356",
+            "# Motor Positions:",
+            "# sample_x: 12.34  theta: 0.2",
+            "#",
+        ]
+    )
+    energy = np.linspace(8950, 9050, 5)
+    for name in ("Cu.001", "Fe.001"):
+        (tmp_path / name).write_text(
+            spectrum_content(energy, {"I0": np.ones(5)}, header.format(name=name))
+        )
+    first, second = (
+        raw_node(tmp_path / name).metadata for name in ("Cu.001", "Fe.001")
+    )
+    # Files with the same configuration share their header sections.
+    for key in (
+        "columns",
+        "mono_info",
+        "motor_positions",
+        "motor_position_values",
+        "scan_config",
+    ):
+        assert first[key] is second[key]
+    # The control panel line names the file, it is not kept for sharing.
+    assert second["file"] == ["LabVIEW Control Panel", "File: Fe.001"]
+    assert type(second["file"]) is list
+    with pytest.raises(TypeError):
+        first["mono_info"]["a"] = "b"
+    with pytest.raises(TypeError):
+        first["columns"].append("b")
+    copied = copy.deepcopy(first["mono_info"])
+    copied["a"] = "b"
+    assert type(copied) is dict and "a" not in second["mono_info"]
+
+    # As does metadata restored from JSON, e.g. from a tree snapshot.
+    restored = [share_sections(json.loads(json.dumps(dict(first)))) for _ in range(2)]
+    assert restored[0] == first
+    assert restored[0]["mono_info"] is restored[1]["mono_info"]
+    assert isinstance(restored[0]["columns"], FrozenList)
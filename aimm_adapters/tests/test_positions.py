@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from ..heald_labview import raw_node
+from ..positions import PositionIndex, build_position_index
+from .test_heald import scan_content, spectrum_content
+
+HEADER = """# Motor Positions:
+# sample_x: {x}  sample_y: -1.5 mm
+# theta: 0.2  label: out
+# Slit Info:
+# Hutch H: 1.00 mm; Hutch V = .5
+#"""
+
+
+def write_scan(filepath, x):
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    energy = np.linspace(8950, 9050, 5)
+    filepath.write_text(
+        spectrum_content(energy, {"I0": np.ones(5)}, HEADER.format(x=x))
+    )
+
+
+def test_header_values(tmp_path):
+    write_scan(tmp_path / "Cu.001", 12.34)
+    metadata = raw_node(tmp_path / "Cu.001").metadata
+    assert metadata["motor_position_values"] == {
+        "sample_x": 12.34,
+        "sample_y": -1.5,
+        "theta": 0.2,
+    }
+    assert metadata["slit_info_values"] == {"Hutch H": 1.0, "Hutch V": 0.5}
+    # The raw lines are still there.
+    assert metadata["motor_positions"][1] == "theta: 0.2  label: out"
+
+
+def test_position_index(tmp_path):
+    archive = tmp_path / "archive"
+    write_scan(archive / "Cu.001", 12.34)
+    write_scan(archive / "day2" / "Cu.001", 12.25)
+    write_scan(archive / "day2" / "Cu.002", 15.0)
+    (archive / "other.001").write_text(scan_content())
+
+    output = tmp_path / "positions.parquet"
+    index = build_position_index(archive, output, workers=1)
+    assert index.attrs["parsed"] == 4
+    assert index["file"].tolist() == [
+        "Cu.001",
+        "day2/Cu.001",
+        "day2/Cu.002",
+        "other.001",
+    ]
+    positions = PositionIndex(output)
+    assert positions.near("sample_x", 12.3, 0.1)["file"].tolist() == [
+        "Cu.001",
+        "day2/Cu.001",
+    ]
+    assert positions.near("slit.Hutch V", 0.5, 0)["file"].tolist() == [
+        "Cu.001",
+        "day2/Cu.001",
+        "day2/Cu.002",
+    ]
+    with pytest.raises(KeyError):
+        positions.near("sample_z", 0, 1)
+
+    # Updates only read the files that changed.
+    write_scan(archive / "day2" / "Cu.002", 12.3)
+    index = build_position_index(archive, output, workers=1)
+    assert index.attrs["parsed"] == 1
+    assert len(index) == 4
+    assert PositionIndex(index).near("sample_x", 12.3, 0.1)["file"].tolist() == [
+        "Cu.001",
+        "day2/Cu.001",
+        "day2/Cu.002",
+    ]
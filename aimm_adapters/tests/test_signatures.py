@@ -0,0 +1,36 @@
+import os
+
+from ..scripts.signatures import SignatureIndex, signature_hash
+from .test_heald import scan_content
+
+
+def test_signature_index(tmp_path):
+    archive = tmp_path / "archive"
+    (archive / "day2").mkdir(parents=True)
+    content = scan_content()
+    (archive / "Cu.001").write_text(content)
+    (archive / "day2" / "Cu.001").write_text(content)
+    (archive / "Fe.001").write_text("# Column Headings:\n\n1 2\n")
+
+    index_file = tmp_path / "signatures.json"
+    index = SignatureIndex.load(index_file)
+    assert index.update(archive, workers=1) == []
+    index.save(index_file)
+
+    columns = ["Resistance", "Voltage", "Current", "Capacitance"]
+    signature = signature_hash(columns)
+    index = SignatureIndex.load(index_file)
+    assert index.signatures == {signature: columns}
+    assert index.clusters() == {signature: ["Cu.001", os.path.join("day2", "Cu.001")]}
+    # The unreadable file is not clustered with an empty signature.
+    assert list(index.errors()) == ["Fe.001"]
+    assert index.errors()["Fe.001"].startswith("IndexError")
+
+    # Only real column changes are reported, not files that became readable.
+    (archive / "Cu.001").write_text(content.replace("Voltage", "Potential"))
+    (archive / "Fe.001").write_text(content)
+    changes = index.update(archive, workers=1)
+    assert [change["file"] for change in changes] == ["Cu.001"]
+    assert changes[0]["old"] == signature
+    assert index.errors() == {}
+    assert len(index.signatures) == 2
@@ -0,0 +1,35 @@
+import numpy as np
+
+from ..scripts.survey import survey, survey_file
+from .test_heald import scan_content, spectrum_content
+
+
+def test_survey(tmp_path):
+    energy = np.linspace(8950, 9050, 5)
+    (tmp_path / "day2").mkdir()
+    (tmp_path / "Cu_foil.001").write_text(spectrum_content(energy, {"I0": energy}))
+    (tmp_path / "day2" / "Cu_foil.002").write_text(
+        spectrum_content(energy, {"I0": energy})
+    )
+    (tmp_path / "other.001").write_text(scan_content())
+    (tmp_path / "bad.001").write_text("# Column Headings:\n\n1 2\n")
+
+    report = survey(tmp_path, workers=1).to_dict()
+    assert report["total_files"] == 4
+    groups = report["column_signature_groups"]
+    assert [group["columns"] for group in groups] == [
+        ["Mono Energy", "I0"],
+        ["Resistance", "Voltage", "Current", "Capacitance"],
+    ]
+    assert groups[0]["files"] == ["Cu_foil.001", "day2/Cu_foil.002"]
+    assert report["keyword_frequencies"] == {"Mono Energy": 2, "I0": 2}
+    assert report["element_counts"]["Cu K"] == 2
+    # The unreadable file is reported, not grouped under an empty signature.
+    assert [error["file"] for error in report["errors"]] == ["bad.001"]
+
+
+def test_survey_unreadable_file(tmp_path):
+    # A file removed or unreadable by the time it is read is recorded as failed.
+    record = survey_file(tmp_path / "gone.001")
+    assert record["columns"] is None
+    assert record["error"].startswith("FileNotFoundError")
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from ..heald_labview import lazy_tree, normalized_node
+from ..training import (
+    ExportedSpectra,
+    SpectraLoader,
+    TreeSpectra,
+    benchmark_loader,
+    edge_grid,
+    export_spectra,
+    load_spectra,
+)
+from .test_heald import scan_content, spectrum_content
+
+
+def write_spectrum(filepath, energy, i0=1.0, transmitted=0.5):
+    # Transmission scan whose mu(E) is a step at 9 keV.
+    itrans = np.where(energy < 9000, 0.9, transmitted)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    filepath.write_text(
+        spectrum_content(energy, {"I0": np.full(len(energy), i0), "IT": itrans * i0})
+    )
+
+
+def test_export_spectra(tmp_path):
+    archive = tmp_path / "archive"
+    write_spectrum(archive / "Cu_foil.001", np.linspace(8900, 9200, 301))
+    write_spectrum(archive / "day2" / "Cu_foil.001", np.linspace(8950, 9100, 76), 2.0)
+    (archive / "day2" / "other.001").write_text(scan_content())
+
+    output = tmp_path / "export"
+    metadata = export_spectra(archive, output, window=(-20, 20, 1), workers=1)
+    assert len(metadata) == 2
+    assert metadata.attrs["skipped"] == 1
+    assert set(metadata["group"]) == {"Cu_K"}
+
+    energy, spectra, group_metadata = load_spectra(output, "Cu", "K")
+    assert isinstance(spectra, np.memmap)
+    np.testing.assert_allclose(energy, edge_grid("Cu", "K", (-20, 20, 1)))
+    assert spectra.shape == (2, 41) and spectra.dtype == np.float32
+    assert group_metadata["row"].tolist() == [0, 1]
+    assert (group_metadata["mode"] == "transmission").all()
+    expected = np.log(1 / np.where(energy < 9000, 0.9, 0.5))
+    # Points next to the step are interpolated across it.
+    away = np.abs(energy - 9000) > 2
+    for row in spectra:
+        np.testing.assert_allclose(row[away], expected[away], rtol=1e-5)
+    np.testing.assert_allclose(group_metadata["edge_step"], np.log(0.9 / 0.5))
+    assert (group_metadata["spikes"] == 0).all() and group_metadata["monotonic"].all()
+    assert len(ExportedSpectra(output, query="spikes > 0")) == 0
+
+    # Edge-step normalized export: 0 before the edge and 1 after it.
+    export_spectra(archive, output, (-20, 20, 1), workers=1, edge_normalize=True)
+    _, spectra, _ = load_spectra(output, "Cu", "K")
+    for row in spectra:
+        np.testing.assert_allclose(
+            row[away], (energy[away] > 9000).astype(float), atol=1e-5
+        )
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = tmp_path / "archive"
+    for i in range(7):
+        write_spectrum(
+            archive / f"run{i % 2}" / f"Cu_foil.00{i}",
+            np.linspace(8900, 9100, 101),
+            transmitted=0.5 - 0.05 * i,
+        )
+    (archive / "other.001").write_text(scan_content())
+    return archive
+
+
+def test_loader_over_export(archive, tmp_path):
+    export_spectra(archive, tmp_path / "export", window=(-20, 20, 1), workers=1)
+    source = ExportedSpectra(tmp_path / "export")
+    loader = SpectraLoader(source, batch_size=3, workers=2, prefetch=1, seed=0)
+    assert len(loader) == 3
+
+    epochs = []
+    for _ in range(2):
+        batches = list(loader)
+        assert [
+            len(batch["element"]) for batch in batches if len(batch["element"]) < 3
+        ] == [1]
+        assert all(
+            batch["mu"].shape == (len(batch["element"]), 41) for batch in batches
+        )
+        assert all((batch["element"] == "Cu").all() for batch in batches)
+        # Every spectrum comes once per epoch. They differ by their edge jump.
+        rows = np.concatenate([batch["mu"] for batch in batches])
+        _, spectra, _ = load_spectra(tmp_path / "export", "Cu", "K")
+        np.testing.assert_array_equal(np.sort(rows[:, -1]), np.sort(spectra[:, -1]))
+        epochs.append(rows[:, -1])
+    # A new order for each epoch.
+    assert not np.array_equal(epochs[0], epochs[1])
+
+    # Stopping early does not leave the workers blocked on the queue.
+    for batch in loader:
+        break
+    # Over a whole epoch the order the workers finish in does not matter.
+    result = benchmark_loader(loader)
+    assert (result["batches"], result["spectra"]) == (3, 7)
+    assert benchmark_loader(loader, max_batches=1)["batches"] == 1
+
+
+def test_loader_over_tree(archive):
+    tree = lazy_tree(archive, normalized_node)
+    source = TreeSpectra(tree)
+    assert len(source) == 7
+    loader = SpectraLoader(source, batch_size=4, workers=3, shuffle=False)
+    batches = list(loader)
+    paths = sorted(path for batch in batches for path in batch["path"])
+    assert paths == sorted(f"run{i % 2}/Cu_foil/Cu_foil.00{i}" for i in range(7))
+    batch = batches[0]
+    assert len(batch["energy"][0]) == len(batch["mu"][0]) == 101
+    assert set(np.concatenate([batch["element"] for batch in batches])) == {"Cu"}
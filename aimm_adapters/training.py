@@ -0,0 +1,561 @@
+"""
+Export of the normalized spectra of a LabVIEW archive for model training.
+
+Every scan that normalizes and gets an element/edge assignment is turned into
+mu(E), or its edge-step normalization with --edge-normalize, and resampled on a
+fixed energy grid around its edge. The spectra of each element/edge are written
+as the rows of one float32 matrix in a .npy file, next to its energy grid, and a
+metadata.parquet table maps the rows back to the files, with the edge energy,
+edge step and quality metrics of every spectrum. The matrices can be
+memory-mapped with load_spectra().
+
+SpectraLoader then serves shuffled mini-batches to a training job, either from
+an export (ExportedSpectra) or straight from a tiled tree (TreeSpectra). Run the
+export, or measure the throughput of the loader, like this:
+
+python -m aimm_adapters.training export path/to/files path/to/export --workers 8
+python -m aimm_adapters.training benchmark path/to/export --batch-size 64
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xraydb
+
+from .heald_labview import (
+    MERGED_KEY,
+    STACKED_KEY,
+    absorption,
+    interpolate_scans,
+    lazy_tree,
+    normalize_dataframe,
+    normalize_edges,
+    normalized_node,
+    parse_element_name,
+    parse_heald_labview,
+    quality_metrics,
+    walk_scan_files,
+)
+
+# Energy grid of the exported spectra, as (start, stop, step) in eV relative to
+# the edge energy.
+DEFAULT_WINDOW = (-50.0, 150.0, 0.5)
+
+
+def group_name(element, edge):
+    return f"{element}_{edge}"
+
+
+def edge_grid(element, edge, window=DEFAULT_WINDOW):
+    start, stop, step = window
+    edge_energy = xraydb.xray_edge(element, edge).energy
+    return edge_energy + start + step * np.arange(int(round((stop - start) / step)) + 1)
+
+
+def read_spectrum(filepath):
+    # (element, edge, energy, mu, mode) of one scan, or None if the scan does not
+    # normalize or has no element, edge or absorption.
+    with open(filepath) as file:
+        df, metadata = parse_heald_labview(file, no_device=True)
+    norm_df, _ = normalize_dataframe(df)
+    if norm_df is None or len(norm_df) < 2:
+        return None
+    element, edge = parse_element_name(Path(filepath), norm_df, metadata)
+    if element is None:
+        return None
+    mu, mode = absorption(norm_df)
+    if mu is None:
+        return None
+    return element, edge, norm_df["energy"].to_numpy(dtype=float), mu, mode
+
+
+def export_chunk(filepaths, window=DEFAULT_WINDOW, edge_normalize=False):
+    # Runs in the worker processes. Reads a chunk of files, then computes the
+    # quality metrics and fits the edge step of the spectra of each element/edge
+    # with single quality_metrics() and normalize_edges() calls, and resamples
+    # them with a single interpolate_scans() call, using the normalized spectra
+    # if edge_normalize. Returns (element, edge, records, rows) tuples and the
+    # number of skipped files.
+    groups = defaultdict(list)
+    skipped = 0
+    for filepath in filepaths:
+        try:
+            spectrum = read_spectrum(filepath)
+        except (IndexError, KeyError, ValueError, OSError):
+            spectrum = None
+        if spectrum is None:
+            skipped += 1
+            continue
+        element, edge, energy, mu, mode = spectrum
+        groups[element, edge].append((filepath, energy, mu, mode))
+
+    results = []
+    for (element, edge), members in groups.items():
+        grid = edge_grid(element, edge, window)
+        energies = [energy for _, energy, _, _ in members]
+        mus = [mu for _, _, mu, _ in members]
+        qc = quality_metrics(energies, mus)
+        edges = normalize_edges(energies, mus)
+        spectra = edges["norm"] if edge_normalize else mus
+        rows = interpolate_scans(energies, [mu[:, np.newaxis] for mu in spectra], grid)[
+            :, :, 0
+        ].astype(np.float32)
+        records = [
+            {
+                "file": str(filepath),
+                "element": element,
+                "edge": edge,
+                "mode": mode,
+                "points": len(energy),
+                "coverage": float(np.isfinite(row).mean()),
+                "e0": edges["e0"][i],
+                "edge_step": edges["edge_step"][i],
+                "noise": qc["noise"][i],
+                "spikes": qc["spikes"][i],
+                "monotonic": qc["monotonic"][i],
+            }
+            for i, ((filepath, energy, _, mode), row) in enumerate(zip(members, rows))
+        ]
+        results.append((element, edge, records, rows))
+    return results, skipped
+
+
+class MatrixWriter:
+    # Appends float32 rows to a .npy file whose number of rows is only known at
+    # the end. The rows go to a raw part file, which close() turns into the .npy.
+
+    def __init__(self, filename, columns):
+        self.filename = Path(filename)
+        self.columns = columns
+        self.rows = 0
+        self._part = open(self.filename.with_suffix(".part"), "wb")
+
+    def append(self, rows):
+        self._part.write(np.ascontiguousarray(rows, dtype="<f4").tobytes())
+        self.rows += len(rows)
+
+    def close(self):
+        self._part.close()
+        header = {
+            "descr": np.lib.format.dtype_to_descr(np.dtype("<f4")),
+            "fortran_order": False,
+            "shape": (self.rows, self.columns),
+        }
+        with open(self.filename, "wb") as file:
+            np.lib.format.write_array_header_1_0(file, header)
+            with open(self._part.name, "rb") as part:
+                while True:
+                    block = part.read(1 << 24)
+                    if not block:
+                        break
+                    file.write(block)
+        os.remove(self._part.name)
+
+
+def export_spectra(
+    directory,
+    output,
+    window=DEFAULT_WINDOW,
+    workers=None,
+    chunksize=64,
+    edge_normalize=False,
+):
+    # Exports the spectra found below directory into the output directory, see
+    # the module docstring. The rows hold the edge-step normalized spectra if
+    # edge_normalize. Returns the metadata table.
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    filepaths = [
+        dirpath / (stem + suffix)
+        for dirpath, stem, suffix, _ in walk_scan_files(directory, stat=False)
+    ]
+    chunks = []
+    for start in range(0, len(filepaths), chunksize):
+        stop = start + chunksize
+        chunks.append(filepaths[start:stop])
+
+    writers = {}
+    records = []
+    skipped = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for results, chunk_skipped in executor.map(
+            export_chunk, chunks, repeat(window), repeat(edge_normalize)
+        ):
+            skipped += chunk_skipped
+            for element, edge, chunk_records, rows in results:
+                name = group_name(element, edge)
+                if name not in writers:
+                    grid = edge_grid(element, edge, window)
+                    np.save(output / f"{name}_energy.npy", grid)
+                    writers[name] = MatrixWriter(output / f"{name}.npy", len(grid))
+                writer = writers[name]
+                for row, record in enumerate(chunk_records, start=writer.rows):
+                    record["group"] = name
+                    record["row"] = row
+                writer.append(rows)
+                records.extend(chunk_records)
+    for writer in writers.values():
+        writer.close()
+
+    columns = [
+        "file",
+        "group",
+        "row",
+        "element",
+        "edge",
+        "mode",
+        "points",
+        "coverage",
+        "e0",
+        "edge_step",
+        "noise",
+        "spikes",
+        "monotonic",
+    ]
+    metadata = pd.DataFrame(records, columns=columns)
+    metadata.to_parquet(output / "metadata.parquet", index=False)
+    metadata.attrs["skipped"] = skipped
+    return metadata
+
+
+def load_spectra(output, element, edge, mmap_mode="r"):
+    # (energy grid, spectra matrix, metadata) of one element/edge of an export.
+    # The matrix is memory-mapped unless mmap_mode is None.
+    output = Path(output)
+    name = group_name(element, edge)
+    energy = np.load(output / f"{name}_energy.npy")
+    spectra = np.load(output / f"{name}.npy", mmap_mode=mmap_mode)
+    metadata = pd.read_parquet(output / "metadata.parquet")
+    metadata = metadata[metadata["group"] == name].sort_values("row")
+    return energy, spectra, metadata.reset_index(drop=True)
+
+
+class ExportedSpectra:
+    """
+    Spectra source over the memory-mapped matrices of an export.
+
+    Parameters
+    ----------
+    output : str or Path
+        Directory written by export_spectra().
+    groups : list of str, optional
+        Element/edge groups to use, e.g. ["Cu_K"]. All of them by default. The
+        groups must share the same grid length, as with a single export window.
+    query : str, optional
+        Selects the spectra with DataFrame.query() on the metadata table, e.g.
+        "spikes == 0 and monotonic" to leave out the scans that failed the
+        quality control.
+    """
+
+    def __init__(self, output, groups=None, query=None):
+        output = Path(output)
+        metadata = pd.read_parquet(output / "metadata.parquet")
+        if groups is not None:
+            metadata = metadata[metadata["group"].isin(groups)]
+        if query is not None:
+            metadata = metadata.query(query)
+        self.metadata = metadata.reset_index(drop=True)
+        self._matrices = {
+            name: (
+                np.load(output / f"{name}_energy.npy").astype(np.float32),
+                np.load(output / f"{name}.npy", mmap_mode="r"),
+            )
+            for name in self.metadata["group"].unique()
+        }
+        self._groups = self.metadata["group"].to_numpy()
+        self._rows = self.metadata["row"].to_numpy()
+        self._elements = self.metadata["element"].to_numpy()
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def read(self, indices):
+        # Gathers the rows of each group in file order, for sequential reads of
+        # the memory maps, then puts them back in the order of indices.
+        indices = np.asarray(indices)
+        groups = self._groups[indices]
+        batch = None
+        for name in np.unique(groups):
+            energy, spectra = self._matrices[name]
+            if batch is None:
+                shape = (len(indices), spectra.shape[1])
+                batch = {
+                    "energy": np.empty(shape, dtype=np.float32),
+                    "mu": np.empty(shape, dtype=np.float32),
+                }
+            positions = np.flatnonzero(groups == name)
+            rows = self._rows[indices[positions]]
+            order = np.argsort(rows)
+            batch["mu"][positions[order]] = spectra[rows[order]]
+            batch["energy"][positions] = energy
+        batch["element"] = self._elements[indices]
+        return batch
+
+
+def _scan_nodes(tree, path=()):
+    # (path, node) of every dataframe node below tree, leaving out the stacked
+    # and merged nodes of the experiment groups.
+    for key, node in tree.items():
+        if key in (STACKED_KEY, MERGED_KEY) or node is None:
+            continue
+        if node.structure_family == "dataframe":
+            yield path + (key,), node
+        elif node.structure_family == "node":
+            yield from _scan_nodes(node, path + (key,))
+
+
+class TreeSpectra:
+    """
+    Spectra source over the scan nodes of a tiled tree, e.g. HealdLabViewTree or
+    a normalized tree.
+
+    The nodes are listed up front and read when their batch is assembled. Scans
+    that do not normalize or have no element or absorption are left out of their
+    batch, and spectra keep their own energy points, so the "energy" and "mu"
+    entries of a batch are lists of arrays.
+
+    Parameters
+    ----------
+    tree : tiled adapter
+    """
+
+    def __init__(self, tree):
+        self.nodes = list(_scan_nodes(tree))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def read(self, indices):
+        batch = {"energy": [], "mu": [], "element": [], "path": []}
+        for index in indices:
+            path, node = self.nodes[index]
+            df = node.read()
+            if "energy" not in df:
+                df, _ = normalize_dataframe(df)
+                if df is None:
+                    continue
+            element, _ = parse_element_name(Path(path[-1]), df, node.metadata)
+            mu, _ = absorption(df)
+            if element is None or mu is None:
+                continue
+            batch["energy"].append(df["energy"].to_numpy(dtype=np.float32))
+            batch["mu"].append(mu.astype(np.float32))
+            batch["element"].append(element)
+            batch["path"].append("/".join(path))
+        batch["element"] = np.array(batch["element"], dtype=object)
+        return batch
+
+
+class SpectraLoader:
+    """
+    Shuffled mini-batches of spectra for training jobs.
+
+    Iterating over the loader runs one epoch. The batches are assembled by worker
+    threads into a queue of at most prefetch batches, so reading the next ones
+    from disk overlaps with training on the current one. Each batch is a dict
+    with "energy", "mu" and "element" entries, see the sources.
+
+    Parameters
+    ----------
+    source : ExportedSpectra or TreeSpectra
+        Anything with __len__() and read(indices).
+    batch_size : int, optional
+    shuffle : bool, optional
+        Draw a new order of the spectra for every epoch.
+    workers : int, optional
+        Number of threads assembling batches.
+    prefetch : int, optional
+        Number of batches kept ready ahead of the consumer.
+    drop_last : bool, optional
+        Leave out the last batch when it is smaller than batch_size.
+    seed : int, optional
+    """
+
+    def __init__(
+        self,
+        source,
+        batch_size=64,
+        shuffle=True,
+        workers=2,
+        prefetch=8,
+        drop_last=False,
+        seed=None,
+    ):
+        self.source = source
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.workers = workers
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.source) // self.batch_size
+        return -(-len(self.source) // self.batch_size)
+
+    def _batches(self):
+        if self.shuffle:
+            order = self._rng.permutation(len(self.source))
+        else:
+            order = np.arange(len(self.source))
+        batches = []
+        for start in range(0, len(order), self.batch_size):
+            stop = start + self.batch_size
+            batches.append(order[start:stop])
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def __iter__(self):
+        tasks = iter(self._batches())
+        tasks_lock = threading.Lock()
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # Gives up when the consumer stopped iterating.
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def work():
+            while not stop.is_set():
+                with tasks_lock:
+                    indices = next(tasks, None)
+                if indices is None:
+                    break
+                try:
+                    put(self.source.read(indices))
+                except Exception as err:
+                    put(err)
+            put(done)
+
+        threads = [
+            threading.Thread(target=work, daemon=True, name=f"aimm-loader-{i}")
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        finished = 0
+        try:
+            while finished < len(threads):
+                item = batches.get()
+                if item is done:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+def benchmark_loader(loader, max_batches=None):
+    # Throughput of loader over one epoch, or over its first max_batches.
+    count = 0
+    batches = 0
+    start = time.perf_counter()
+    for batch in loader:
+        count += len(batch["element"])
+        batches += 1
+        if max_batches is not None and batches >= max_batches:
+            break
+    elapsed = time.perf_counter() - start
+    return {
+        "batches": batches,
+        "spectra": count,
+        "seconds": elapsed,
+        "spectra_per_second": count / elapsed if elapsed else float("inf"),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export the spectra.")
+    export_parser.add_argument("directory", help="Root directory of the LabVIEW files.")
+    export_parser.add_argument("output", help="Directory of the exported files.")
+    export_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs).",
+    )
+    export_parser.add_argument(
+        "--window",
+        type=float,
+        nargs=3,
+        default=DEFAULT_WINDOW,
+        metavar=("START", "STOP", "STEP"),
+        help="Energy grid relative to the edge, in eV (default: %(default)s).",
+    )
+    export_parser.add_argument(
+        "--edge-normalize",
+        action="store_true",
+        help="Export the edge-step normalized spectra instead of mu(E).",
+    )
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Measure the throughput of the data loader."
+    )
+    benchmark_parser.add_argument(
+        "source",
+        help="Directory of an export, or root directory of the LabVIEW files.",
+    )
+    benchmark_parser.add_argument("-b", "--batch-size", type=int, default=64)
+    benchmark_parser.add_argument(
+        "-w", "--workers", type=int, default=2, help="Number of loader threads."
+    )
+    benchmark_parser.add_argument(
+        "-n", "--max-batches", type=int, default=None, help="Stop after n batches."
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        metadata = export_spectra(
+            args.directory,
+            args.output,
+            tuple(args.window),
+            args.workers,
+            edge_normalize=args.edge_normalize,
+        )
+        print(
+            f"{len(metadata)} spectra exported, "
+            f"{metadata.attrs['skipped']} files skipped"
+        )
+        for name, count in metadata["group"].value_counts().sort_index().items():
+            print(f"{name}: {count}")
+    else:
+        if (Path(args.source) / "metadata.parquet").exists():
+            source = ExportedSpectra(args.source)
+        else:
+            tree = lazy_tree(args.source, normalized_node)
+            source = TreeSpectra(tree)
+        loader = SpectraLoader(source, args.batch_size, workers=args.workers)
+        result = benchmark_loader(loader, args.max_batches)
+        print(
+            f"{result['spectra']} spectra in {result['batches']} batches, "
+            f"{result['seconds']:.2f} s: {result['spectra_per_second']:.0f} spectra/s"
+        )
+
+
+if __name__ == "__main__":
+    main()